@@ -0,0 +1,103 @@
+"""
+Micro-benchmark of the top-of-book parser against a full JSON decode.
+
+Runs every parser on the order_book payloads recorded in benchmarks/payloads/.
+When no payload has been recorded yet, a synthetic one shaped like Bitso's
+response is used instead.
+
+    python -m benchmarks.bench_parse
+    python -m benchmarks.bench_parse --record btc_mxn xrp_mxn
+"""
+import os
+import json
+import glob
+import random
+import timeit
+import argparse
+from modules.fast_parse import parse_top_of_book, parse_payload
+
+PAYLOAD_DIR = os.path.join(os.path.dirname(__file__), "payloads")
+
+
+def synthetic_payload(book="btc_mxn", levels=500, mid=1_150_000.0):
+    """Order book response with the same layout as Bitso's"""
+    rng = random.Random(42)
+
+    def side(sign):
+        return [
+            {"book": book, "price": f"{mid + sign * (i + 1) * 5:.2f}", "amount": f"{rng.uniform(0.0001, 2):.8f}"}
+            for i in range(levels)
+        ]
+
+    response = {
+        "success": True,
+        "payload": {
+            "asks": side(1),
+            "bids": side(-1),
+            "updated_at": "2024-06-30T10:00:00+00:00",
+            "sequence": "2734013941",
+        },
+    }
+    return json.dumps(response, separators=(",", ":")).encode()
+
+
+def record_payloads(books):
+    from modules.api_request import make_request, BASE_URL
+
+    os.makedirs(PAYLOAD_DIR, exist_ok=True)
+    for book in books:
+        response = make_request(os.getenv("BITSO_API_KEY"), os.getenv("BITSO_API_SECRET"), "GET", BASE_URL, {"book": book})
+        path = os.path.join(PAYLOAD_DIR, f"{book}.json")
+        with open(path, "wb") as f:
+            f.write(response.content)
+        print(f"Recorded {len(response.content)} bytes to {path}")
+
+
+def load_payloads():
+    payloads = {}
+    for path in sorted(glob.glob(os.path.join(PAYLOAD_DIR, "*.json"))):
+        with open(path, "rb") as f:
+            payloads[os.path.basename(path)] = f.read()
+    return payloads or {"synthetic_500_levels": synthetic_payload()}
+
+
+def current_parser(raw):
+    payload = json.loads(raw).get('payload')
+    return float(payload['bids'][0]['price']), float(payload['asks'][0]['price'])
+
+
+def full_decode_parser(raw):
+    payload = parse_payload(raw)
+    return float(payload['bids'][0]['price']), float(payload['asks'][0]['price'])
+
+
+PARSERS = {
+    "json (current)": current_parser,
+    "full decode (orjson if installed)": full_decode_parser,
+    "top of book scan": parse_top_of_book,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--record", nargs="+", metavar="BOOK", help="record live order_book payloads first")
+    parser.add_argument("--number", type=int, default=2000, help="calls per measurement")
+    args = parser.parse_args()
+
+    if args.record:
+        record_payloads(args.record)
+
+    for name, raw in load_payloads().items():
+        expected = current_parser(raw)
+        print(f"{name} ({len(raw) / 1024:.1f} KiB)")
+
+        baseline = None
+        for parser_name, parse in PARSERS.items():
+            assert parse(raw) == expected, f"{parser_name} disagrees with the current parser"
+            seconds = min(timeit.repeat(lambda: parse(raw), number=args.number, repeat=5)) / args.number
+            baseline = baseline or seconds
+            print(f"  {parser_name:<36} {seconds * 1e6:10.2f} us/call  {baseline / seconds:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+"""
+End-to-end benchmark of the collection strategies against a local mock Bitso.
+
+Every strategy runs in its own process for --duration seconds against
+mocks/bitso_server.py, with closed files uploaded to the fake GCS server of
+mocks/fake_gcs_server.py (or moved to data/ with --sink local) inside a
+scratch directory. The report is JSON: sampled rows per second, request
+latency percentiles, tick jitter (lateness of the ticks past their
+deadline), missed ticks, CPU and peak RSS of each strategy.
+
+    python -m benchmarks.run_strategies --books 10 --duration 60
+    python -m benchmarks.run_strategies --strategies main_async --latency 200 --error-rate 0.05
+    python -m benchmarks.run_strategies --strategies main_multithreading main_async --books 30 --ticker
+    python -m benchmarks.run_strategies --output current.json --baseline baseline.json
+
+With --baseline the run is compared to an earlier report and the command exits
+with status 1 when a metric regressed by more than --tolerance.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import importlib
+import resource
+import threading
+import subprocess
+from mocks.bitso_server import start_mock_server, DEFAULT_BOOKS
+from mocks.fake_gcs_server import start_fake_gcs
+
+STRATEGIES = ["main", "main_multithreading", "main_async"]
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Metric -> True when higher is better, checked against --baseline
+REGRESSION_CHECKS = {
+    "rows_per_second": True,
+    "cpu_percent": False,
+    "peak_rss_mb": False,
+    "tick_jitter_ms.p99": False,
+}
+
+
+def percentiles(samples, scale=1000):
+    """p50/p90/p99/max of `samples`, scaled to milliseconds by default"""
+    if not samples:
+        return {"p50": None, "p90": None, "p99": None, "max": None}
+    ordered = sorted(samples)
+
+    def at(q):
+        return round(ordered[min(int(q * len(ordered)), len(ordered) - 1)] * scale, 3)
+
+    return {"p50": at(0.5), "p90": at(0.9), "p99": at(0.99), "max": round(ordered[-1] * scale, 3)}
+
+
+def book_names(count):
+    """The first `count` books, padded with made-up ones beyond the known books"""
+    return (DEFAULT_BOOKS + [f"bench{i}_mxn" for i in range(count)])[:count]
+
+
+class Probe:
+    """Counts rows, request latencies and tick lateness inside the benchmarked process"""
+
+    def __init__(self):
+        self.started_at = None
+        self.rows = 0
+        self.latencies = []
+        self.lateness = []
+        self.clocks = []
+        self.missed_at_start = 0
+
+    def install(self):
+        from modules import api_request, api_request_async
+        from modules.scheduler import TickClock
+        from modules.interval_writer import IntervalWriter, AsyncIntervalWriter
+
+        probe = self
+        make_request, make_request_async = api_request.make_request, api_request_async.make_request
+
+        def timed_request(*args, **kwargs):
+            started_at = time.monotonic()
+            try:
+                return make_request(*args, **kwargs)
+            finally:
+                probe.record(probe.latencies, time.monotonic() - started_at)
+
+        async def timed_request_async(*args, **kwargs):
+            started_at = time.monotonic()
+            try:
+                return await make_request_async(*args, **kwargs)
+            finally:
+                probe.record(probe.latencies, time.monotonic() - started_at)
+
+        api_request.make_request = timed_request
+        api_request_async.make_request = timed_request_async
+
+        init, fire = TickClock.__init__, TickClock._fire
+
+        def register(clock, *args, **kwargs):
+            init(clock, *args, **kwargs)
+            probe.clocks.append(clock)
+
+        def timed_fire(clock, delay=0.0):
+            probe.record(probe.lateness, time.monotonic() - clock._deadline - delay)
+            fire(clock, delay)
+
+        TickClock.__init__, TickClock._fire = register, timed_fire
+
+        write, write_async = IntervalWriter.write, AsyncIntervalWriter.write
+
+        def counted_write(writer, data_tuple):
+            probe.count_row()
+            write(writer, data_tuple)
+
+        async def counted_write_async(writer, data_tuple):
+            probe.count_row()
+            await write_async(writer, data_tuple)
+
+        IntervalWriter.write, AsyncIntervalWriter.write = counted_write, counted_write_async
+
+    def record(self, samples, value):
+        if self.started_at is not None:
+            samples.append(value)
+
+    def count_row(self):
+        if self.started_at is not None:
+            self.rows += 1
+
+    def missed(self):
+        return sum(clock.stats["missed"] for clock in self.clocks)
+
+    def start(self):
+        self.missed_at_start = self.missed()
+        self.usage_at_start = resource.getrusage(resource.RUSAGE_SELF)
+        self.started_at = time.monotonic()
+
+    def report(self):
+        elapsed = time.monotonic() - self.started_at
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu = (usage.ru_utime - self.usage_at_start.ru_utime) + (usage.ru_stime - self.usage_at_start.ru_stime)
+        return {
+            "seconds": round(elapsed, 3),
+            "rows": self.rows,
+            "rows_per_second": round(self.rows / elapsed, 3),
+            "requests": len(self.latencies),
+            "request_latency_ms": percentiles(self.latencies),
+            "ticks": len(self.lateness),
+            "tick_jitter_ms": percentiles(self.lateness),
+            "missed_ticks": self.missed() - self.missed_at_start,
+            "cpu_seconds": round(cpu, 3),
+            "cpu_percent": round(100 * cpu / elapsed, 2),
+            "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),  # ru_maxrss is in KiB on Linux
+        }
+
+
+def run_child(args):
+    """Run one strategy in this process and print its metrics as JSON"""
+    logging.basicConfig(level=args.log_level)
+    logging.getLogger().setLevel(args.log_level)
+
+    from modules import api_request, api_request_async
+    from modules.rate_limiter import rate_limiter
+
+    api_request.BASE_URL = api_request_async.BASE_URL = args.base_url
+    api_request.TICKER_URL = api_request_async.TICKER_URL = args.base_url.replace("/order_book", "/ticker")
+    # 0 turns rate limiting off on the server, the collectors then get a budget they never exhaust
+    rate_limiter.rate = (args.requests_per_minute or 1_000_000) / 60
+    probe = Probe()
+    probe.install()
+
+    strategy = importlib.import_module(args.child)
+    strategy.STORE_IN_GCS = args.sink == "gcs"
+    if args.ticker:
+        strategy.TICKER_MODE = True
+    books = book_names(args.books)
+    api_key, api_secret = os.environ["BITSO_API_KEY"], os.environ["BITSO_API_SECRET"]
+
+    if args.child == "main":
+        # main.py samples a single book
+        books = books[:1]
+        strategy.upload_pipeline.start()
+        target, target_args = strategy.main_loop, (books[0], api_key, api_secret)
+    elif args.child == "main_async":
+        strategy.books = books
+        target, target_args = asyncio.run, (strategy.main(),)
+    else:
+        strategy.books = books
+        target, target_args = strategy.main, ()
+    threading.Thread(target=target, args=target_args, daemon=True).start()
+
+    time.sleep(args.warmup)
+    probe.start()
+    time.sleep(args.duration)
+    result = {"strategy": args.child, "books": len(books), **probe.report()}
+    print(json.dumps(result), flush=True)
+    # The strategies loop forever, skip their cleanup
+    os._exit(0)
+
+
+def run_strategy(strategy, args, base_url, env):
+    command = [
+        sys.executable, "-m", "benchmarks.run_strategies", "--child", strategy,
+        "--base-url", base_url, "--books", str(args.books), "--duration", str(args.duration),
+        "--warmup", str(args.warmup), "--requests-per-minute", str(args.requests_per_minute),
+        "--sink", args.sink, "--log-level", args.log_level,
+    ] + (["--ticker"] if args.ticker else [])
+    env = {**env, "PYTHONPATH": os.pathsep.join(filter(None, [REPO_DIR, env.get("PYTHONPATH")]))}
+    with tempfile.TemporaryDirectory(prefix=f"bench_{strategy}_") as scratch:
+        completed = subprocess.run(command, cwd=scratch, env=env, stdout=subprocess.PIPE, text=True,
+                                   timeout=args.warmup + args.duration + 60)
+    if completed.returncode != 0:
+        raise RuntimeError(f"{strategy} exited with status {completed.returncode}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def metric(result, name):
+    value = result
+    for key in name.split("."):
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Compare a run with a baseline report
+
+    Returns:
+    list: Descriptions of the metrics that regressed by more than `tolerance`
+    '''
+    previous = {result["strategy"]: result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = previous.get(result["strategy"])
+        if before is None:
+            continue
+        for name, higher_is_better in REGRESSION_CHECKS.items():
+            old, new = metric(before, name), metric(result, name)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (change < -tolerance) if higher_is_better else (change > tolerance):
+                regressions.append(f"{result['strategy']} {name}: {old} -> {new} ({change:+.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--strategies", nargs="+", choices=STRATEGIES, default=STRATEGIES)
+    parser.add_argument("--books", type=int, default=3, help="books sampled by each strategy")
+    parser.add_argument("--duration", type=float, default=30, help="measured seconds per strategy")
+    parser.add_argument("--warmup", type=float, default=3, help="seconds run before measuring")
+    parser.add_argument("--latency", type=float, default=50, help="mock base response time in ms")
+    parser.add_argument("--jitter", type=float, default=20, help="mock mean extra delay in ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of mock responses that are 503s")
+    parser.add_argument("--depth", type=int, default=50, help="price levels per side in the mock order books")
+    parser.add_argument("--requests-per-minute", type=int, default=60,
+                        help="request budget of the mock server and of the collectors' rate limiter, 0 disables it")
+    parser.add_argument("--ticker", action="store_true",
+                        help="run main_multithreading and main_async in ticker mode, one request per tick for all books")
+    parser.add_argument("--sink", choices=["gcs", "local"], default="gcs",
+                        help="upload to the fake GCS server or move files to data/")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    parser.add_argument("--baseline", help="earlier JSON report to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative change counted as a regression")
+    parser.add_argument("--log-level", default="WARNING", help="log level of the benchmarked strategies")
+    parser.add_argument("--child", choices=STRATEGIES, help=argparse.SUPPRESS)
+    parser.add_argument("--base-url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return run_child(args)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    gcs = start_fake_gcs(port=0)
+    env = {
+        **os.environ,
+        "STORAGE_EMULATOR_HOST": f"http://localhost:{gcs.server_port}",
+        "GOOGLE_CLOUD_PROJECT": os.getenv("GOOGLE_CLOUD_PROJECT", "benchmark"),
+        "BITSO_API_KEY": "benchmark",
+        "BITSO_API_SECRET": "benchmark",
+    }
+
+    results = []
+    for strategy in args.strategies:
+        # A fresh server per strategy, so rate-limit windows and stats don't carry over
+        server, base_url = start_mock_server(
+            latency=args.latency / 1000, jitter=args.jitter / 1000, error_rate=args.error_rate, depth=args.depth,
+            requests_per_minute=args.requests_per_minute or None, seed=0, books=book_names(args.books)
+        )
+        logging.info(f"Running {strategy} with {args.books} books for {args.warmup + args.duration:.0f}s")
+        result = run_strategy(strategy, args, base_url, env)
+        result["server"] = {key: value for key, value in server.stats.items() if key != "books"}
+        results.append(result)
+        logging.info(
+            f"{strategy}: {result['rows_per_second']} rows/s, latency p99 {result['request_latency_ms']['p99']}ms, "
+            f"jitter p99 {result['tick_jitter_ms']['p99']}ms, {result['missed_ticks']} missed ticks, "
+            f"CPU {result['cpu_percent']}%, peak RSS {result['peak_rss_mb']}MB"
+        )
+
+    report = {
+        "config": {key: value for key, value in vars(args).items()
+                   if key not in ("child", "base_url", "output", "baseline")},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            logging.error(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,17 @@
 import os
 import logging
 from datetime import datetime, timezone, timedelta
-import time
-from google.cloud import storage
 from modules.api_request import make_request_and_process
-from modules.utils import save_to_csv_stream, store_data_to_gcs, store_data_locally
+from modules.credentials import CredentialPool
+from modules.utils import store_data_to_gcs, store_data_locally
+from modules.interval_writer import IntervalWriter
+from modules.depth import depth_filename
+from modules.bars import BarAggregator, bars_filename
+from modules.scheduler import TickClock
+from modules.resilience import request_policy
+from modules.upload_pipeline import UploadPipeline, FanOutPipeline
+from modules.sinks import start_row_sinks
+from modules.metrics import start_metrics
 
 # Constants
 GCS_BUCKET_NAME = "bitsode"
@@ -12,18 +19,30 @@ BASE_URL = "https://stage.bitso.com/api/v3/order_book"
 HTTP_METHOD = "GET"
 STORE_IN_GCS = True
 MINUTE_MULTIPLE = 2
+OUTPUT_FORMAT = "csv"  # One of modules.formats.OUTPUT_FORMATS, e.g. "parquet"
+METRICS_DUMP_FILE = None  # e.g. "metrics.prom" to also dump the metrics to a file every minute
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
-# Initialize GCS client
-gcs_client = storage.Client()
-
 # Load API credentials from environment variables
 api_key = os.getenv("BITSO_API_KEY")
 api_secret = os.getenv("BITSO_API_SECRET")
+# Every BITSO_API_KEY_<n> pair adds its own request budget, see modules/credentials.py
+credential_pool = CredentialPool.from_env()
 book = "btc_mxn"
+# Books whose full order book is reduced to depth metrics stored next to the interval files
+DEPTH_BOOKS = set()
+# Bar sizes in minutes of the OHLC bars stored next to the interval files, e.g. (1, 5, MINUTE_MULTIPLE)
+BAR_MINUTES = ()
+# Drop unchanged top-of-book samples: None, "changes" or "rle", see modules/interval_writer.py
+DEDUP_MODE = None
+# Build intervals in memory and stream them to storage: None, "memory" or "gzip", see modules/interval_writer.py
+BUFFER = None
+# Sinks of the closed intervals and of every row, e.g. ["local", "gcs", "ndjson", "queue"], see modules/sinks.py
+# None stores the intervals in GCS or locally per STORE_IN_GCS
+SINKS = None
 
 
 def round_down_minute(current_time):
@@ -35,9 +54,29 @@ def round_down_minute(current_time):
 def store_data(filename):
     """Store data either in GCS or locally"""
     if STORE_IN_GCS:
-        store_data_to_gcs(GCS_BUCKET_NAME, filename)
+        store_data_to_gcs(GCS_BUCKET_NAME, filename, OUTPUT_FORMAT)
     else:
-        store_data_locally(filename)
+        store_data_locally(filename, OUTPUT_FORMAT)
+
+
+def store_locally(filename):
+    """File sink "local" of SINKS"""
+    store_data_locally(filename, OUTPUT_FORMAT)
+
+
+def store_in_gcs(filename):
+    """File sink "gcs" of SINKS"""
+    store_data_to_gcs(GCS_BUCKET_NAME, filename, OUTPUT_FORMAT)
+
+
+# Uploads run in the background so interval rollovers never block sampling
+if SINKS:
+    # Every file sink gets its own upload pipeline, so a slow one never holds up the others
+    upload_pipeline = FanOutPipeline({
+        name: store for name, store in (("local", store_locally), ("gcs", store_in_gcs)) if name in SINKS
+    })
+else:
+    upload_pipeline = UploadPipeline(store_data)
 
 
 def main_loop(book, api_key, api_secret):
@@ -45,22 +84,38 @@ def main_loop(book, api_key, api_secret):
     current_interval = round_down_minute(datetime.now(timezone.utc))
     next_interval = current_interval + timedelta(minutes=MINUTE_MULTIPLE)
     filename = f"{book}_{current_interval.strftime('%Y-%m-%d-%H-%M-%S')}.csv"
+    writer = IntervalWriter(filename, dedup=DEDUP_MODE, buffer=BUFFER)
+    depth_writer = IntervalWriter(depth_filename(filename), buffer=BUFFER)
+    bar_writer = IntervalWriter(bars_filename(filename), buffer=BUFFER)
+    bars = BarAggregator(BAR_MINUTES)
+    capture_depth = book in DEPTH_BOOKS
+    clock = TickClock(book)
 
     while True:
+        clock.wait()
         now = datetime.now(timezone.utc)
 
-        data_tuple = make_request_and_process(api_key, api_secret, book)
+        result = make_request_and_process(api_key, api_secret, book, credential_pool, depth=capture_depth)
 
-        if not data_tuple:
-            time.sleep(1 - datetime.now(timezone.utc).microsecond / 1_000_000)
+        if not result:
             continue
 
+        data_tuple, depth_tuple = result if capture_depth else (result, None)
+
         if now < next_interval:
-            save_to_csv_stream(data_tuple, filename)
+            writer.write(data_tuple)
         else:
-            # Store the previous interval's data
-            store_data(filename)
-            logger.info(f"Data for interval {current_interval} to {next_interval} stored.")
+            # Hand the previous interval's data to the upload pipeline
+            for bar in bars.expire(next_interval):
+                bar_writer.write(bar)
+            for closed_filename in (writer.close(), depth_writer.close(), bar_writer.close()):
+                if closed_filename:
+                    upload_pipeline.submit(closed_filename)
+            if upload_pipeline.backpressure:
+                logger.warning(f"Uploads are falling behind: {upload_pipeline.stats}")
+            logger.info(f"Data for interval {current_interval} to {next_interval} queued for upload.")
+            clock.report()
+            request_policy.report(book)
 
             # Update intervals and filename for the new interval
             current_interval = round_down_minute(now)
@@ -68,10 +123,20 @@ def main_loop(book, api_key, api_secret):
             filename = f"{book}_{current_interval.strftime('%Y-%m-%d-%H-%M-%S')}.csv"
 
             # Save the first data point of the new interval
-            save_to_csv_stream(data_tuple, filename)
+            writer.open(filename)
+            depth_writer.open(depth_filename(filename))
+            bar_writer.open(bars_filename(filename))
+            writer.write(data_tuple)
+
+        for bar in bars.update(data_tuple):
+            bar_writer.write(bar)
 
-        time.sleep(1 - datetime.now(timezone.utc).microsecond / 1_000_000)
+        if depth_tuple:
+            depth_writer.write(depth_tuple)
 
 
 if __name__ == "__main__":
+    start_metrics(dump_file=METRICS_DUMP_FILE)
+    upload_pipeline.start()
+    start_row_sinks(SINKS)
     main_loop(book, api_key, api_secret)
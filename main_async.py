@@ -1,15 +1,21 @@
 import os
 import logging
 import asyncio
-import aiohttp
 from datetime import datetime, timezone, timedelta
-from google.cloud import storage
-from modules.api_request_async import make_request_and_process
-from modules.utils_async import (
-    save_to_csv_stream_async,
-    store_data_to_gcs_async,
-    store_data_locally_async
-)
+from modules.api_request_async import make_request_and_process, fetch_tickers
+from modules.credentials import CredentialPool
+from modules.http_client import async_http_client
+from modules.utils_async import store_data_to_gcs_async, store_data_locally_async
+from modules.interval_writer import AsyncIntervalWriter
+from modules.upload_pipeline import AsyncUploadPipeline, AsyncFanOutPipeline
+from modules.sinks import start_row_sinks, close_row_sinks
+from modules.depth import depth_filename
+from modules.bars import BarAggregator, bars_filename
+from modules.adaptive import adaptive_sampler, rates_filename
+from modules.cross_book import CrossBookSnapshot, cross_filename, SETTLE_DELAY
+from modules.scheduler import TickClock, TICK_PERIOD
+from modules.resilience import request_policy
+from modules.metrics import start_metrics, LOG_TICKS
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -21,75 +27,255 @@ BASE_URL = "https://stage.bitso.com/api/v3/order_book"
 HTTP_METHOD = "GET"
 STORE_IN_GCS = True
 MINUTE_MULTIPLE = 2
+OUTPUT_FORMAT = "csv"  # One of modules.formats.OUTPUT_FORMATS, e.g. "parquet"
+METRICS_DUMP_FILE = None  # e.g. "metrics.prom" to also dump the metrics to a file every minute
 
 # Load API credentials from environment variables
 api_key = os.getenv("BITSO_API_KEY")
 api_secret = os.getenv("BITSO_API_SECRET")
+# Every BITSO_API_KEY_<n> pair adds its own request budget, see modules/credentials.py
+credential_pool = CredentialPool.from_env()
 # books = ["btc_mxn", "ltc_mxn", "xrp_mxn"]  # List of book parameters
 books = ['btc_mxn', 'ltc_mxn']
-
-# Initialize GCS client
-gcs_client = storage.Client()
+# Books with a higher priority get request tokens first when the shared budget is tight
+BOOK_PRIORITIES = {"btc_mxn": 2}
+# Books whose full order book is reduced to depth metrics stored next to the interval files
+DEPTH_BOOKS = set()
+# Bar sizes in minutes of the OHLC bars stored next to the interval files, e.g. (1, 5, MINUTE_MULTIPLE)
+BAR_MINUTES = ()
+# Drop unchanged top-of-book samples: None, "changes" or "rle", see modules/interval_writer.py
+DEDUP_MODE = None
+# Build intervals in memory and stream them to storage: None, "memory" or "gzip", see modules/interval_writer.py
+BUFFER = None
+# Sinks of the closed intervals and of every row, e.g. ["local", "gcs", "ndjson", "queue"], see modules/sinks.py
+# None stores the intervals in GCS or locally per STORE_IN_GCS
+SINKS = None
+# Spread the request budget over the books by their volatility instead of 1 Hz each, see modules/adaptive.py
+ADAPTIVE_SAMPLING = False
+# Sample every book from one ticker request per tick, only DEPTH_BOOKS still request their order book
+TICKER_MODE = False
+# Write implied cross rates, arbitrage gaps and spread z-scores of all the books every tick, see modules/cross_book.py
+CROSS_BOOK = False
 
 
 def round_down_minute(current_time):
     """
     Round down the current time to the nearest multiple of MINUTE_MULTIPLE
     """
-    minutes = (current_time.minute + (MINUTE_MULTIPLE // 2)) // MINUTE_MULTIPLE * MINUTE_MULTIPLE
-    return current_time.replace(minute=minutes % 60, second=0, microsecond=0)
+    minutes = (current_time.minute // MINUTE_MULTIPLE) * MINUTE_MULTIPLE
+    return current_time.replace(minute=minutes, second=0, microsecond=0)
+
+
+def open_interval(writers, current_interval, bar_writers):
+    """Open the files of a new interval for every book"""
+    for book, writer in writers.items():
+        filename = f"{book}_{current_interval.strftime('%Y-%m-%d-%H-%M-%S')}.csv"
+        writer.open(filename)
+        bar_writers[book].open(bars_filename(filename))
 
 
-async def process_book(book, api_key, api_secret, session, current_interval):
+async def process_book(book, api_key, api_secret, session, writer, depth_writer, bar_writer, bars):
     params = {"book": book}
-    logging.info(f"Processing book: {book} with params: {params}")
+    capture_depth = book in DEPTH_BOOKS
+    if LOG_TICKS:
+        logging.info(f"Processing book: {book} with params: {params}")
 
     try:
-        data_tuple = await make_request_and_process(api_key, api_secret, params, session)
+        result = await make_request_and_process(api_key, api_secret, params, session, credential_pool, depth=capture_depth)
 
-        if data_tuple:
-            filename = f"{book}_{current_interval.strftime('%Y-%m-%d-%H-%M-%S')}.csv"
-            await save_to_csv_stream_async(data_tuple, filename)
-            return book, filename
+        if result:
+            data_tuple, depth_tuple = result if capture_depth else (result, None)
+            await writer.write(data_tuple)
+            for bar in bars.update(data_tuple):
+                await bar_writer.write(bar)
+            if depth_tuple:
+                await depth_writer.write(depth_tuple)
+            return data_tuple
         else:
             logging.error(f"No data fetched for {book}")
-            return book, None
     except Exception as e:
         logging.error(f"Error processing {book}: {e}")
-        return book, None
 
 
-async def store_data(files_to_store):
-    store_tasks = []
-    for book, filename in files_to_store:
+async def store_data(filename):
+    """Store data either in GCS or locally"""
+    if STORE_IN_GCS:
+        await store_data_to_gcs_async(GCS_BUCKET_NAME, filename, OUTPUT_FORMAT)
+    else:
+        await store_data_locally_async(filename, OUTPUT_FORMAT)
+
+
+async def store_locally(filename):
+    """File sink "local" of SINKS"""
+    await store_data_locally_async(filename, OUTPUT_FORMAT)
+
+
+async def store_in_gcs(filename):
+    """File sink "gcs" of SINKS"""
+    await store_data_to_gcs_async(GCS_BUCKET_NAME, filename, OUTPUT_FORMAT)
+
+
+# Uploads run in the background so interval rollovers never block sampling
+if SINKS:
+    # Every file sink gets its own upload pipeline, so a slow one never holds up the others
+    upload_pipeline = AsyncFanOutPipeline({
+        name: store for name, store in (("local", store_locally), ("gcs", store_in_gcs)) if name in SINKS
+    })
+else:
+    upload_pipeline = AsyncUploadPipeline(store_data)
+# Latest top of book of every book, read by the cross-book collector
+cross_snapshot = CrossBookSnapshot(books)
+
+
+async def submit_closed(writers, pipeline=upload_pipeline):
+    """Close the writers of an interval and queue their files for upload"""
+    for writer in writers:
+        filename = await writer.close()
         if filename:
-            if STORE_IN_GCS:
-                store_tasks.append(store_data_to_gcs_async(GCS_BUCKET_NAME, filename))
-            else:
-                store_tasks.append(store_data_locally_async(filename))
+            await pipeline.submit(filename)
+    if pipeline.backpressure:
+        logger.warning(f"Uploads are falling behind: {pipeline.stats}")
 
-    if store_tasks:
-        await asyncio.gather(*store_tasks)
 
+async def collect_book(book, api_key, api_secret, session, pipeline=upload_pipeline):
+    """Sample one book on its own tick grid, so a slow book never delays the others"""
+    current_interval = round_down_minute(datetime.now(timezone.utc))
+    next_interval = current_interval + timedelta(minutes=MINUTE_MULTIPLE)
+    filename = f"{book}_{current_interval.strftime('%Y-%m-%d-%H-%M-%S')}.csv"
+    writer = AsyncIntervalWriter(filename, dedup=DEDUP_MODE, buffer=BUFFER)
+    depth_writer = AsyncIntervalWriter(depth_filename(filename), buffer=BUFFER)
+    bar_writer = AsyncIntervalWriter(bars_filename(filename), buffer=BUFFER)
+    rate_writer = AsyncIntervalWriter(rates_filename(filename), buffer=BUFFER)
+    bars = BarAggregator(BAR_MINUTES)
+    clock = TickClock(book)
+    if ADAPTIVE_SAMPLING:
+        adaptive_sampler.attach(book, clock)
 
-async def main():
+    while True:
+        await clock.wait_async()
+        now = datetime.now(timezone.utc)
+
+        if now >= next_interval:
+            for bar in bars.expire(next_interval):
+                await bar_writer.write(bar)
+            await submit_closed([writer, depth_writer, bar_writer, rate_writer], pipeline)
+            logger.info(f"Data for {book} interval {current_interval} to {next_interval} queued for upload.")
+            clock.report()
+            request_policy.report(book)
+
+            current_interval = round_down_minute(now)
+            next_interval = current_interval + timedelta(minutes=MINUTE_MULTIPLE)
+            filename = f"{book}_{current_interval.strftime('%Y-%m-%d-%H-%M-%S')}.csv"
+            writer.open(filename)
+            depth_writer.open(depth_filename(filename))
+            bar_writer.open(bars_filename(filename))
+            rate_writer.open(rates_filename(filename))
+
+        data_tuple = await process_book(book, api_key, api_secret, session, writer, depth_writer, bar_writer, bars)
+        if data_tuple and CROSS_BOOK:
+            cross_snapshot.update(data_tuple)
+        if data_tuple and ADAPTIVE_SAMPLING:
+            for row in adaptive_sampler.observe(data_tuple):
+                await rate_writer.write(row)
+
+
+async def collect_tickers(ticker_books, api_key, api_secret, session, pipeline=upload_pipeline):
+    """Sample all the books from a single ticker request per tick"""
+    current_interval = round_down_minute(datetime.now(timezone.utc))
+    next_interval = current_interval + timedelta(minutes=MINUTE_MULTIPLE)
+    writers = {book: AsyncIntervalWriter(dedup=DEDUP_MODE, buffer=BUFFER) for book in ticker_books}
+    bar_writers = {book: AsyncIntervalWriter(buffer=BUFFER) for book in ticker_books}
+    open_interval(writers, current_interval, bar_writers)
+    bars = BarAggregator(BAR_MINUTES)
+    clock = TickClock("ticker")
+
+    while True:
+        await clock.wait_async()
+        now = datetime.now(timezone.utc)
+
+        if now >= next_interval:
+            for bar in bars.expire(next_interval):
+                await bar_writers[bar[1]].write(bar)
+            await submit_closed([*writers.values(), *bar_writers.values()], pipeline)
+            logger.info(f"Ticker data for interval {current_interval} to {next_interval} queued for upload.")
+            clock.report()
+            request_policy.report("ticker")
+
+            current_interval = round_down_minute(now)
+            next_interval = current_interval + timedelta(minutes=MINUTE_MULTIPLE)
+            open_interval(writers, current_interval, bar_writers)
+
+        try:
+            data_tuples = await fetch_tickers(api_key, api_secret, ticker_books, session, credential_pool)
+            for book, data_tuple in data_tuples.items():
+                await writers[book].write(data_tuple)
+                for bar in bars.update(data_tuple):
+                    await bar_writers[book].write(bar)
+                if CROSS_BOOK:
+                    cross_snapshot.update(data_tuple)
+        except Exception as e:
+            logging.error(f"Error processing tickers: {e}")
+
+
+async def collect_cross(snapshot, pipeline=upload_pipeline):
+    """Write the cross-book metrics of the latest samples of all the books once per tick"""
     current_interval = round_down_minute(datetime.now(timezone.utc))
     next_interval = current_interval + timedelta(minutes=MINUTE_MULTIPLE)
+    writer = AsyncIntervalWriter(cross_filename(current_interval), buffer=BUFFER)
+    clock = TickClock("cross")
+
+    while True:
+        await clock.wait_async()
+        await asyncio.sleep(SETTLE_DELAY)
+        now = datetime.now(timezone.utc)
+
+        if now >= next_interval:
+            await submit_closed([writer], pipeline)
+            logger.info(f"Cross-book data for interval {current_interval} to {next_interval} queued for upload.")
+            clock.report()
+
+            current_interval = round_down_minute(now)
+            next_interval = current_interval + timedelta(minutes=MINUTE_MULTIPLE)
+            writer.open(cross_filename(current_interval))
+
+        for row in snapshot.rows(now):
+            await writer.write(row)
 
-    async with aiohttp.ClientSession() as session:
-        while True:
-            now = datetime.now(timezone.utc)
 
-            tasks = [process_book(book, api_key, api_secret, session, current_interval) for book in books]
-            results = await asyncio.gather(*tasks)
+def collectors(books, api_key, api_secret, session, pipeline=upload_pipeline):
+    """Collection coroutines for `books`, one per book or one ticker collector plus the depth books"""
+    if not TICKER_MODE:
+        return [collect_book(book, api_key, api_secret, session, pipeline) for book in books]
 
-            if now > next_interval:
-                await store_data(results)
-                current_interval = round_down_minute(now)
-                next_interval = current_interval + timedelta(minutes=MINUTE_MULTIPLE)
+    ticker_books = [book for book in books if book not in DEPTH_BOOKS]
+    depth_books = [book for book in books if book in DEPTH_BOOKS]
+    tasks = [collect_book(book, api_key, api_secret, session, pipeline) for book in depth_books]
+    if ticker_books:
+        tasks.append(collect_tickers(ticker_books, api_key, api_secret, session, pipeline))
+        # The ticker request comes out of the budget the sampler hands to the depth books
+        adaptive_sampler.reserved = 1 / TICK_PERIOD
+    return tasks
 
-            await asyncio.sleep(1 - datetime.now(timezone.utc).microsecond / 1_000_000)
+
+async def main():
+    for book, priority in BOOK_PRIORITIES.items():
+        credential_pool.set_priority(book, priority)
+    # The adaptive sampler hands out the budget of every key of the pool
+    adaptive_sampler.limiter = credential_pool
+
+    await upload_pipeline.start()
+    start_row_sinks(SINKS)
+    try:
+        async with async_http_client as session:
+            tasks = collectors(books, api_key, api_secret, session)
+            if CROSS_BOOK:
+                tasks.append(collect_cross(cross_snapshot))
+            await asyncio.gather(*tasks)
+    finally:
+        await asyncio.to_thread(close_row_sinks, 10)
+        await upload_pipeline.close(timeout=60)
 
 
 if __name__ == "__main__":
+    start_metrics(dump_file=METRICS_DUMP_FILE)
     asyncio.run(main())
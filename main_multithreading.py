@@ -1,11 +1,22 @@
 import os
+import signal
 import logging
 from datetime import datetime, timezone, timedelta
-import time
 import threading
-from google.cloud import storage
-from modules.api_request import make_request_and_process
-from modules.utils import save_to_csv_stream, store_data_to_gcs, store_data_locally
+from modules.api_request import make_request_and_process, fetch_tickers
+from modules.credentials import CredentialPool
+from modules.utils import store_data_to_gcs, store_data_locally
+from modules.interval_writer import IntervalWriter
+from modules.depth import depth_filename
+from modules.bars import BarAggregator, bars_filename
+from modules.adaptive import adaptive_sampler, rates_filename
+from modules.cross_book import CrossBookSnapshot, cross_filename, SETTLE_DELAY
+from modules.scheduler import TickClock, TICK_PERIOD
+from modules.timer_wheel import WheelExecutor
+from modules.resilience import request_policy
+from modules.upload_pipeline import UploadPipeline, FanOutPipeline
+from modules.sinks import start_row_sinks, close_row_sinks
+from modules.metrics import start_metrics
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -17,14 +28,36 @@ BASE_URL = "https://stage.bitso.com/api/v3/order_book"
 HTTP_METHOD = "GET"
 STORE_IN_GCS = True
 MINUTE_MULTIPLE = 2
+OUTPUT_FORMAT = "csv"  # One of modules.formats.OUTPUT_FORMATS, e.g. "parquet"
+METRICS_DUMP_FILE = None  # e.g. "metrics.prom" to also dump the metrics to a file every minute
 
 # Load API credentials from environment variables
 api_key = os.getenv("BITSO_API_KEY")
 api_secret = os.getenv("BITSO_API_SECRET")
+# Every BITSO_API_KEY_<n> pair adds its own request budget, see modules/credentials.py
+credential_pool = CredentialPool.from_env()
 books = ["btc_mxn", "xrp_mxn"]  # Add or remove books as needed
-
-# Initialize GCS client
-gcs_client = storage.Client()
+# Books with a higher priority get request tokens first when the shared budget is tight
+BOOK_PRIORITIES = {"btc_mxn": 2}
+# Books whose full order book is reduced to depth metrics stored next to the interval files
+DEPTH_BOOKS = set()
+# Bar sizes in minutes of the OHLC bars stored next to the interval files, e.g. (1, 5, MINUTE_MULTIPLE)
+BAR_MINUTES = ()
+# Drop unchanged top-of-book samples: None, "changes" or "rle", see modules/interval_writer.py
+DEDUP_MODE = None
+# Build intervals in memory and stream them to storage: None, "memory" or "gzip", see modules/interval_writer.py
+BUFFER = None
+# Sinks of the closed intervals and of every row, e.g. ["local", "gcs", "ndjson", "queue"], see modules/sinks.py
+# None stores the intervals in GCS or locally per STORE_IN_GCS
+SINKS = None
+# Spread the request budget over the books by their volatility instead of 1 Hz each, see modules/adaptive.py
+ADAPTIVE_SAMPLING = False
+# Sample every book from one ticker request per tick, only DEPTH_BOOKS still request their order book
+TICKER_MODE = False
+# Write implied cross rates, arbitrage gaps and spread z-scores of all the books every tick, see modules/cross_book.py
+CROSS_BOOK = False
+# Threads sampling the books, each one serves many books
+POOL_WORKERS = 32
 
 
 def round_down_minute(current_time):
@@ -33,44 +66,198 @@ def round_down_minute(current_time):
     return current_time.replace(minute=minutes, second=0, microsecond=0)
 
 
-def process_book(book, api_key, api_secret):
-    """Process data for a single book"""
-    current_interval = round_down_minute(datetime.now(timezone.utc))
-    next_interval = current_interval + timedelta(minutes=MINUTE_MULTIPLE)
-    filename = f"{book}_{current_interval.strftime('%Y-%m-%d-%H-%M-%S')}.csv"
+def open_interval(writers, current_interval, bar_writers):
+    """Open the files of a new interval for every book"""
+    for book, writer in writers.items():
+        filename = f"{book}_{current_interval.strftime('%Y-%m-%d-%H-%M-%S')}.csv"
+        writer.open(filename)
+        bar_writers[book].open(bars_filename(filename))
+
+
+def submit_closed(writers):
+    """Close the writers of an interval and queue their files for upload"""
+    for writer in writers:
+        closed_filename = writer.close()
+        if closed_filename:
+            upload_pipeline.submit(closed_filename)
+    if upload_pipeline.backpressure:
+        logger.warning(f"Uploads are falling behind: {upload_pipeline.stats}")
+
+
+class BookCollector:
+    """Samples a single book, one `step` per tick of its clock"""
 
-    while True:
+    def __init__(self, book, api_key, api_secret, snapshot=None):
+        self.book = book
+        self.name = book
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.snapshot = snapshot
+        self.current_interval = round_down_minute(datetime.now(timezone.utc))
+        self.next_interval = self.current_interval + timedelta(minutes=MINUTE_MULTIPLE)
+        filename = f"{book}_{self.current_interval.strftime('%Y-%m-%d-%H-%M-%S')}.csv"
+        self.writer = IntervalWriter(filename, dedup=DEDUP_MODE, buffer=BUFFER)
+        self.depth_writer = IntervalWriter(depth_filename(filename), buffer=BUFFER)
+        self.bar_writer = IntervalWriter(bars_filename(filename), buffer=BUFFER)
+        self.rate_writer = IntervalWriter(rates_filename(filename), buffer=BUFFER)
+        self.bars = BarAggregator(BAR_MINUTES)
+        self.capture_depth = book in DEPTH_BOOKS
+        self.clock = TickClock(book)
+        if ADAPTIVE_SAMPLING:
+            adaptive_sampler.attach(book, self.clock)
+
+    @property
+    def writers(self):
+        return [self.writer, self.depth_writer, self.bar_writer, self.rate_writer]
+
+    def step(self):
         now = datetime.now(timezone.utc)
-        data_tuple = make_request_and_process(api_key, api_secret, book)
+        result = make_request_and_process(self.api_key, self.api_secret, self.book, credential_pool,
+                                          depth=self.capture_depth)
+
+        if not result:
+            return
 
-        if not data_tuple:
-            time.sleep(1 - datetime.now(timezone.utc).microsecond / 1_000_000)
-            continue
+        data_tuple, depth_tuple = result if self.capture_depth else (result, None)
 
-        if now < next_interval:
-            save_to_csv_stream(data_tuple, filename)
-        else:
-            # Store the previous interval's data
-            store_data(filename)
-            logger.info(f"Data for {book} interval {current_interval} to {next_interval} stored.")
+        if now >= self.next_interval:
+            # Hand the previous interval's data to the upload pipeline
+            for bar in self.bars.expire(self.next_interval):
+                self.bar_writer.write(bar)
+            submit_closed(self.writers)
+            logger.info(f"Data for {self.book} interval {self.current_interval} to {self.next_interval} queued for upload.")
+            self.clock.report()
+            request_policy.report(self.book)
 
             # Update intervals and filename for the new interval
-            current_interval = round_down_minute(now)
-            next_interval = current_interval + timedelta(minutes=MINUTE_MULTIPLE)
-            filename = f"{book}_{current_interval.strftime('%Y-%m-%d-%H-%M-%S')}.csv"
+            self.current_interval = round_down_minute(now)
+            self.next_interval = self.current_interval + timedelta(minutes=MINUTE_MULTIPLE)
+            filename = f"{self.book}_{self.current_interval.strftime('%Y-%m-%d-%H-%M-%S')}.csv"
+            self.writer.open(filename)
+            self.depth_writer.open(depth_filename(filename))
+            self.bar_writer.open(bars_filename(filename))
+            self.rate_writer.open(rates_filename(filename))
+
+        self.writer.write(data_tuple)
+        for bar in self.bars.update(data_tuple):
+            self.bar_writer.write(bar)
+        if self.snapshot:
+            self.snapshot.update(data_tuple)
+        if ADAPTIVE_SAMPLING:
+            for row in adaptive_sampler.observe(data_tuple):
+                self.rate_writer.write(row)
+
+        if depth_tuple:
+            self.depth_writer.write(depth_tuple)
+
+    def close(self):
+        """Queue the open interval for upload"""
+        submit_closed(self.writers)
+
+
+class TickerCollector:
+    """Samples all the books from a single ticker request per tick"""
+
+    def __init__(self, ticker_books, api_key, api_secret, snapshot=None):
+        self.name = "ticker"
+        self.ticker_books = ticker_books
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.snapshot = snapshot
+        self.current_interval = round_down_minute(datetime.now(timezone.utc))
+        self.next_interval = self.current_interval + timedelta(minutes=MINUTE_MULTIPLE)
+        self.writers = {book: IntervalWriter(dedup=DEDUP_MODE, buffer=BUFFER) for book in ticker_books}
+        self.bar_writers = {book: IntervalWriter(buffer=BUFFER) for book in ticker_books}
+        open_interval(self.writers, self.current_interval, self.bar_writers)
+        self.bars = BarAggregator(BAR_MINUTES)
+        self.clock = TickClock("ticker")
+
+    def step(self):
+        now = datetime.now(timezone.utc)
+        data_tuples = fetch_tickers(self.api_key, self.api_secret, self.ticker_books, credential_pool)
+
+        if now >= self.next_interval:
+            # Hand the previous interval's data to the upload pipeline
+            for bar in self.bars.expire(self.next_interval):
+                self.bar_writers[bar[1]].write(bar)
+            self.close()
+            logger.info(f"Ticker data for interval {self.current_interval} to {self.next_interval} queued for upload.")
+            self.clock.report()
+            request_policy.report("ticker")
+
+            self.current_interval = round_down_minute(now)
+            self.next_interval = self.current_interval + timedelta(minutes=MINUTE_MULTIPLE)
+            open_interval(self.writers, self.current_interval, self.bar_writers)
+
+        for book, data_tuple in data_tuples.items():
+            self.writers[book].write(data_tuple)
+            for bar in self.bars.update(data_tuple):
+                self.bar_writers[book].write(bar)
+            if self.snapshot:
+                self.snapshot.update(data_tuple)
 
-            # Save the first data point of the new interval
-            save_to_csv_stream(data_tuple, filename)
+    def close(self):
+        """Queue the open interval for upload"""
+        submit_closed([*self.writers.values(), *self.bar_writers.values()])
 
-        time.sleep(1 - datetime.now(timezone.utc).microsecond / 1_000_000)
+
+class CrossCollector:
+    """Writes the cross-book metrics of the latest samples of all the books once per tick"""
+
+    def __init__(self, snapshot):
+        self.name = "cross"
+        self.snapshot = snapshot
+        self.current_interval = round_down_minute(datetime.now(timezone.utc))
+        self.next_interval = self.current_interval + timedelta(minutes=MINUTE_MULTIPLE)
+        self.writer = IntervalWriter(cross_filename(self.current_interval), buffer=BUFFER)
+        self.clock = TickClock("cross")
+
+    def step(self):
+        now = datetime.now(timezone.utc)
+
+        if now >= self.next_interval:
+            self.close()
+            logger.info(f"Cross-book data for interval {self.current_interval} to {self.next_interval} queued for upload.")
+            self.clock.report()
+
+            self.current_interval = round_down_minute(now)
+            self.next_interval = self.current_interval + timedelta(minutes=MINUTE_MULTIPLE)
+            self.writer.open(cross_filename(self.current_interval))
+
+        for row in self.snapshot.rows(now):
+            self.writer.write(row)
+
+    def close(self):
+        """Queue the open interval for upload"""
+        submit_closed([self.writer])
 
 
 def store_data(filename):
     """Store data either in GCS or locally"""
     if STORE_IN_GCS:
-        store_data_to_gcs(GCS_BUCKET_NAME, filename)
+        store_data_to_gcs(GCS_BUCKET_NAME, filename, OUTPUT_FORMAT)
     else:
-        store_data_locally(filename)
+        store_data_locally(filename, OUTPUT_FORMAT)
+
+
+def store_locally(filename):
+    """File sink "local" of SINKS"""
+    store_data_locally(filename, OUTPUT_FORMAT)
+
+
+def store_in_gcs(filename):
+    """File sink "gcs" of SINKS"""
+    store_data_to_gcs(GCS_BUCKET_NAME, filename, OUTPUT_FORMAT)
+
+
+# Uploads run in the background so interval rollovers never block sampling
+if SINKS:
+    # Every file sink gets its own upload pipeline, so a slow one never holds up the others
+    upload_pipeline = FanOutPipeline({
+        name: store for name, store in (("local", store_locally), ("gcs", store_in_gcs)) if name in SINKS
+    })
+else:
+    upload_pipeline = UploadPipeline(store_data)
 
 
 def main():
@@ -78,16 +265,47 @@ def main():
         logger.error("API credentials not found in environment variables")
         return
 
-    threads = []
-    for book in books:
-        thread = threading.Thread(target=process_book, args=(book, api_key, api_secret))
-        thread.start()
-        threads.append(thread)
+    for book, priority in BOOK_PRIORITIES.items():
+        credential_pool.set_priority(book, priority)
+    # The adaptive sampler hands out the budget of every key of the pool
+    adaptive_sampler.limiter = credential_pool
+    upload_pipeline.start()
+    start_row_sinks(SINKS)
+
+    snapshot = CrossBookSnapshot(books) if CROSS_BOOK else None
+    book_jobs = [book for book in books if not TICKER_MODE or book in DEPTH_BOOKS]
+    jobs = [BookCollector(book, api_key, api_secret, snapshot) for book in book_jobs]
+
+    ticker_books = [book for book in books if book not in book_jobs]
+    if ticker_books:
+        # The ticker request comes out of the budget the sampler hands to the depth books
+        adaptive_sampler.reserved = 1 / TICK_PERIOD
+        jobs.append(TickerCollector(ticker_books, api_key, api_secret, snapshot))
+
+    # Every book shares the same pool of threads, the timer wheel wakes them on their ticks
+    executor = WheelExecutor(POOL_WORKERS)
+    # Room for a first send and a hedge of every sampling thread
+    request_policy.hedge_workers = 2 * POOL_WORKERS
+    for job in jobs:
+        executor.add(job)
+    if snapshot:
+        jobs.append(CrossCollector(snapshot))
+        executor.add(jobs[-1], delay=SETTLE_DELAY)
+
+    if threading.current_thread() is threading.main_thread():
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda signum, frame: executor.stop())
+    logger.info(f"Sampling {len(books)} books on a pool of {POOL_WORKERS} threads")
 
-    # Wait for all threads to complete
-    for thread in threads:
-        thread.join()
+    # Returns once a signal stopped the executor and the running steps finished
+    executor.run()
+    logger.info("Shutting down, queueing the open intervals for upload")
+    for job in jobs:
+        job.close()
+    close_row_sinks(timeout=10)
+    upload_pipeline.close(timeout=60)
 
 
 if __name__ == "__main__":
+    start_metrics(dump_file=METRICS_DUMP_FILE)
     main()
@@ -0,0 +1,213 @@
+import os
+import glob
+import time
+import logging
+import asyncio
+import multiprocessing
+from multiprocessing.connection import wait
+from datetime import datetime, timezone
+import main_async
+from modules.rate_limiter import shared_budget
+from modules.adaptive import adaptive_sampler
+from modules.http_client import async_http_client
+from modules.utils import store_data_to_gcs, store_data_locally
+from modules.upload_pipeline import UploadPipeline, FanOutPipeline, RemoteUploader, stage_file, QUEUE_SIZE
+from modules.sinks import start_row_sinks, close_row_sinks
+from modules.metrics import start_metrics, METRICS_PORT
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+# Constants
+GCS_BUCKET_NAME = "bitsode"
+STORE_IN_GCS = True
+OUTPUT_FORMAT = "csv"  # One of modules.formats.OUTPUT_FORMATS, e.g. "parquet"
+METRICS_DUMP_FILE = None  # e.g. "metrics.prom" to also dump the metrics to a file every minute
+WORKERS = os.cpu_count() or 1
+RESTART_BASE = 1  # seconds before restarting a crashed worker, doubled on every crash in a row
+RESTART_CAP = 60  # seconds
+HEALTHY_AFTER = 300  # A worker up this long starts its restart backoff over
+# Sinks of the closed intervals and of every row, e.g. ["local", "gcs", "ndjson", "queue"], see modules/sinks.py
+# None stores the intervals in GCS or locally per STORE_IN_GCS. Every worker runs its own row sinks
+SINKS = None
+
+# Load API credentials from environment variables
+api_key = os.getenv("BITSO_API_KEY")
+api_secret = os.getenv("BITSO_API_SECRET")
+books = ["btc_mxn", "eth_mxn", "xrp_mxn", "ltc_mxn", "bch_mxn", "usd_mxn"]
+
+
+def shard_books(books, workers):
+    """Deal the books round-robin, so every worker gets a similar number"""
+    return [shard for shard in (books[i::workers] for i in range(workers)) if shard]
+
+
+def store_data(filename):
+    """Store data either in GCS or locally"""
+    if STORE_IN_GCS:
+        store_data_to_gcs(GCS_BUCKET_NAME, filename, OUTPUT_FORMAT)
+    else:
+        store_data_locally(filename, OUTPUT_FORMAT)
+
+
+def store_locally(filename):
+    """File sink "local" of SINKS"""
+    store_data_locally(filename, OUTPUT_FORMAT)
+
+
+def store_in_gcs(filename):
+    """File sink "gcs" of SINKS"""
+    store_data_to_gcs(GCS_BUCKET_NAME, filename, OUTPUT_FORMAT)
+
+
+async def collect_shard(shard, uploads, budget_share=1.0):
+    """Run the async collector of main_async for the books of one shard"""
+    for book, priority in main_async.BOOK_PRIORITIES.items():
+        main_async.credential_pool.set_priority(book, priority)
+    # The budget is shared by every worker, the adaptive sampler hands out this shard's part
+    adaptive_sampler.limiter = main_async.credential_pool
+    adaptive_sampler.budget_share *= budget_share
+
+    uploader = RemoteUploader(uploads)
+    async with async_http_client as session:
+        await asyncio.gather(*main_async.collectors(shard, api_key, api_secret, session, uploader))
+
+
+def run_worker(index, shard, budgets, uploads, budget_share=1.0):
+    '''
+    Entry point of a worker process
+
+    The parent serves its upload metrics on METRICS_PORT, worker `index`
+    serves the metrics of its shard on METRICS_PORT + 1 + index.
+
+    Args:
+    index (int): Shard number
+    shard (list): Books sampled by this worker
+    budgets (list): Request budget of each API key, shared by every worker
+    uploads (multiprocessing.Queue): Closed interval files for the upload pipeline
+    budget_share (float): Part of the budget for this shard's books, used by the adaptive sampler
+    '''
+    main_async.credential_pool.share(budgets)
+    start_metrics(METRICS_PORT + 1 + index, METRICS_DUMP_FILE and f"{METRICS_DUMP_FILE}.shard-{index}")
+    start_row_sinks(SINKS)
+    try:
+        asyncio.run(collect_shard(shard, uploads, budget_share))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close_row_sinks(timeout=10)
+
+
+def stage_orphans(shard):
+    """
+    Stage the interval files a crashed worker or a previous run left behind
+
+    Files of intervals that already ended are never closed by the new worker,
+    so they are moved to the pending directory for the rescan. The current
+    interval's file is kept, the new worker appends to it.
+    """
+    current_interval = main_async.round_down_minute(datetime.now(timezone.utc)).strftime('%Y-%m-%d-%H-%M-%S')
+    for book in shard:
+        for filename in glob.glob(f"{book}_*.csv"):
+            if filename[len(book) + 1:][:19] < current_interval:
+                logger.warning(f"Staging {filename} left by a previous worker")
+                stage_file(filename)
+
+
+class Supervisor:
+    """
+    Keeps one worker process per shard running.
+
+    A worker that exits is restarted on the same shard after an exponential
+    backoff, so a book that keeps crashing its worker cannot spin the host.
+    """
+
+    def __init__(self, shards, budgets, uploads):
+        self.shards = shards
+        self.budgets = budgets
+        self.uploads = uploads
+        self.processes = {}
+        self.started_at = {}
+        self.crashes = {}
+        self.restart_at = {}
+
+    def start(self, index):
+        stage_orphans(self.shards[index])
+        process = multiprocessing.Process(
+            target=run_worker,
+            args=(index, self.shards[index], self.budgets, self.uploads,
+                  len(self.shards[index]) / sum(map(len, self.shards))),
+            name=f"shard-{index}",
+            daemon=True
+        )
+        process.start()
+        self.processes[index] = process
+        self.started_at[index] = time.monotonic()
+        logger.info(f"Worker {process.name} (pid {process.pid}) started for {self.shards[index]}")
+
+    def run(self):
+        for index in range(len(self.shards)):
+            self.start(index)
+
+        while True:
+            now = time.monotonic()
+            timeout = min((at - now for at in self.restart_at.values()), default=None)
+            alive = {process.sentinel: index for index, process in self.processes.items()}
+            for sentinel in wait(list(alive), timeout=None if timeout is None else max(timeout, 0)):
+                self.on_exit(alive[sentinel])
+
+            now = time.monotonic()
+            for index, at in list(self.restart_at.items()):
+                if at <= now:
+                    del self.restart_at[index]
+                    self.start(index)
+
+    def on_exit(self, index):
+        process = self.processes.pop(index)
+        process.join()
+        if time.monotonic() - self.started_at[index] >= HEALTHY_AFTER:
+            self.crashes[index] = 0
+        self.crashes[index] = self.crashes.get(index, 0) + 1
+        delay = min(RESTART_CAP, RESTART_BASE * 2 ** (self.crashes[index] - 1))
+        logger.error(f"Worker {process.name} exited with code {process.exitcode}, restarting in {delay}s")
+        self.restart_at[index] = time.monotonic() + delay
+
+    def stop(self, timeout=5):
+        deadline = time.monotonic() + timeout
+        for process in self.processes.values():
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+
+def main(books=books, workers=WORKERS):
+    shards = shard_books(books, workers)
+    budgets = [shared_budget() for _ in main_async.credential_pool.credentials]
+    uploads = multiprocessing.Queue(QUEUE_SIZE)
+
+    start_metrics(METRICS_PORT, METRICS_DUMP_FILE)
+    # One pipeline in the parent uploads what every worker closes, one per file sink with SINKS
+    if SINKS:
+        upload_pipeline = FanOutPipeline({
+            name: store for name, store in (("local", store_locally), ("gcs", store_in_gcs)) if name in SINKS
+        }).start()
+    else:
+        upload_pipeline = UploadPipeline(store_data).start()
+    feeder = upload_pipeline.feed(uploads)
+
+    supervisor = Supervisor(shards, budgets, uploads)
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        logger.info("Stopping workers")
+    finally:
+        supervisor.stop()
+        uploads.put(None)
+        feeder.join()
+        upload_pipeline.close(timeout=60)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import os
+import logging
+import asyncio
+from datetime import datetime, timezone, timedelta
+from modules.http_client import async_http_client
+from modules.ws_stream import OrderBookStream, WS_URL
+from modules.utils_async import store_data_to_gcs_async, store_data_locally_async
+from modules.interval_writer import AsyncIntervalWriter
+from modules.bars import BarAggregator, bars_filename
+from modules.cross_book import CrossBookSnapshot, cross_filename
+from modules.upload_pipeline import AsyncUploadPipeline, AsyncFanOutPipeline
+from modules.sinks import start_row_sinks, close_row_sinks
+from modules.scheduler import TickClock
+from modules.metrics import start_metrics
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+# Constants
+GCS_BUCKET_NAME = "bitsode"
+BASE_URL = "https://stage.bitso.com/api/v3/order_book"
+STORE_IN_GCS = True
+MINUTE_MULTIPLE = 2
+OUTPUT_FORMAT = "csv"  # One of modules.formats.OUTPUT_FORMATS, e.g. "parquet"
+METRICS_DUMP_FILE = None  # e.g. "metrics.prom" to also dump the metrics to a file every minute
+
+# Load API credentials from environment variables
+api_key = os.getenv("BITSO_API_KEY")
+api_secret = os.getenv("BITSO_API_SECRET")
+books = ["btc_mxn", "ltc_mxn", "xrp_mxn"]
+# Bar sizes in minutes of the OHLC bars stored next to the interval files, e.g. (1, 5, MINUTE_MULTIPLE)
+BAR_MINUTES = ()
+# Drop unchanged top-of-book samples: None, "changes" or "rle", see modules/interval_writer.py
+DEDUP_MODE = None
+# Build intervals in memory and stream them to storage: None, "memory" or "gzip", see modules/interval_writer.py
+BUFFER = None
+# Sinks of the closed intervals and of every row, e.g. ["local", "gcs", "ndjson", "queue"], see modules/sinks.py
+# None stores the intervals in GCS or locally per STORE_IN_GCS
+SINKS = None
+# Write implied cross rates, arbitrage gaps and spread z-scores of all the books every tick, see modules/cross_book.py
+CROSS_BOOK = False
+
+
+def round_down_minute(current_time):
+    """Round down the current time to the nearest multiple of MINUTE_MULTIPLE"""
+    minutes = (current_time.minute // MINUTE_MULTIPLE) * MINUTE_MULTIPLE
+    return current_time.replace(minute=minutes, second=0, microsecond=0)
+
+
+def open_interval(writers, current_interval, bar_writers):
+    """Open the files of a new interval for every book"""
+    for book, writer in writers.items():
+        filename = f"{book}_{current_interval.strftime('%Y-%m-%d-%H-%M-%S')}.csv"
+        writer.open(filename)
+        bar_writers[book].open(bars_filename(filename))
+
+
+async def store_data(filename):
+    """Store data either in GCS or locally"""
+    if STORE_IN_GCS:
+        await store_data_to_gcs_async(GCS_BUCKET_NAME, filename, OUTPUT_FORMAT)
+    else:
+        await store_data_locally_async(filename, OUTPUT_FORMAT)
+
+
+async def store_locally(filename):
+    """File sink "local" of SINKS"""
+    await store_data_locally_async(filename, OUTPUT_FORMAT)
+
+
+async def store_in_gcs(filename):
+    """File sink "gcs" of SINKS"""
+    await store_data_to_gcs_async(GCS_BUCKET_NAME, filename, OUTPUT_FORMAT)
+
+
+# Uploads run in the background so interval rollovers never block sampling
+if SINKS:
+    # Every file sink gets its own upload pipeline, so a slow one never holds up the others
+    upload_pipeline = AsyncFanOutPipeline({
+        name: store for name, store in (("local", store_locally), ("gcs", store_in_gcs)) if name in SINKS
+    })
+else:
+    upload_pipeline = AsyncUploadPipeline(store_data)
+
+
+async def submit_closed(writers):
+    """Close the writers of an interval and queue their files for upload"""
+    for writer in writers:
+        filename = await writer.close()
+        if filename:
+            await upload_pipeline.submit(filename)
+    if upload_pipeline.backpressure:
+        logger.warning(f"Uploads are falling behind: {upload_pipeline.stats}")
+
+
+async def main(ws_url=WS_URL, snapshot_url=BASE_URL):
+    """Sample the streamed order books once per second into the interval files"""
+    stream = OrderBookStream(books, api_key, api_secret, ws_url, snapshot_url)
+    current_interval = round_down_minute(datetime.now(timezone.utc))
+    next_interval = current_interval + timedelta(minutes=MINUTE_MULTIPLE)
+    writers = {book: AsyncIntervalWriter(dedup=DEDUP_MODE, buffer=BUFFER) for book in books}
+    bar_writers = {book: AsyncIntervalWriter(buffer=BUFFER) for book in books}
+    bars = BarAggregator(BAR_MINUTES)
+    open_interval(writers, current_interval, bar_writers)
+    cross_snapshot = CrossBookSnapshot(books)
+    cross_writer = AsyncIntervalWriter(cross_filename(current_interval), buffer=BUFFER)
+    clock = TickClock("stream sampler")
+    await upload_pipeline.start()
+    start_row_sinks(SINKS)
+
+    async with async_http_client as session:
+        stream_task = asyncio.create_task(stream.run(session))
+        try:
+            while True:
+                await clock.wait_async()
+                now = datetime.now(timezone.utc)
+
+                if stream_task.done():
+                    # The books wait for a resync until the restarted stream reconnects
+                    logger.error(f"Order book stream stopped, restarting it: {stream_task.exception()!r}")
+                    stream_task = asyncio.create_task(stream.run(session))
+
+                if now >= next_interval:
+                    for bar in bars.expire(next_interval):
+                        await bar_writers[bar[1]].write(bar)
+                    await submit_closed([*writers.values(), *bar_writers.values(), cross_writer])
+                    logger.info(f"Data for interval {current_interval} to {next_interval} queued for upload.")
+                    logger.info(f"Stream stats: {stream.stats}")
+                    clock.report()
+                    current_interval = round_down_minute(now)
+                    next_interval = current_interval + timedelta(minutes=MINUTE_MULTIPLE)
+                    open_interval(writers, current_interval, bar_writers)
+                    cross_writer.open(cross_filename(current_interval))
+
+                for book in books:
+                    data_tuple = stream.top_of_book_tuple(book)
+                    if data_tuple:
+                        await writers[book].write(data_tuple)
+                        for bar in bars.update(data_tuple):
+                            await bar_writers[book].write(bar)
+                        cross_snapshot.update(data_tuple)
+                    else:
+                        logger.warning(f"Order book {book} not synced, skipping tick")
+
+                if CROSS_BOOK:
+                    for row in cross_snapshot.rows(now):
+                        await cross_writer.write(row)
+        finally:
+            stream_task.cancel()
+            await asyncio.to_thread(close_row_sinks, 10)
+            await upload_pipeline.close(timeout=60)
+
+
+if __name__ == "__main__":
+    start_metrics(dump_file=METRICS_DUMP_FILE)
+    asyncio.run(main())
@@ -0,0 +1,225 @@
+"""
+Local stand-in for Bitso's order_book and ticker REST endpoints.
+
+Serves synthetic order books whose mid price random-walks between requests,
+with configurable latency, jitter, error rate, depth and rate limiting, so the
+collectors can be benchmarked and tested without the network. Rate limiting
+follows Bitso: a budget of requests per minute per API key, X-RateLimit-*
+headers on every response and a 429 with Retry-After once it runs out.
+
+    python -m mocks.bitso_server --port 8080 --latency 50 --jitter 20 --error-rate 0.01
+
+Point the collectors at it by setting BASE_URL and TICKER_URL in
+modules/api_request.py and modules/api_request_async.py to
+http://localhost:8080/api/v3/order_book and http://localhost:8080/api/v3/ticker.
+"""
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import threading
+from aiohttp import web
+
+DEFAULT_BOOKS = ["btc_mxn", "eth_mxn", "xrp_mxn", "ltc_mxn", "bch_mxn", "usd_mxn"]
+TICK_SIZE = 0.01
+
+
+class MockBitso:
+    """
+    Order book server with injected latency, errors and rate limiting.
+
+    Args:
+    latency (float): Base response time in seconds
+    jitter (float): Mean of an exponentially distributed extra delay, in seconds
+    error_rate (float): Share of requests answered with a 503
+    depth (int): Price levels returned on each side
+    requests_per_minute (int): Budget per API key, None disables rate limiting
+    seed (int): Seed of the price walks and the injected delays and errors
+    books (list): Books listed by the ticker and available_books endpoints
+    rejected_keys (set): API keys answered with a 401, to exercise the credential pool
+    """
+
+    def __init__(self, latency=0.05, jitter=0.02, error_rate=0.0, depth=50, requests_per_minute=None, seed=None,
+                 books=DEFAULT_BOOKS, rejected_keys=()):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.depth = depth
+        self.requests_per_minute = requests_per_minute
+        self.rng = random.Random(seed)
+        self.books = list(books)
+        self.rejected_keys = set(rejected_keys)
+        self.mids = {}
+        self.windows = {}  # API key -> (window start, requests in the window)
+        self.stats = {"requests": 0, "ok": 0, "errors": 0, "rate_limited": 0, "rejected": 0, "books": {}, "keys": {}}
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/api/v3/order_book", self.order_book)
+        app.router.add_get("/api/v3/ticker", self.ticker)
+        app.router.add_get("/api/v3/available_books", self.available_books)
+        return app
+
+    def _rate_limit(self, key):
+        """Fixed one-minute windows per key, return the headers and whether the request is allowed"""
+        if self.requests_per_minute is None:
+            return {}, True
+        now = time.time()
+        started_at, count = self.windows.get(key, (now, 0))
+        if now - started_at >= 60:
+            started_at, count = now, 0
+        allowed = count < self.requests_per_minute
+        if allowed:
+            count += 1
+        self.windows[key] = (started_at, count)
+        reset = started_at + 60
+        headers = {
+            "X-RateLimit-Limit": str(self.requests_per_minute),
+            "X-RateLimit-Remaining": str(self.requests_per_minute - count),
+            "X-RateLimit-Reset": str(int(reset)),
+        }
+        if not allowed:
+            headers["Retry-After"] = str(max(int(reset - now) + 1, 1))
+        return headers, allowed
+
+    def _next_mid(self, book):
+        """Move the mid price of `book` a few ticks, return it with the price gap between levels"""
+        mid = self.mids.get(book) or self.rng.uniform(10, 1_000_000)
+        step = max(round(mid / 10_000, 2), TICK_SIZE)
+        mid = max(mid + self.rng.gauss(0, 2) * step, step * self.depth)
+        self.mids[book] = mid
+        return mid, step
+
+    def book_payload(self, book):
+        """Next order book of `book`"""
+        mid, step = self._next_mid(book)
+
+        def side(sign):
+            return [
+                {"book": book, "price": f"{mid + sign * (i + 0.5) * step:.2f}",
+                 "amount": f"{self.rng.uniform(0.0001, 2):.8f}"}
+                for i in range(self.depth)
+            ]
+
+        return {
+            "success": True,
+            "payload": {
+                "asks": side(1),
+                "bids": side(-1),
+                "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime()),
+                "sequence": str(int(time.time() * 1000)),
+            },
+        }
+
+    def ticker_payload(self, book):
+        """Ticker of `book`, quoting the next top of book"""
+        mid, step = self._next_mid(book)
+        return {
+            "book": book,
+            "bid": f"{mid - step / 2:.2f}",
+            "ask": f"{mid + step / 2:.2f}",
+            "last": f"{mid:.2f}",
+            "volume": f"{self.rng.uniform(1, 1000):.8f}",
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime()),
+        }
+
+    async def _serve(self, request, key, build):
+        """Apply the rate limit, latency and errors, then answer with `build()`"""
+        self.stats["requests"] += 1
+        self.stats["books"][key] = self.stats["books"].get(key, 0) + 1
+
+        api_key = request.headers.get("Authorization", "").split(":")[0] or request.remote
+        self.stats["keys"][api_key] = self.stats["keys"].get(api_key, 0) + 1
+        if api_key.removeprefix("Bitso ") in self.rejected_keys:
+            self.stats["rejected"] += 1
+            body = {"success": False, "error": {"code": "0201", "message": "Invalid credentials"}}
+            return web.json_response(body, status=401)
+
+        headers, allowed = self._rate_limit(api_key)
+        if not allowed:
+            self.stats["rate_limited"] += 1
+            body = {"success": False, "error": {"code": "0201", "message": "Too many requests"}}
+            return web.json_response(body, status=429, headers=headers)
+
+        delay = self.latency + (self.rng.expovariate(1 / self.jitter) if self.jitter else 0)
+        await asyncio.sleep(delay)
+
+        if self.rng.random() < self.error_rate:
+            self.stats["errors"] += 1
+            return web.json_response({"success": False}, status=503, headers=headers)
+
+        self.stats["ok"] += 1
+        body = json.dumps(build(), separators=(",", ":"))
+        return web.Response(text=body, content_type="application/json", headers=headers)
+
+    async def order_book(self, request):
+        book = request.query.get("book", "btc_mxn")
+        return await self._serve(request, book, lambda: self.book_payload(book))
+
+    async def ticker(self, request):
+        book = request.query.get("book")
+        if book:
+            return await self._serve(request, book, lambda: {"success": True, "payload": self.ticker_payload(book)})
+        return await self._serve(request, "ticker", lambda: {
+            "success": True, "payload": [self.ticker_payload(book) for book in self.books]
+        })
+
+    async def available_books(self, request):
+        payload = [{"book": book, "minimum_amount": "0.00001", "maximum_amount": "100000"}
+                   for book in sorted(set(self.books) | set(self.mids))]
+        return web.json_response({"success": True, "payload": payload})
+
+
+def start_mock_server(host="localhost", port=0, **options):
+    '''
+    Serve a MockBitso from a background thread with its own event loop
+
+    Args:
+    host (str): Interface to listen on
+    port (int): Port to listen on, 0 picks a free one
+    options: Keyword arguments of MockBitso
+
+    Returns:
+    tuple: The MockBitso instance and the base URL of its order_book endpoint
+    '''
+    server = MockBitso(**options)
+    ready = threading.Event()
+    address = {}
+
+    async def serve():
+        runner = web.AppRunner(server.app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        address["port"] = runner.addresses[0][1]
+        ready.set()
+        await asyncio.Event().wait()
+
+    threading.Thread(target=asyncio.run, args=(serve(),), name="mock-bitso", daemon=True).start()
+    ready.wait()
+    return server, f"http://{host}:{address['port']}/api/v3/order_book"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=50, help="base response time in ms")
+    parser.add_argument("--jitter", type=float, default=20, help="mean extra delay in ms, exponentially distributed")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with a 503")
+    parser.add_argument("--depth", type=int, default=50, help="price levels per side")
+    parser.add_argument("--requests-per-minute", type=int, default=60, help="budget per API key, 0 disables it")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    server = MockBitso(args.latency / 1000, args.jitter / 1000, args.error_rate, args.depth,
+                       args.requests_per_minute or None, args.seed)
+    logging.info(f"Mock Bitso listening on http://{args.host}:{args.port}/api/v3/order_book")
+    web.run_app(server.app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
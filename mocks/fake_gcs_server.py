@@ -0,0 +1,262 @@
+"""
+Local stand-in for the parts of the GCS JSON API the collectors use.
+
+Objects are kept in memory. Supports multipart and resumable uploads,
+listing by prefix, metadata, downloads (with Range requests, and decompressive
+transcoding of gzip encoded objects) and deletes, and can fail a share of the uploads to exercise the retries. Point
+google-cloud-storage at it with the STORAGE_EMULATOR_HOST environment
+variable:
+
+    python -m mocks.fake_gcs_server --port 4443 --fail-rate 0.2
+    STORAGE_EMULATOR_HOST=http://localhost:4443 python3 main.py
+"""
+import re
+import gzip
+import json
+import time
+import base64
+import random
+import hashlib
+import logging
+import argparse
+import threading
+from email.parser import BytesParser
+from urllib.parse import urlparse, parse_qs, unquote, quote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+try:
+    import google_crc32c
+except ImportError:
+    google_crc32c = None
+
+
+def _crc32c(data):
+    if google_crc32c is not None:
+        return google_crc32c.value(data)
+    crc = 0xFFFFFFFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ (0x82F63B78 & -(crc & 1))
+    return crc ^ 0xFFFFFFFF
+
+
+def _b64(raw):
+    return base64.b64encode(raw).decode()
+
+
+class FakeGCS:
+    """In-memory buckets shared by the request handlers"""
+
+    def __init__(self, fail_rate=0.0):
+        self.fail_rate = fail_rate
+        self.objects = {}  # (bucket, name) -> (data, resource)
+        self.uploads = {}  # upload id -> (bucket, name, bytearray)
+        self.lock = threading.Lock()
+        self.generation = int(time.time() * 1e6)
+
+    def put(self, bucket, name, data, content_type="application/octet-stream", content_encoding=None):
+        with self.lock:
+            self.generation += 1
+            resource = {
+                "kind": "storage#object",
+                "id": f"{bucket}/{name}/{self.generation}",
+                "bucket": bucket,
+                "name": name,
+                "generation": str(self.generation),
+                "metageneration": "1",
+                "contentType": content_type,
+                "size": str(len(data)),
+                "md5Hash": _b64(hashlib.md5(data).digest()),
+                "crc32c": _b64(_crc32c(data).to_bytes(4, "big")),
+                "timeCreated": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+                "updated": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+            }
+            if content_encoding:
+                resource["contentEncoding"] = content_encoding
+            self.objects[(bucket, name)] = (bytes(data), resource)
+        return resource
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    gcs = None  # Set by make_server
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def _send(self, status, body=b"", headers=None, content_type="application/json"):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _error(self, status, message):
+        self._send(status, {"error": {"code": status, "message": message}})
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _route(self):
+        url = urlparse(self.path)
+        return url.path, {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+    def do_POST(self):
+        path, query = self._route()
+        match = re.fullmatch(r"/upload/storage/v1/b/([^/]+)/o", path)
+        if not match:
+            return self._error(404, f"Unknown endpoint {path}")
+        bucket = match.group(1)
+        body = self._body()
+
+        if self.gcs.fail_rate and random.random() < self.gcs.fail_rate:
+            return self._error(503, "Injected failure")
+
+        upload_type = query.get("uploadType")
+        if upload_type == "multipart":
+            message = BytesParser().parsebytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body
+            )
+            metadata_part, media_part = message.get_payload()
+            metadata = json.loads(metadata_part.get_payload(decode=True))
+            data = media_part.get_payload(decode=True)
+            resource = self.gcs.put(bucket, metadata["name"], data, media_part.get_content_type(),
+                                    metadata.get("contentEncoding"))
+            return self._send(200, resource)
+
+        if upload_type == "resumable":
+            metadata = json.loads(body) if body else {}
+            name = query.get("name") or metadata.get("name")
+            upload_id = f"{time.time_ns()}{random.randrange(1 << 30)}"
+            with self.gcs.lock:
+                self.gcs.uploads[upload_id] = (bucket, name, bytearray(), metadata)
+            host = self.headers.get("Host")
+            location = f"http://{host}/upload/storage/v1/b/{bucket}/o?uploadType=resumable&upload_id={upload_id}"
+            return self._send(200, {}, {"Location": location})
+
+        if upload_type == "media":
+            resource = self.gcs.put(bucket, query["name"], body, self.headers.get("Content-Type"))
+            return self._send(200, resource)
+
+        self._error(400, f"Unsupported uploadType {upload_type}")
+
+    def do_PUT(self):
+        path, query = self._route()
+        upload = self.gcs.uploads.get(query.get("upload_id"))
+        if upload is None:
+            return self._error(404, "Unknown upload")
+        bucket, name, buffer, metadata = upload
+        buffer.extend(self._body())
+
+        # Content-Range is "bytes start-end/total", "bytes */total" or with "*" for an unknown total
+        total = (self.headers.get("Content-Range") or "").rpartition("/")[2]
+        if total != "*" and total and len(buffer) >= int(total):
+            with self.gcs.lock:
+                del self.gcs.uploads[query["upload_id"]]
+            return self._send(200, self.gcs.put(bucket, name, buffer, metadata.get("contentType", "application/octet-stream"),
+                                                metadata.get("contentEncoding")))
+        headers = {"Range": f"bytes=0-{len(buffer) - 1}"} if buffer else {}
+        self._send(308, b"", headers)
+
+    def do_GET(self):
+        path, query = self._route()
+
+        match = re.fullmatch(r"/storage/v1/b/([^/]+)/o", path)
+        if match:
+            bucket, prefix = match.group(1), query.get("prefix", "")
+            with self.gcs.lock:
+                items = [resource for (b, name), (_, resource) in sorted(self.gcs.objects.items())
+                         if b == bucket and name.startswith(prefix)]
+            return self._send(200, {"kind": "storage#objects", "items": items})
+
+        match = re.fullmatch(r"/storage/v1/b/([^/]+)", path)
+        if match:
+            return self._send(200, {"kind": "storage#bucket", "name": match.group(1), "id": match.group(1)})
+
+        match = re.fullmatch(r"(/download)?/storage/v1/b/([^/]+)/o/(.+)", path)
+        if not match:
+            return self._error(404, f"Unknown endpoint {path}")
+        stored = self.gcs.objects.get((match.group(2), unquote(match.group(3))))
+        if stored is None:
+            return self._error(404, "No such object")
+        data, resource = stored
+
+        if query.get("alt") != "media":
+            return self._send(200, resource)
+
+        headers = {"X-Goog-Hash": f"crc32c={resource['crc32c']},md5={resource['md5Hash']}",
+                   "X-Goog-Generation": resource["generation"]}
+        if resource.get("contentEncoding") == "gzip":
+            # Like GCS, served as stored to clients accepting gzip, decompressed for the others
+            if "gzip" in (self.headers.get("Accept-Encoding") or ""):
+                headers["Content-Encoding"] = "gzip"
+            else:
+                data = gzip.decompress(data)
+                headers = {"X-Goog-Generation": resource["generation"]}
+        byte_range = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range") or "")
+        if byte_range:
+            start = int(byte_range.group(1))
+            end = int(byte_range.group(2)) if byte_range.group(2) else len(data) - 1
+            end = min(end, len(data) - 1)
+            headers = {"Content-Range": f"bytes {start}-{end}/{len(data)}"}
+            return self._send(206, data[start:end + 1], headers, "application/octet-stream")
+        self._send(200, data, headers, resource["contentType"])
+
+    def do_DELETE(self):
+        path, _ = self._route()
+        match = re.fullmatch(r"/storage/v1/b/([^/]+)/o/(.+)", path)
+        key = match and (match.group(1), unquote(match.group(2)))
+        with self.gcs.lock:
+            if not key or self.gcs.objects.pop(key, None) is None:
+                return self._error(404, "No such object")
+        self._send(204)
+
+
+def make_server(host="localhost", port=4443, fail_rate=0.0):
+    '''
+    Create the fake GCS server, run it with `serve_forever()`
+
+    Returns:
+    ThreadingHTTPServer: Server whose `gcs` attribute holds the stored objects
+    '''
+    gcs = FakeGCS(fail_rate)
+    handler = type("FakeGCSHandler", (Handler,), {"gcs": gcs})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.gcs = gcs
+    return server
+
+
+def start_fake_gcs(host="localhost", port=4443, fail_rate=0.0):
+    """Serve a fake GCS from a daemon thread and return the server"""
+    server = make_server(host, port, fail_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Fake GCS listening on http://{host}:{server.server_port}")
+    return server
+
+
+def object_url(host, port, bucket, name):
+    return f"http://{host}:{port}/storage/v1/b/{bucket}/o/{quote(name, safe='')}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=4443)
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="share of uploads answered with a 503")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    server = make_server(args.host, args.port, args.fail_rate)
+    logging.info(f"Fake GCS listening on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Local stand-in for a message queue the row sinks publish to.
+
+Topics are append-only logs kept in memory. Producers POST batches of NDJSON
+messages to /topics/<topic>, consumers poll GET /topics/<topic>?offset=N,
+which returns the messages from offset N on as NDJSON with the next offset
+in the X-Next-Offset header. Delays and failures can be injected to see a
+slow or broken sink being isolated from the collectors:
+
+    python -m mocks.message_queue --port 8766 --delay 0.5
+    curl "http://localhost:8766/topics/bitso?offset=0"
+"""
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+MAX_POLL = 10000  # Messages returned by one poll
+
+
+class MessageQueue:
+    """In-memory topics shared by the request handlers"""
+
+    def __init__(self, delay=0.0, fail_rate=0.0):
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.topics = {}  # topic -> list of messages
+        self.stats = {"batches": 0, "messages": 0, "failed": 0}
+        self.lock = threading.Lock()
+
+    def publish(self, topic, messages):
+        with self.lock:
+            log = self.topics.setdefault(topic, [])
+            log.extend(messages)
+            self.stats["batches"] += 1
+            self.stats["messages"] += len(messages)
+            return len(log)
+
+    def poll(self, topic, offset, limit=MAX_POLL):
+        with self.lock:
+            messages = self.topics.get(topic, [])[offset:offset + limit]
+        return messages, offset + len(messages)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    queue = None  # Set by make_server
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def _send(self, status, body=b"", headers=None, content_type="application/json"):
+        if isinstance(body, dict):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _topic(self):
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        if len(parts) != 2 or parts[0] != "topics":
+            return None, {}
+        return parts[1], {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+    def do_POST(self):
+        topic, _ = self._topic()
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if topic is None:
+            return self._send(404, {"error": "unknown path"})
+        if self.queue.delay:
+            time.sleep(self.queue.delay)
+        if random.random() < self.queue.fail_rate:
+            self.queue.stats["failed"] += 1
+            return self._send(503, {"error": "injected failure"})
+        messages = [line for line in body.decode().splitlines() if line]
+        self._send(200, {"offset": self.queue.publish(topic, messages)})
+
+    def do_GET(self):
+        topic, query = self._topic()
+        if topic is None:
+            return self._send(404, {"error": "unknown path"})
+        messages, next_offset = self.queue.poll(topic, int(query.get("offset", 0)),
+                                                min(int(query.get("limit", MAX_POLL)), MAX_POLL))
+        body = "".join(f"{message}\n" for message in messages).encode()
+        self._send(200, body, {"X-Next-Offset": str(next_offset)}, "application/x-ndjson")
+
+
+def make_server(host="localhost", port=8766, delay=0.0, fail_rate=0.0):
+    '''
+    Create the message queue server, run it with `serve_forever()`
+
+    Returns:
+    ThreadingHTTPServer: Server whose `queue` attribute holds the topics
+    '''
+    queue = MessageQueue(delay, fail_rate)
+    handler = type("MessageQueueHandler", (Handler,), {"queue": queue})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.queue = queue
+    return server
+
+
+def start_message_queue(host="localhost", port=8766, delay=0.0, fail_rate=0.0):
+    """Serve a message queue from a daemon thread and return the server"""
+    server = make_server(host, port, delay, fail_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Message queue listening on http://{host}:{server.server_port}")
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds every publish takes")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="share of publishes answered with a 503")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    server = make_server(args.host, args.port, args.delay, args.fail_rate)
+    logging.info(f"Message queue listening on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+Local stand-in for Bitso's websocket and order_book endpoints.
+
+Replays a recording to every websocket client that subscribes to diff-orders,
+keeping the original spacing between messages (scaled by --speed), and serves
+the recorded REST snapshots on /api/v3/order_book for the resyncs. The
+recording is a JSONL file where each line is either
+{"t": seconds, "message": <websocket message>} or
+{"t": seconds, "book": book, "snapshot": <order_book response>}.
+
+    python -m mocks.ws_replay_server recording.jsonl --port 8765
+    python -m mocks.ws_replay_server recording.jsonl --record btc_mxn xrp_mxn --duration 120
+
+Point the stream collector at it with
+OrderBookStream(books, key, secret, ws_url="ws://localhost:8765/",
+snapshot_url="http://localhost:8765/api/v3/order_book").
+"""
+import json
+import time
+import asyncio
+import logging
+import argparse
+import aiohttp
+from aiohttp import web
+
+BITSO_WS_URL = "wss://ws.bitso.com"
+BITSO_ORDER_BOOK_URL = "https://stage.bitso.com/api/v3/order_book"
+SNAPSHOT_EVERY = 30  # seconds between snapshots while recording
+
+
+def load_recording(path):
+    messages, snapshots = [], {}
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if "message" in entry:
+                messages.append((entry["t"], entry["message"]))
+            else:
+                snapshots.setdefault(entry["book"], []).append((entry["t"], entry["snapshot"]))
+    return messages, snapshots
+
+
+class ReplayServer:
+    def __init__(self, path, speed=1.0):
+        self.messages, self.snapshots = load_recording(path)
+        self.speed = speed
+        self.started_at = None
+
+    def elapsed(self):
+        """Recording time reached by the replay"""
+        if self.started_at is None:
+            return 0
+        return (time.monotonic() - self.started_at) * self.speed
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/", self.websocket)
+        app.router.add_get("/api/v3/order_book", self.order_book)
+        return app
+
+    async def websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        books = set()
+        replay = None
+
+        async for msg in ws:
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                continue
+            subscription = json.loads(msg.data)
+            if subscription.get("action") != "subscribe":
+                continue
+            books.add(subscription.get("book"))
+            await ws.send_json({"action": "subscribe", "response": "ok", "time": int(time.time() * 1000),
+                                "type": subscription.get("type")})
+            if replay is None:
+                replay = asyncio.create_task(self.replay(ws, books))
+
+        if replay is not None:
+            replay.cancel()
+        return ws
+
+    async def replay(self, ws, books):
+        if self.started_at is None:
+            self.started_at = time.monotonic()
+        for t, message in self.messages:
+            delay = (t - self.elapsed()) / self.speed
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if message.get("book") in books:
+                await ws.send_json(message)
+        logging.info("Replay finished")
+
+    async def order_book(self, request):
+        candidates = self.snapshots.get(request.query.get("book"))
+        if not candidates:
+            return web.json_response({"success": False, "error": {"message": "no snapshot recorded"}}, status=404)
+
+        # Latest snapshot taken before the current replay time, or the first one
+        elapsed = self.elapsed()
+        reached = [snapshot for t, snapshot in candidates if t <= elapsed]
+        return web.json_response(reached[-1] if reached else candidates[0][1])
+
+
+async def start_replay_server(path, host="localhost", port=8765, speed=1.0):
+    '''
+    Start the replay server in the running event loop
+
+    Returns:
+    web.AppRunner: Runner to clean up with `await runner.cleanup()`
+    '''
+    runner = web.AppRunner(ReplayServer(path, speed).app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Replaying {path} on ws://{host}:{port}/")
+    return runner
+
+
+async def record(path, books, duration):
+    """Record live diff-orders messages and periodic snapshots of the books"""
+    started_at = time.monotonic()
+    last_snapshot = -SNAPSHOT_EVERY
+
+    async with aiohttp.ClientSession() as session, session.ws_connect(BITSO_WS_URL) as ws:
+        for book in books:
+            await ws.send_json({"action": "subscribe", "book": book, "type": "diff-orders"})
+
+        with open(path, "w") as f:
+            while (elapsed := time.monotonic() - started_at) < duration:
+                if elapsed - last_snapshot >= SNAPSHOT_EVERY:
+                    last_snapshot = elapsed
+                    for book in books:
+                        params = {"book": book, "aggregate": "false"}
+                        async with session.get(BITSO_ORDER_BOOK_URL, params=params) as response:
+                            snapshot = await response.json()
+                        f.write(json.dumps({"t": round(elapsed, 3), "book": book, "snapshot": snapshot}) + "\n")
+
+                try:
+                    msg = await ws.receive(timeout=1)
+                except asyncio.TimeoutError:
+                    continue
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    f.write(json.dumps({"t": round(elapsed, 3), "message": json.loads(msg.data)}) + "\n")
+
+    logging.info(f"Recorded {duration}s of {books} to {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recording")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed multiplier")
+    parser.add_argument("--record", nargs="+", metavar="BOOK", help="record live messages instead of replaying")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to record")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    if args.record:
+        asyncio.run(record(args.recording, args.record, args.duration))
+    else:
+        web.run_app(ReplayServer(args.recording, args.speed).app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
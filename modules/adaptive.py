@@ -0,0 +1,210 @@
+import os
+import math
+import time
+import logging
+import threading
+from datetime import datetime, timezone
+from modules.formats import STREAM_COLUMNS, TIMESTAMP_FORMAT
+from modules.rate_limiter import rate_limiter
+from modules.scheduler import TICK_PERIOD
+
+# Sampling rates in requests per second
+MIN_RATE = 0.2  # Floor, a quiet book is still sampled every 5 seconds
+MAX_RATE = 1 / TICK_PERIOD  # Ceiling, timestamps have one-second resolution, faster samples of a book would collide
+BUDGET_SHARE = 0.9  # Share of the rate limiter's budget handed out, the rest absorbs retries and hedges
+REBALANCE_INTERVAL = 10  # seconds between reassignments of the budget
+HALF_LIFE = 120  # seconds, half-life of the volatility estimates
+
+RATE_COLUMNS = ["timestamp", "book", "target_rate", "effective_rate", "mid_volatility", "spread_volatility"]
+STREAM_COLUMNS["rates"] = RATE_COLUMNS
+
+
+def rates_filename(filename):
+    """Name of the sampling rates file stored next to an interval file"""
+    return f"{os.path.splitext(filename)[0]}.rates.csv"
+
+
+def allocate(scores, budget, floors, ceilings):
+    '''
+    Split a request budget between books in proportion to their scores
+
+    Every book gets at least its floor and at most its ceiling, what a capped
+    book cannot take is spread over the others (water filling). When the
+    floors alone exceed the budget they are scaled down to fit it.
+
+    Args:
+    scores (dict): Non-negative weight per book
+    budget (float): Requests per second to hand out
+    floors (dict): Minimum rate per book
+    ceilings (dict): Maximum rate per book
+
+    Returns:
+    dict: Rate per book in requests per second
+    '''
+    total_floor = sum(floors[book] for book in scores)
+    if total_floor >= budget:
+        return {book: budget * floors[book] / total_floor for book in scores}
+
+    rates = {book: floors[book] for book in scores}
+    left = budget - total_floor
+    active = {book for book in scores if rates[book] < ceilings[book]}
+    while left > 1e-9 and active:
+        weights = {book: scores[book] for book in active}
+        total = sum(weights.values())
+        if total <= 0:
+            weights = {book: 1.0 for book in active}
+            total = len(active)
+        given = 0.0
+        for book, weight in weights.items():
+            extra = min(left * weight / total, ceilings[book] - rates[book])
+            rates[book] += extra
+            given += extra
+            if rates[book] >= ceilings[book] - 1e-12:
+                active.discard(book)
+        left -= given
+        if given <= 1e-12:
+            break
+    return rates
+
+
+class BookVolatility:
+    """Exponentially weighted variance per second of the log mid price and of the relative spread"""
+
+    __slots__ = ("mid", "spread", "seen_at", "mid_variance", "spread_variance", "samples")
+
+    def __init__(self):
+        self.mid = None
+        self.spread = None
+        self.seen_at = None
+        self.mid_variance = 0.0
+        self.spread_variance = 0.0
+        self.samples = 0
+
+    def update(self, bid, ask, now, half_life=HALF_LIFE):
+        mid = (bid + ask) / 2
+        spread = (ask - bid) / mid
+        if self.mid is not None and now > self.seen_at and mid > 0 and self.mid > 0:
+            elapsed = now - self.seen_at
+            weight = 1 - 0.5 ** (elapsed / half_life)
+            mid_return = math.log(mid / self.mid)
+            self.mid_variance += weight * (mid_return ** 2 / elapsed - self.mid_variance)
+            self.spread_variance += weight * ((spread - self.spread) ** 2 / elapsed - self.spread_variance)
+        self.mid, self.spread, self.seen_at = mid, spread, now
+        self.samples += 1
+
+    def score(self):
+        """Volatility per square root of a second, mid and spread moves weigh the same"""
+        return math.sqrt(self.mid_variance) + math.sqrt(self.spread_variance)
+
+
+class AdaptiveSampler:
+    """
+    Reassigns the request budget between books by their recent volatility.
+
+    Collectors `attach` the TickClock of each book and feed every row of
+    process_response to `observe`. Every `rebalance_interval` seconds the
+    budget of the shared rate limiter is split between the books in
+    proportion to their mid price and spread volatility, between `floor` and
+    `ceiling` requests per second, and the clock periods are updated. After a
+    rebalance each book's next `observe` returns a row with its target and
+    effective rates for the rates stream.
+    """
+
+    def __init__(self, floor=MIN_RATE, ceiling=MAX_RATE, limits=None, budget_share=BUDGET_SHARE,
+                 rebalance_interval=REBALANCE_INTERVAL, limiter=rate_limiter):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.limits = dict(limits or {})  # book -> (floor, ceiling)
+        self.budget_share = budget_share
+        self.reserved = 0.0  # Requests per second taken by other collectors, e.g. the ticker
+        self.rebalance_interval = rebalance_interval
+        self.limiter = limiter
+        self.clocks = {}
+        self.books = {}
+        self.rates = {}
+        self.effective = {}
+        self._counts = {}
+        self._pending = set()
+        self._rebalanced_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def budget(self):
+        """Requests per second shared by the attached books"""
+        return max(self.limiter.rate * self.budget_share - self.reserved, 0.0)
+
+    def attach(self, book, clock):
+        '''
+        Let the sampler set the tick period of a book
+
+        Args:
+        book (str): Book name
+        clock (TickClock): Clock of the book's collector
+        '''
+        with self._lock:
+            self.clocks[book] = clock
+            self.books.setdefault(book, BookVolatility())
+            self._counts.setdefault(book, 0)
+            self._assign(time.monotonic())
+
+    def observe(self, data_tuple):
+        '''
+        Update the volatility of a book with one row, and rebalance when due
+
+        Args:
+        data_tuple (tuple): Row matching formats.COLUMNS
+
+        Returns:
+        list: The rates row of the book after a rebalance, empty otherwise
+        '''
+        _, book, bid, ask, _ = data_tuple
+        now = time.monotonic()
+        with self._lock:
+            volatility = self.books.setdefault(book, BookVolatility())
+            volatility.update(bid, ask, now)
+            self._counts[book] = self._counts.get(book, 0) + 1
+            if now - self._rebalanced_at >= self.rebalance_interval:
+                self._rebalance(now)
+            if book not in self._pending:
+                return []
+            self._pending.discard(book)
+            return [self._rates_row(book)]
+
+    def _rebalance(self, now):
+        elapsed = now - self._rebalanced_at
+        self.effective = {book: count / elapsed for book, count in self._counts.items()}
+        self._counts = dict.fromkeys(self._counts, 0)
+        self._assign(now)
+        self._pending = set(self.clocks)
+        logging.debug(f"Sampling rates: { {book: round(rate, 2) for book, rate in self.rates.items()} }")
+
+    def _assign(self, now):
+        """Split the budget between the attached books and retune their clocks"""
+        self._rebalanced_at = now
+        books = list(self.clocks)
+        if not books:
+            return
+        floors = {book: self.limits.get(book, (self.floor, self.ceiling))[0] for book in books}
+        # Per-book ceilings can't go past MAX_RATE either, see above
+        ceilings = {book: min(self.limits.get(book, (self.floor, self.ceiling))[1], MAX_RATE) for book in books}
+        scores = {book: self.books[book].score() for book in books}
+        self.rates = allocate(scores, self.budget, floors, ceilings)
+        for book, rate in self.rates.items():
+            if rate > 0:
+                self.clocks[book].set_period(1 / rate)
+
+    def _rates_row(self, book):
+        """Row matching RATE_COLUMNS"""
+        volatility = self.books[book]
+        return (
+            datetime.now(timezone.utc).strftime(TIMESTAMP_FORMAT),
+            book,
+            round(self.rates.get(book, 0.0), 4),
+            round(self.effective.get(book, 0.0), 4),
+            float(f"{math.sqrt(volatility.mid_variance):.6g}"),
+            float(f"{math.sqrt(volatility.spread_variance):.6g}"),
+        )
+
+
+# Shared by the collectors of a process
+adaptive_sampler = AdaptiveSampler()
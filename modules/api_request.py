@@ -1,17 +1,28 @@
 import time
 import hmac
 import hashlib
-import requests
 from urllib.parse import urlparse, urlencode
 from dotenv import load_dotenv
 import os
 import logging
-from datetime import datetime, timezone
-from google.cloud import storage
+from modules.rate_limiter import rate_limiter
+from modules.credentials import granted_credential
+from modules.http_client import get_http_client
+from modules.depth import process_depth
+from modules.fast_parse import parse_top_of_book, parse_payload, parse_tickers
+from modules.formats import make_data_tuple
+from modules.resilience import request_policy, TransientStatusError, TRANSIENT_STATUS
+from modules.metrics import stage, SKIPPED_TICKS, LOG_TICKS
 
 # Constants
 BASE_URL = "https://stage.bitso.com/api/v3/order_book"
+# Top of book of every book in one request
+TICKER_URL = "https://stage.bitso.com/api/v3/ticker"
+# Rate limiter and request policy key of the ticker requests
+TICKER_KEY = "ticker"
 DEFAULT_BOOK = "btc_mxn"
+# Skip the tick if no request token frees up within one sampling period
+ACQUIRE_TIMEOUT = 1
 
 
 # Logging setup
@@ -36,47 +47,150 @@ def build_auth_header(api_key, api_secret, http_method, request_path, json_paylo
     return f"Bitso {api_key}:{nonce}:{signature}"
 
 
-def make_request(api_key, api_secret, http_method, base_url, params):
-    url = f"{base_url}?{urlencode(params)}"
-    request_path = f"{urlparse(base_url).path}?{urlencode(params)}"
+def make_request(api_key, api_secret, http_method, base_url, params, limiter=rate_limiter, client=None, timeout=None,
+                 credential=None):
+    query = urlencode(params)
+    url = f"{base_url}?{query}" if query else base_url
+    request_path = f"{urlparse(base_url).path}?{query}" if query else urlparse(base_url).path
     json_payload = ""
 
-    auth_header = build_auth_header(api_key, api_secret, http_method, request_path, json_payload)
+    with stage("sign"):
+        if credential is not None:
+            auth_header = credential.auth_header(http_method, request_path, json_payload)
+        else:
+            auth_header = build_auth_header(api_key, api_secret, http_method, request_path, json_payload)
 
     headers = {
         'Authorization': auth_header,
         'Content-Type': 'application/json'
     }
 
-    if http_method == "GET":
-        return requests.get(url, headers=headers)
-    elif http_method == "POST":
-        return requests.post(url, headers=headers, data=json_payload)
-    else:
-        raise ValueError("Unsupported HTTP method")
-
-
-def process_response(response, book):
-    payload = response.json().get('payload')
-    best_bid = float(payload['bids'][0]['price'])
-    best_ask = float(payload['asks'][0]['price'])
-    spread = float(format((best_bid/best_ask) * 100 / best_ask, '.4f'))
-
-    orderbook_timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S%z")
-    return (orderbook_timestamp, book, best_bid, best_ask, spread)
-
+    client = client or get_http_client()
+    with stage("http"):
+        if http_method == "GET":
+            response = client.get(url, headers=headers, timeout=timeout)
+        elif http_method == "POST":
+            response = client.post(url, headers=headers, data=json_payload, timeout=timeout)
+        else:
+            raise ValueError("Unsupported HTTP method")
+
+    (credential or limiter).update_from_response(response.status_code, response.headers)
+    if response.status_code in TRANSIENT_STATUS:
+        raise TransientStatusError(response.status_code)
+    return response
+
+
+def process_response(response, book, depth=False):
+    with stage("process"):
+        # Depth mode needs the whole book, otherwise only the first level is read
+        with stage("decode"):
+            top_of_book = None if depth else parse_top_of_book(response.content)
+            payload = None if top_of_book else parse_payload(response.content)
+        if top_of_book:
+            best_bid, best_ask = top_of_book
+        else:
+            best_bid = float(payload['bids'][0]['price'])
+            best_ask = float(payload['asks'][0]['price'])
+        data_tuple = make_data_tuple(book, best_bid, best_ask)
+        if depth:
+            return data_tuple, process_depth(payload, book, data_tuple[0])
+        return data_tuple
+
+
+def make_request_and_process(api_key, api_secret, book=DEFAULT_BOOK, limiter=rate_limiter, depth=False,
+                             policy=request_policy):
+    '''
+    Request the order book of a book and extract its best bid and ask
+
+    With depth=True the whole book is also reduced to depth metrics and a
+    (data_tuple, depth_tuple) pair is returned instead of the data tuple.
+    '''
+    grant = limiter.acquire(book, timeout=ACQUIRE_TIMEOUT)
+    if not grant:
+        SKIPPED_TICKS.labels(book, "budget").inc()
+        logging.warning(f"Request budget exhausted, skipping tick for {book}")
+        return None
 
-def make_request_and_process(api_key, api_secret, book=DEFAULT_BOOK):
+    # A CredentialPool grants the key to sign with, with a plain RateLimiter the request is signed with api_key
+    credential = granted_credential(grant)
     params = {"book": book}
-    response = make_request(api_key, api_secret, "GET", BASE_URL, params)
+    response = policy.call(
+        lambda timeout: make_request(api_key, api_secret, "GET", BASE_URL, params, limiter, timeout=timeout,
+                                     credential=credential),
+        book, credential.limiter if credential else limiter
+    )
+    if response is None:
+        SKIPPED_TICKS.labels(book, "request").inc()
+        return None
 
     if response.status_code != 200:
+        SKIPPED_TICKS.labels(book, "status").inc()
         logging.error(f"Request failed with status code: {response.status_code}")
         return None
 
-    data_tuple = process_response(response, book)
-    logging.info(f"Bid-Ask spread: {data_tuple}")
-    return data_tuple
+    result = process_response(response, book, depth)
+    if LOG_TICKS:
+        logging.info(f"Bid-Ask spread: {result[0] if depth else result}")
+    return result
+
+
+def process_ticker_response(response, books):
+    '''
+    Build the row of every book from one ticker response
+
+    Args:
+    response: Response of the ticker endpoint
+    books (set): Books to keep
+
+    Returns:
+    dict: Data tuple keyed by book
+    '''
+    with stage("process"):
+        with stage("decode"):
+            quotes = parse_tickers(response.content, books)
+        return {book: make_data_tuple(book, best_bid, best_ask) for book, (best_bid, best_ask) in quotes.items()}
+
+
+def fetch_tickers(api_key, api_secret, books, limiter=rate_limiter, policy=request_policy):
+    '''
+    Get the top of book of every book with a single ticker request
+
+    Args:
+    books (iterable): Books to sample
+
+    Returns:
+    dict: Data tuple keyed by book, empty if the request failed
+    '''
+    books = set(books)
+    grant = limiter.acquire(TICKER_KEY, timeout=ACQUIRE_TIMEOUT)
+    if not grant:
+        SKIPPED_TICKS.labels(TICKER_KEY, "budget").inc()
+        logging.warning("Request budget exhausted, skipping ticker tick")
+        return {}
+
+    credential = granted_credential(grant)
+    response = policy.call(
+        lambda timeout: make_request(api_key, api_secret, "GET", TICKER_URL, {}, limiter, timeout=timeout,
+                                     credential=credential),
+        TICKER_KEY, credential.limiter if credential else limiter
+    )
+    if response is None or response.status_code != 200:
+        SKIPPED_TICKS.labels(TICKER_KEY, "request").inc()
+        if response is not None:
+            logging.error(f"Ticker request failed with status code: {response.status_code}")
+        return {}
+
+    data_tuples = process_ticker_response(response, books)
+    if not data_tuples:
+        SKIPPED_TICKS.labels(TICKER_KEY, "payload").inc()
+        logging.error("Ticker response has none of the books")
+        return {}
+    for book in books - data_tuples.keys():
+        SKIPPED_TICKS.labels(book, "ticker").inc()
+        logging.warning(f"No ticker for {book}")
+    if LOG_TICKS:
+        logging.info(f"Tickers: {list(data_tuples.values())}")
+    return data_tuples
 
 
 if __name__ == "__main__":
@@ -86,8 +200,6 @@ if __name__ == "__main__":
     if not api_key or not api_secret:
         logging.error("API credentials not found in environment variables")
 
-    gcs_client = storage.Client()
-
     result = make_request_and_process(api_key, api_secret)
     if result:
         print("Processed Data:", result)
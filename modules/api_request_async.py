@@ -1,17 +1,29 @@
 import time
 import hmac
 import hashlib
-import aiohttp
 import asyncio
 from urllib.parse import urlparse, urlencode
 from dotenv import load_dotenv
 import os
 import logging
-from datetime import datetime, timezone
+from modules.rate_limiter import rate_limiter
+from modules.credentials import granted_credential
+from modules.http_client import async_http_client
+from modules.depth import process_depth
+from modules.fast_parse import parse_top_of_book, parse_payload, parse_tickers
+from modules.formats import make_data_tuple
+from modules.resilience import request_policy, TransientStatusError, TRANSIENT_STATUS
+from modules.metrics import stage, SKIPPED_TICKS, LOG_TICKS
 
 # Constants
 BASE_URL = "https://stage.bitso.com/api/v3/order_book"
+# Top of book of every book in one request
+TICKER_URL = "https://stage.bitso.com/api/v3/ticker"
+# Rate limiter and request policy key of the ticker requests
+TICKER_KEY = "ticker"
 DEFAULT_BOOK = "xrp_mxn"
+# Skip the tick if no request token frees up within one sampling period
+ACQUIRE_TIMEOUT = 1
 
 # Logging setup
 logging.basicConfig(
@@ -35,12 +47,24 @@ def build_auth_header(api_key, api_secret, http_method, request_path, json_paylo
     return f"Bitso {api_key}:{nonce}:{signature}"
 
 
-async def make_request(api_key, api_secret, http_method, base_url, params, session):
-    url = f"{base_url}?{urlencode(params)}"
-    request_path = f"{urlparse(base_url).path}?{urlencode(params)}"
+async def make_request(api_key, api_secret, http_method, base_url, params, session, limiter=rate_limiter,
+                       credential=None):
+    """
+    Send a signed request and return the raw response body
+
+    With a `credential` of the credential pool the request is signed with its
+    key and the response is reported to it instead of `limiter`.
+    """
+    query = urlencode(params)
+    url = f"{base_url}?{query}" if query else base_url
+    request_path = f"{urlparse(base_url).path}?{query}" if query else urlparse(base_url).path
     json_payload = ""
 
-    auth_header = build_auth_header(api_key, api_secret, http_method, request_path, json_payload)
+    with stage("sign"):
+        if credential is not None:
+            auth_header = credential.auth_header(http_method, request_path, json_payload)
+        else:
+            auth_header = build_auth_header(api_key, api_secret, http_method, request_path, json_payload)
 
     headers = {
         'Authorization': auth_header,
@@ -48,42 +72,121 @@ async def make_request(api_key, api_secret, http_method, base_url, params, sessi
     }
 
     if http_method == "GET":
-        async with session.get(url, headers=headers) as response:
-            return await response.json()
+        request = session.get(url, headers=headers)
     elif http_method == "POST":
-        async with session.post(url, headers=headers, data=json_payload) as response:
-            return await response.json()
+        request = session.post(url, headers=headers, data=json_payload)
     else:
         raise ValueError("Unsupported HTTP method")
 
-
-async def process_response(response, book):
-    payload = response.get('payload')
-    if not payload:
-        logging.error(f"Error in response payload: {response}")
+    with stage("http"):
+        async with request as response:
+            (credential or limiter).update_from_response(response.status, response.headers)
+            if response.status in TRANSIENT_STATUS:
+                raise TransientStatusError(response.status)
+            return await response.read()
+
+
+async def process_response(response, book, depth=False):
+    with stage("process"):
+        # Depth mode needs the whole book, otherwise only the first level is read
+        with stage("decode"):
+            top_of_book = None if depth else parse_top_of_book(response)
+            payload = None if top_of_book else parse_payload(response)
+        if top_of_book:
+            best_bid, best_ask = top_of_book
+        else:
+            if not payload:
+                logging.error(f"Error in response payload: {response}")
+                return None
+
+            best_bid = float(payload['bids'][0]['price'])
+            best_ask = float(payload['asks'][0]['price'])
+        data_tuple = make_data_tuple(book, best_bid, best_ask)
+        if depth:
+            return data_tuple, process_depth(payload, book, data_tuple[0])
+        return data_tuple
+
+
+async def make_request_and_process(api_key, api_secret, params, session=None, limiter=rate_limiter, depth=False,
+                                   policy=request_policy):
+    """
+    Request the order book of a book and extract its best bid and ask
+
+    With depth=True the whole book is also reduced to depth metrics and a
+    (data_tuple, depth_tuple) pair is returned instead of the data tuple.
+    """
+    book = params.get('book')
+    grant = await limiter.acquire_async(book, timeout=ACQUIRE_TIMEOUT)
+    if not grant:
+        SKIPPED_TICKS.labels(book, "budget").inc()
+        logging.warning(f"Request budget exhausted, skipping tick for {book}")
         return None
 
-    best_bid = float(payload['bids'][0]['price'])
-    best_ask = float(payload['asks'][0]['price'])
-    spread = float(format((best_bid/best_ask) * 100 / best_ask, '.4f'))
-
-    orderbook_timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S%z")
-    return (orderbook_timestamp, book, best_bid, best_ask, spread)
-
-
-async def make_request_and_process(api_key, api_secret, params, session=None):
-
+    # A CredentialPool grants the key to sign with, with a plain RateLimiter the request is signed with api_key
+    credential = granted_credential(grant)
     if session is None:
-        async with aiohttp.ClientSession() as new_session:
-            response = await make_request(api_key, api_secret, "GET", BASE_URL, params, new_session)
-    else:
-        response = await make_request(api_key, api_secret, "GET", BASE_URL, params, session)
+        session = await async_http_client.session()
+    response = await policy.call_async(
+        lambda timeout: make_request(api_key, api_secret, "GET", BASE_URL, params, session, limiter, credential),
+        book, credential.limiter if credential else limiter
+    )
+    if response is None:
+        SKIPPED_TICKS.labels(book, "request").inc()
+        return None
 
-    book = params.get('book')
-    data_tuple = await process_response(response, book)
-    if data_tuple:
-        logging.info(f"Bid-Ask spread: {data_tuple}")
-    return data_tuple
+    result = await process_response(response, book, depth)
+    if result is None:
+        SKIPPED_TICKS.labels(book, "payload").inc()
+    elif LOG_TICKS:
+        logging.info(f"Bid-Ask spread: {result[0] if depth else result}")
+    return result
+
+
+async def process_ticker_response(response, books):
+    """
+    Build the row of every book in `books` from one ticker response, keyed by book
+    """
+    with stage("process"):
+        with stage("decode"):
+            quotes = parse_tickers(response, books)
+        return {book: make_data_tuple(book, best_bid, best_ask) for book, (best_bid, best_ask) in quotes.items()}
+
+
+async def fetch_tickers(api_key, api_secret, books, session=None, limiter=rate_limiter, policy=request_policy):
+    """
+    Get the top of book of every book with a single ticker request
+
+    Returns a dict of data tuples keyed by book, empty if the request failed.
+    """
+    books = set(books)
+    grant = await limiter.acquire_async(TICKER_KEY, timeout=ACQUIRE_TIMEOUT)
+    if not grant:
+        SKIPPED_TICKS.labels(TICKER_KEY, "budget").inc()
+        logging.warning("Request budget exhausted, skipping ticker tick")
+        return {}
+
+    credential = granted_credential(grant)
+    if session is None:
+        session = await async_http_client.session()
+    response = await policy.call_async(
+        lambda timeout: make_request(api_key, api_secret, "GET", TICKER_URL, {}, session, limiter, credential),
+        TICKER_KEY, credential.limiter if credential else limiter
+    )
+    if response is None:
+        SKIPPED_TICKS.labels(TICKER_KEY, "request").inc()
+        return {}
+
+    data_tuples = await process_ticker_response(response, books)
+    if not data_tuples:
+        SKIPPED_TICKS.labels(TICKER_KEY, "payload").inc()
+        logging.error("Ticker response has none of the books")
+        return {}
+    for book in books - data_tuples.keys():
+        SKIPPED_TICKS.labels(book, "ticker").inc()
+        logging.warning(f"No ticker for {book}")
+    if LOG_TICKS:
+        logging.info(f"Tickers: {list(data_tuples.values())}")
+    return data_tuples
 
 
 async def main():
@@ -94,8 +197,8 @@ async def main():
         logging.error("API credentials not found in environment variables")
         return
 
-    async with aiohttp.ClientSession() as session:
-        result = await make_request_and_process(api_key, api_secret, session=session)
+    async with async_http_client as session:
+        result = await make_request_and_process(api_key, api_secret, {"book": DEFAULT_BOOK}, session)
         if result:
             print("Processed Data:", result)
 
@@ -0,0 +1,113 @@
+import os
+from datetime import datetime, timezone
+from modules.formats import STREAM_COLUMNS, TIMESTAMP_FORMAT
+
+# Bar sizes in minutes, the collectors set their own, e.g. (1, 5, MINUTE_MULTIPLE)
+BAR_MINUTES = (1, 5)
+
+BAR_COLUMNS = (
+    ["timestamp", "book", "minutes"]
+    + [f"{price}_{field}" for price in ("bid", "ask", "mid") for field in ("open", "high", "low", "close")]
+    + ["spread_mean", "spread_max", "ticks"]
+)
+STREAM_COLUMNS["bars"] = BAR_COLUMNS
+
+
+def bars_filename(filename):
+    """Name of the bars file stored next to an interval file"""
+    return f"{os.path.splitext(filename)[0]}.bars.csv"
+
+
+class Bar:
+    """Running OHLC of bid, ask and mid, and spread stats, of one book over one bar"""
+
+    __slots__ = ("start", "bid", "ask", "mid", "spread_sum", "spread_max", "ticks")
+
+    def __init__(self, start, bid, ask, spread):
+        mid = (bid + ask) / 2
+        self.start = start
+        self.bid = [bid, bid, bid, bid]
+        self.ask = [ask, ask, ask, ask]
+        self.mid = [mid, mid, mid, mid]
+        self.spread_sum = spread
+        self.spread_max = spread
+        self.ticks = 1
+
+    def update(self, bid, ask, spread):
+        for ohlc, price in ((self.bid, bid), (self.ask, ask), (self.mid, (bid + ask) / 2)):
+            if price > ohlc[1]:
+                ohlc[1] = price
+            elif price < ohlc[2]:
+                ohlc[2] = price
+            ohlc[3] = price
+        self.spread_sum += spread
+        if spread > self.spread_max:
+            self.spread_max = spread
+        self.ticks += 1
+
+    def row(self, book, minutes):
+        """Row matching BAR_COLUMNS"""
+        timestamp = datetime.fromtimestamp(self.start, timezone.utc).strftime(TIMESTAMP_FORMAT)
+        return (timestamp, book, minutes, *self.bid, *self.ask, *self.mid,
+                round(self.spread_sum / self.ticks, 4), self.spread_max, self.ticks)
+
+
+class BarAggregator:
+    """
+    Incremental OHLC bars of the top-of-book rows.
+
+    Keeps one open bar per book and bar size, so memory does not grow with
+    the ticks. Bars are aligned to the epoch like the interval files, a bar
+    is closed by the first row of a later bar or by `expire` at an interval
+    rollover, and closed bars come back as rows matching BAR_COLUMNS.
+    """
+
+    def __init__(self, minutes=BAR_MINUTES):
+        self.minutes = tuple(minutes)
+        self._bars = {}  # (book, minutes) -> open Bar
+
+    def update(self, data_tuple):
+        '''
+        Add one row of process_response to the open bars of its book
+
+        Args:
+        data_tuple (tuple): Row matching formats.COLUMNS
+
+        Returns:
+        list: Rows of the bars closed by this row
+        '''
+        if not self.minutes:
+            return []
+        timestamp, book, bid, ask, spread = data_tuple
+        now = datetime.strptime(timestamp, TIMESTAMP_FORMAT).timestamp()
+
+        closed = []
+        for minutes in self.minutes:
+            seconds = minutes * 60
+            start = now - now % seconds
+            bar = self._bars.get((book, minutes))
+            if bar is not None and bar.start == start:
+                bar.update(bid, ask, spread)
+                continue
+            if bar is not None:
+                closed.append(bar.row(book, minutes))
+            self._bars[(book, minutes)] = Bar(start, bid, ask, spread)
+        return closed
+
+    def expire(self, until):
+        '''
+        Close the bars that ended at or before a time, for books that stopped ticking and at rollovers
+
+        Args:
+        until (datetime): Bars ending at or before this time are closed
+
+        Returns:
+        list: Rows of the closed bars
+        '''
+        until = until.timestamp()
+        closed = []
+        for (book, minutes), bar in list(self._bars.items()):
+            if bar.start + minutes * 60 <= until:
+                closed.append(bar.row(book, minutes))
+                del self._bars[(book, minutes)]
+        return closed
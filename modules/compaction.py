@@ -0,0 +1,245 @@
+"""
+Hourly compaction of the interval files of a partition.
+
+Merges the small interval files of a closed hour into one sorted file per
+book (or one across books) and stream, checks the row counts, removes the
+originals and writes a manifest with the time bounds, books, row counts and
+price ranges of the partition, so readers can prune without listing.
+
+    python -m modules.compaction --local data
+    python -m modules.compaction --bucket bitsode --hours 48 --across-books
+"""
+import io
+import re
+import json
+import logging
+import argparse
+from datetime import datetime, timezone, timedelta
+from modules.formats import columns_for, read_csv_table, read_parquet_table, TIMESTAMP_FORMAT
+from modules.storage import get_storage, MANIFEST_NAME
+# Register the columns of the extra streams
+import modules.depth  # noqa: F401
+import modules.bars  # noqa: F401
+import modules.adaptive  # noqa: F401
+import modules.cross_book  # noqa: F401
+
+# Constants
+GRACE_PERIOD = timedelta(minutes=15)  # Time left after an hour ends for its last uploads
+LOOKBACK_HOURS = 24
+ALL_BOOKS = "all_books"  # Book name of the files compacted across books
+COMPACTION_FORMATS = ("parquet", "csv")
+COMPRESSION = "zstd"
+PRICE_COLUMNS = ("bid", "ask", "spread")
+
+# Interval files are {book}_{YYYY-MM-DD-HH-MM-SS}[.stream].ext, compacted ones {book}_{YYYY-MM-DD-HH}[.stream].ext
+FILE_PATTERN = re.compile(
+    r"^(?P<book>.+)_(?P<start>\d{4}-\d{2}-\d{2}-\d{2}(?P<minutes>-\d{2}-\d{2})?)(?P<stream>\.[a-z]+)?\.(?P<ext>csv|parquet)$"
+)
+
+
+def parse_name(key):
+    '''
+    Split the name of a data file into its parts
+
+    Args:
+    key (str): Key or name of the file
+
+    Returns:
+    dict: book, stream ("" for top of book), ext and whether the file is compacted, None for other files
+    '''
+    match = FILE_PATTERN.match(key.rsplit("/", 1)[-1])
+    if not match:
+        return None
+    return {
+        "book": match["book"],
+        "stream": (match["stream"] or "").lstrip("."),
+        "ext": match["ext"],
+        "compacted": match["minutes"] is None,
+    }
+
+
+def read_table(storage, key):
+    """Read a data file of any supported format into a pyarrow Table"""
+    data = io.BytesIO(storage.read(key))
+    if key.endswith(".parquet"):
+        return read_parquet_table(data)
+    return read_csv_table(data, columns_for(key))
+
+
+def serialize(table, output_format):
+    """Encode a table as Parquet, or as headerless CSV in the collectors' format"""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+    from pyarrow import csv as pa_csv
+
+    buffer = io.BytesIO()
+    if output_format == "parquet":
+        pq.write_table(table, buffer, compression=COMPRESSION)
+    else:
+        index = table.schema.get_field_index("timestamp")
+        timestamps = pc.strftime(table["timestamp"], format=TIMESTAMP_FORMAT)
+        table = table.set_column(index, pa.field("timestamp", pa.string()), timestamps)
+        pa_csv.write_csv(table, buffer, pa_csv.WriteOptions(include_header=False, quoting_style="none"))
+    return buffer.getvalue()
+
+
+def count_rows(data, output_format):
+    import pyarrow.parquet as pq
+
+    if output_format == "parquet":
+        return pq.ParquetFile(io.BytesIO(data)).metadata.num_rows
+    return data.count(b"\n")
+
+
+def table_stats(table):
+    '''
+    Row count, time bounds and price ranges of each book of a table
+
+    Returns:
+    dict: Stats keyed by book
+    '''
+    aggregations = [("timestamp", "min"), ("timestamp", "max"), ("book", "count")]
+    aggregations += [(name, stat) for name in PRICE_COLUMNS if name in table.column_names for stat in ("min", "max")]
+    stats = {}
+    for row in table.group_by("book").aggregate(aggregations).to_pylist():
+        book_stats = {
+            "rows": row["book_count"],
+            "start": row["timestamp_min"].isoformat(),
+            "end": row["timestamp_max"].isoformat(),
+        }
+        for name in PRICE_COLUMNS:
+            if f"{name}_min" in row:
+                book_stats[f"{name}_min"] = row[f"{name}_min"]
+                book_stats[f"{name}_max"] = row[f"{name}_max"]
+        stats[row["book"]] = book_stats
+    return stats
+
+
+def compact_partition(storage, hour, per_book=True, output_format="parquet"):
+    '''
+    Compact the interval files of one hour
+
+    Every stream (top of book, depth) is merged separately. Rows are sorted by
+    timestamp and book, exact duplicates are dropped, so rerunning after a
+    crash between the writes and the deletes is safe. Interval files that
+    arrive after a compaction are merged into the compacted files by the next
+    run.
+
+    Args:
+    storage: LocalStorage or GcsStorage holding the partitions
+    hour (datetime): Any time in the hour to compact
+    per_book (bool): One file per book, otherwise one file across books
+    output_format (str): "parquet" or "csv"
+
+    Returns:
+    dict: The partition manifest, None if there was nothing to compact
+    '''
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    prefix = storage.partition(hour)
+    files = {key: parse_name(key) for key in storage.list(prefix)}
+    files = {key: info for key, info in files.items() if info}
+    if all(info["compacted"] and info["ext"] == output_format for info in files.values()):
+        return None
+
+    hour_name = hour.strftime("%Y-%m-%d-%H")
+    manifest = {"partition": prefix, "hour": hour.replace(minute=0, second=0, microsecond=0).isoformat(),
+                "compacted_at": datetime.now(timezone.utc).isoformat(), "files": []}
+    inputs = []
+
+    for stream in sorted({info["stream"] for info in files.values()}):
+        keys = [key for key, info in files.items() if info["stream"] == stream]
+        tables = [read_table(storage, key) for key in keys]
+        table = pa.concat_tables(tables, promote_options="permissive")
+        # Distinct rows, in timestamp and book order
+        table = table.group_by(table.column_names, use_threads=False).aggregate([])
+        table = table.sort_by([("timestamp", "ascending"), ("book", "ascending")])
+
+        if per_book:
+            groups = {book: table.filter(pc.equal(table["book"], book)) for book in pc.unique(table["book"]).to_pylist()}
+        else:
+            groups = {ALL_BOOKS: table}
+
+        suffix = f".{stream}" if stream else ""
+        for book, group in sorted(groups.items()):
+            key = f"{prefix}/{book}_{hour_name}{suffix}.{output_format}"
+            data = serialize(group, output_format)
+            storage.write(key, data)
+            written = count_rows(storage.read(key), output_format)
+            if written != group.num_rows:
+                raise RuntimeError(f"{key} has {written} rows, expected {group.num_rows}, originals kept")
+            manifest["files"].append({
+                "name": key.rsplit("/", 1)[-1],
+                "stream": stream or "top",
+                "rows": group.num_rows,
+                "bytes": len(data),
+                "books": table_stats(group),
+            })
+        inputs.extend(keys)
+
+    outputs = {f"{prefix}/{entry['name']}" for entry in manifest["files"]}
+    manifest["books"] = sorted({book for entry in manifest["files"] for book in entry["books"]})
+    manifest["rows"] = sum(entry["rows"] for entry in manifest["files"] if entry["stream"] == "top")
+    storage.write(f"{prefix}/{MANIFEST_NAME}", json.dumps(manifest, indent=2).encode())
+
+    for key in inputs:
+        if key not in outputs:
+            storage.delete(key)
+    logging.info(f"Compacted {len(inputs)} files of {prefix} into {len(outputs)} ({manifest['rows']} rows)")
+    return manifest
+
+
+def closed_hours(now=None, hours=LOOKBACK_HOURS):
+    """Start of the last `hours` hours that ended at least GRACE_PERIOD ago, oldest first"""
+    now = now or datetime.now(timezone.utc)
+    last = (now - GRACE_PERIOD).replace(minute=0, second=0, microsecond=0) - timedelta(hours=1)
+    return [last - timedelta(hours=i) for i in reversed(range(hours))]
+
+
+def compact_closed_hours(storage, hours=LOOKBACK_HOURS, per_book=True, output_format="parquet"):
+    '''
+    Compact every closed hour of the lookback window
+
+    Args:
+    storage: LocalStorage or GcsStorage holding the partitions
+    hours (int): Number of closed hours to look at
+
+    Returns:
+    list: Manifests of the partitions that were compacted
+    '''
+    manifests = []
+    for hour in closed_hours(hours=hours):
+        try:
+            manifest = compact_partition(storage, hour, per_book, output_format)
+        except Exception as e:
+            logging.error(f"Compaction of {storage.partition(hour)} failed: {e}")
+            continue
+        if manifest:
+            manifests.append(manifest)
+    return manifests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--local", metavar="ROOT", help="compact the local partitions under ROOT (default: data)")
+    target.add_argument("--bucket", help="compact the partitions of this GCS bucket")
+    parser.add_argument("--hours", type=int, default=LOOKBACK_HOURS, help="closed hours to look at")
+    parser.add_argument("--hour", help="compact only this hour, e.g. 2024-06-30T10")
+    parser.add_argument("--across-books", action="store_true", help="one file per hour for all books")
+    parser.add_argument("--format", choices=COMPACTION_FORMATS, default="parquet")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    storage = get_storage("gcs", args.bucket) if args.bucket else get_storage("local", args.local or "data")
+    if args.hour:
+        hour = datetime.strptime(args.hour, "%Y-%m-%dT%H").replace(tzinfo=timezone.utc)
+        compact_partition(storage, hour, not args.across_books, args.format)
+    else:
+        compact_closed_hours(storage, args.hours, not args.across_books, args.format)
+
+
+if __name__ == "__main__":
+    main()
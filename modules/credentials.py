@@ -0,0 +1,213 @@
+"""
+Pool of Bitso API keys, each with its own request budget and nonce sequence.
+
+Bitso limits requests per API key, so with several keys the collectors can
+make more requests than one key allows. Every Credential signs with a
+prepared HMAC of its secret, hands out strictly increasing nonces and
+owns a RateLimiter. The pool routes each request to the key with the most
+headroom and takes keys rejected by the server out of rotation for a while.
+
+Keys are read from BITSO_API_KEY and BITSO_API_SECRET, then from the numbered
+pairs BITSO_API_KEY_1 and BITSO_API_SECRET_1 up to BITSO_API_KEY_16.
+"""
+import os
+import hmac
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from modules.rate_limiter import RateLimiter, rate_limiter
+from modules.metrics import CREDENTIAL_EVENTS
+
+# Constants
+MAX_KEYS = 16  # Numbered key pairs read from the environment
+AUTH_STATUS = {401, 403}
+AUTH_COOLDOWN = 60  # seconds a rejected key stays out of rotation, doubled on every rejection in a row
+MAX_COOLDOWN = 3600  # seconds
+REROUTE_INTERVAL = 0.25  # seconds spent waiting on one key before looking for a better one
+
+
+class Credential:
+    """
+    One API key pair with its request budget, nonce sequence and health.
+
+    Has the `update_from_response` of RateLimiter, so make_request can report
+    the responses of the key to it.
+    """
+
+    def __init__(self, api_key, api_secret, name=None, limiter=None):
+        self.api_key = api_key
+        self.name = name or "key"
+        self.limiter = limiter or RateLimiter()
+        # The secret is keyed into an HMAC once, every signature starts from a copy of it
+        self._hmac = hmac.new(api_secret.encode('utf-8'), digestmod=hashlib.sha256)
+        self._nonce = 0
+        self._lock = threading.Lock()
+        self.disabled_until = 0.0
+        self.cooldown = AUTH_COOLDOWN
+
+    @property
+    def active(self):
+        return time.monotonic() >= self.disabled_until
+
+    def next_nonce(self):
+        """Millisecond timestamp, bumped so nonces of the key never repeat or go backwards"""
+        with self._lock:
+            self._nonce = max(self._nonce + 1, int(time.time() * 1000))
+            return self._nonce
+
+    def sign(self, nonce, http_method, request_path, json_payload):
+        """Same signature as api_request.generate_signature, without keying a new HMAC"""
+        signature = self._hmac.copy()
+        signature.update(f"{nonce}{http_method}{request_path}{json_payload}".encode('utf-8'))
+        return signature.hexdigest()
+
+    def auth_header(self, http_method, request_path, json_payload=""):
+        nonce = self.next_nonce()
+        return f"Bitso {self.api_key}:{nonce}:{self.sign(nonce, http_method, request_path, json_payload)}"
+
+    def update_from_response(self, status_code, headers):
+        '''
+        Adjust the key's budget to the response and take the key out of rotation on auth errors
+
+        Args:
+        status_code (int): HTTP status code of the response
+        headers (Mapping): Case-insensitive response headers
+        '''
+        self.limiter.update_from_response(status_code, headers)
+        if status_code in AUTH_STATUS:
+            CREDENTIAL_EVENTS.labels(self.name, "rejected").inc()
+            with self._lock:
+                now = time.monotonic()
+                if now < self.disabled_until:
+                    # Sent before the key was taken out of rotation
+                    return
+                self.disabled_until = now + self.cooldown
+                cooldown, self.cooldown = self.cooldown, min(self.cooldown * 2, MAX_COOLDOWN)
+            logging.error(f"API key {self.name} rejected with status {status_code}, out of rotation for {cooldown}s")
+        elif status_code == 429:
+            # The limiter pauses the key until the server's window resets, the pool routes around it
+            CREDENTIAL_EVENTS.labels(self.name, "limited").inc()
+        elif status_code < 400:
+            with self._lock:
+                self.cooldown = AUTH_COOLDOWN
+
+
+class CredentialPool:
+    """
+    Routes requests between API keys.
+
+    Stands in for the RateLimiter of the collectors: `acquire` and
+    `acquire_async` return the Credential whose budget a request was taken
+    from, to sign the request with, or None when no key had a token within
+    the timeout. `rate` is the total budget of the keys in rotation.
+    """
+
+    def __init__(self, credentials):
+        self.credentials = list(credentials)
+
+    @classmethod
+    def from_env(cls, limiter=rate_limiter):
+        '''
+        Build the pool from the key pairs of the environment
+
+        Args:
+        limiter (RateLimiter): Budget of the first key, the process-wide rate_limiter by default
+
+        Returns:
+        CredentialPool: One Credential per key pair, the first one drawing from `limiter`
+        '''
+        pairs = []
+        for suffix in ["", *(f"_{n}" for n in range(1, MAX_KEYS + 1))]:
+            api_key, api_secret = os.getenv(f"BITSO_API_KEY{suffix}"), os.getenv(f"BITSO_API_SECRET{suffix}")
+            if api_key and api_secret and api_key not in {key for key, _ in pairs}:
+                pairs.append((api_key, api_secret))
+        if not pairs:
+            logging.error("API credentials not found in environment variables")
+            pairs = [("", "")]
+        credentials = [
+            Credential(api_key, api_secret, f"key{index + 1}", limiter if index == 0 else None)
+            for index, (api_key, api_secret) in enumerate(pairs)
+        ]
+        logging.info(f"{len(credentials)} API keys in the credential pool")
+        return cls(credentials)
+
+    @property
+    def rate(self):
+        """Requests per second of the keys in rotation"""
+        return sum(credential.limiter.rate for credential in self.credentials if credential.active)
+
+    def set_priority(self, book, priority):
+        for credential in self.credentials:
+            credential.limiter.set_priority(book, priority)
+
+    def share(self, budgets):
+        '''
+        Draw every key's tokens from budgets shared with other processes
+
+        Args:
+        budgets (list): One rate_limiter.shared_budget() per key, in the order of `credentials`
+        '''
+        for credential, budget in zip(self.credentials, budgets):
+            credential.limiter.share(budget)
+
+    def _pick(self):
+        """Key in rotation with the most headroom"""
+        active = [credential for credential in self.credentials if credential.active]
+        return max(active, key=lambda credential: credential.limiter.headroom(), default=None)
+
+    def acquire(self, book, timeout=None):
+        '''
+        Block until one of the keys has a request token for the book
+
+        Args:
+        book (str): Book the request is made for
+        timeout (float): Maximum seconds to wait, None waits forever
+
+        Returns:
+        Credential: Key to sign the request with, None if the timeout expired
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = REROUTE_INTERVAL if deadline is None else min(REROUTE_INTERVAL, deadline - time.monotonic())
+            credential = self._pick()
+            if credential is None:
+                if wait <= 0:
+                    return None
+                time.sleep(wait)
+            elif credential.limiter.acquire(book, timeout=max(wait, 0)):
+                CREDENTIAL_EVENTS.labels(credential.name, "requests").inc()
+                return credential
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+
+    async def acquire_async(self, book, timeout=None):
+        '''
+        Wait without blocking the event loop until one of the keys has a request token for the book
+
+        Args:
+        book (str): Book the request is made for
+        timeout (float): Maximum seconds to wait, None waits forever
+
+        Returns:
+        Credential: Key to sign the request with, None if the timeout expired
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = REROUTE_INTERVAL if deadline is None else min(REROUTE_INTERVAL, deadline - time.monotonic())
+            credential = self._pick()
+            if credential is None:
+                if wait <= 0:
+                    return None
+                await asyncio.sleep(wait)
+            elif await credential.limiter.acquire_async(book, timeout=max(wait, 0)):
+                CREDENTIAL_EVENTS.labels(credential.name, "requests").inc()
+                return credential
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+
+
+def granted_credential(grant):
+    """Credential returned by CredentialPool.acquire, None for the True of a plain RateLimiter"""
+    return grant if isinstance(grant, Credential) else None
@@ -0,0 +1,172 @@
+import time
+import threading
+from datetime import datetime, timezone
+import numpy as np
+from modules.formats import STREAM_COLUMNS, TIMESTAMP_FORMAT
+
+# Constants
+MAX_AGE = 2.5  # seconds a book's last sample stays in the snapshot, older quotes count as missing
+SETTLE_DELAY = 0.5  # seconds after a tick the collectors read the snapshot, so the tick's responses are in
+VIA_CURRENCIES = ("usd", "btc", "eth", "usdt", "mxn")  # Preferred middle currency of the implied cross rates
+ALL_BOOKS = "all_books"  # Book name of the files holding every book, like compaction.ALL_BOOKS
+BASIS_POINTS = 1e4
+PRICE_METRICS, PRICE_DECIMALS = ("mid", "implied_bid", "implied_ask"), 8
+RATIO_METRICS, RATIO_DECIMALS = ("spread_bps", "spread_z", "basis_bps", "arb_buy_bps", "arb_sell_bps"), 4
+
+CROSS_COLUMNS = [
+    "timestamp", "book", "mid", "spread_bps", "spread_z",
+    "via", "implied_bid", "implied_ask", "basis_bps", "arb_buy_bps", "arb_sell_bps"
+]
+STREAM_COLUMNS["cross"] = CROSS_COLUMNS
+
+
+def cross_filename(interval_start):
+    """Name of the cross-book metrics file of the interval starting at `interval_start`"""
+    return f"{ALL_BOOKS}_{interval_start.strftime('%Y-%m-%d-%H-%M-%S')}.cross.csv"
+
+
+def find_triangles(books, via_currencies=VIA_CURRENCIES):
+    '''
+    Pair every book with two other books whose rates multiply into its own
+
+    btc_mxn is implied by btc_usd and usd_mxn, a leg quoted the other way
+    round, e.g. mxn_usd, is inverted. The middle currencies of VIA_CURRENCIES
+    are tried first, then the other currencies of the books.
+
+    Args:
+    books (list): Book names like "btc_mxn"
+    via_currencies (tuple): Preferred middle currencies
+
+    Returns:
+    list: (book index, via, first leg index, first leg inverted, second leg index, second leg inverted)
+    '''
+    pairs = {tuple(book.split("_", 1)): index for index, book in enumerate(books) if "_" in book}
+    currencies = [*via_currencies, *sorted({currency for pair in pairs for currency in pair} - set(via_currencies))]
+
+    def leg(base, quote):
+        if (base, quote) in pairs:
+            return pairs[(base, quote)], False
+        if (quote, base) in pairs:
+            return pairs[(quote, base)], True
+        return None
+
+    triangles = []
+    for (base, quote), index in pairs.items():
+        for via in currencies:
+            if via in (base, quote):
+                continue
+            first, second = leg(base, via), leg(via, quote)
+            if first and second:
+                triangles.append((index, via, *first, *second))
+                break
+    return triangles
+
+
+class CrossBookSnapshot:
+    """
+    Latest top of book of every book in one matrix, with cross-book metrics computed over all books at once.
+
+    The collectors `update` it with every top-of-book row and write the
+    `rows` of the snapshot once per tick to the cross stream. Per book the
+    rows hold the relative spread and its z-score across the books, and,
+    when two other books imply its rate, the implied bid and ask, the basis
+    of the direct mid against the implied mid and the triangular arbitrage
+    gaps: arb_buy_bps is what buying through the legs and selling the book
+    directly would earn, arb_sell_bps the other way round, both before fees.
+    """
+
+    def __init__(self, books, max_age=MAX_AGE):
+        self.books = list(books)
+        self.max_age = max_age
+        self._index = {book: index for index, book in enumerate(self.books)}
+        # One row per book: bid, ask, monotonic time of the sample
+        self._quotes = np.full((len(self.books), 3), np.nan)
+        self._lock = threading.Lock()
+
+        triangles = find_triangles(self.books)
+        self._via = {triangle[0]: triangle[1] for triangle in triangles}
+        self._direct = np.array([triangle[0] for triangle in triangles], dtype=int)
+        self._legs = tuple(np.array([triangle[column] for triangle in triangles], dtype=dtype)
+                           for column, dtype in ((2, int), (3, bool), (4, int), (5, bool)))
+
+    def update(self, data_tuple):
+        '''
+        Replace the quote of a book with its latest top-of-book row
+
+        Args:
+        data_tuple (tuple): Row of formats.make_data_tuple
+        '''
+        index = self._index.get(data_tuple[1])
+        if index is not None:
+            with self._lock:
+                self._quotes[index] = (data_tuple[2], data_tuple[3], time.monotonic())
+
+    def compute(self, now=None):
+        '''
+        Cross-book metrics of the current snapshot, vectorized over the books
+
+        Args:
+        now (float): Monotonic time the quotes' age is measured at
+
+        Returns:
+        dict: Array per metric, one entry per book, NaN where a quote is stale or missing
+        '''
+        with self._lock:
+            quotes = self._quotes.copy()
+        now = time.monotonic() if now is None else now
+        fresh = now - quotes[:, 2] <= self.max_age
+        bid = np.where(fresh, quotes[:, 0], np.nan)
+        ask = np.where(fresh, quotes[:, 1], np.nan)
+        mid = (bid + ask) / 2
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            spread = (ask - bid) / mid * BASIS_POINTS
+            valid = np.isfinite(spread)
+            spread_z = np.full(len(self.books), np.nan)
+            if valid.sum() >= 2 and np.std(spread[valid]) > 0:
+                spread_z[valid] = (spread[valid] - spread[valid].mean()) / spread[valid].std()
+
+            # An inverted leg sells at 1 / ask and buys at 1 / bid
+            first, first_inverted, second, second_inverted = self._legs
+            first_bid = np.where(first_inverted, 1 / ask[first], bid[first])
+            first_ask = np.where(first_inverted, 1 / bid[first], ask[first])
+            second_bid = np.where(second_inverted, 1 / ask[second], bid[second])
+            second_ask = np.where(second_inverted, 1 / bid[second], ask[second])
+            implied_bid = np.full(len(self.books), np.nan)
+            implied_ask = np.full(len(self.books), np.nan)
+            implied_bid[self._direct] = first_bid * second_bid
+            implied_ask[self._direct] = first_ask * second_ask
+
+            basis = (mid / ((implied_bid + implied_ask) / 2) - 1) * BASIS_POINTS
+            arb_buy = (bid / implied_ask - 1) * BASIS_POINTS
+            arb_sell = (implied_bid / ask - 1) * BASIS_POINTS
+
+        return {"mid": mid, "spread_bps": spread, "spread_z": spread_z, "implied_bid": implied_bid,
+                "implied_ask": implied_ask, "basis_bps": basis, "arb_buy_bps": arb_buy, "arb_sell_bps": arb_sell}
+
+    def rows(self, timestamp=None):
+        '''
+        Rows matching CROSS_COLUMNS for the books with a fresh quote
+
+        Args:
+        timestamp (datetime): Time of the tick, now by default
+
+        Returns:
+        list: One row per book, metrics that cannot be computed are None
+        '''
+        timestamp = (timestamp or datetime.now(timezone.utc)).strftime(TIMESTAMP_FORMAT)
+        metrics = self.compute()
+        prices = np.column_stack([metrics[name] for name in PRICE_METRICS]).round(PRICE_DECIMALS)
+        ratios = np.column_stack([metrics[name] for name in RATIO_METRICS]).round(RATIO_DECIMALS)
+
+        rows = []
+        # One conversion of the whole matrix, NaN becomes None in the rows
+        for index, (price_values, ratio_values) in enumerate(zip(prices.tolist(), ratios.tolist())):
+            mid, implied_bid, implied_ask = (None if value != value else value for value in price_values)
+            spread, spread_z, basis, arb_buy, arb_sell = (None if value != value else value for value in ratio_values)
+            if mid is None:
+                continue
+            via = self._via.get(index) if implied_bid is not None else None
+            rows.append((timestamp, self.books[index], mid, spread, spread_z,
+                         via, implied_bid, implied_ask, basis, arb_buy, arb_sell))
+        return rows
@@ -0,0 +1,96 @@
+import os
+import numpy as np
+from modules.formats import STREAM_COLUMNS
+
+# Depth metrics computed when a book is captured in depth mode
+DEPTH_LEVELS = (1, 5, 10, 20)  # Cumulative depth at N levels
+VWAP_SIZES = (0.1, 1.0, 5.0)  # Fill sizes in the book's major currency
+
+DEPTH_COLUMNS = (
+    ["timestamp", "book", "microprice"]
+    + [f"bid_depth_{n}" for n in DEPTH_LEVELS]
+    + [f"ask_depth_{n}" for n in DEPTH_LEVELS]
+    + [f"imbalance_{n}" for n in DEPTH_LEVELS]
+    + [f"bid_vwap_{size:g}" for size in VWAP_SIZES]
+    + [f"ask_vwap_{size:g}" for size in VWAP_SIZES]
+)
+STREAM_COLUMNS["depth"] = DEPTH_COLUMNS
+
+
+def levels_to_array(levels):
+    '''
+    Turn one side of the order book payload into a (price, amount) array
+
+    Args:
+    levels (list): Bids or asks of the order_book payload, best price first
+
+    Returns:
+    np.ndarray: float64 array of shape (n, 2)
+    '''
+    return np.array([(level['price'], level['amount']) for level in levels], dtype=np.float64).reshape(-1, 2)
+
+
+def cumulative_depth(side, levels=DEPTH_LEVELS):
+    """Amount available up to each of the first N levels, books shallower than N use every level"""
+    cum_amount = np.cumsum(side[:, 1])
+    if cum_amount.size == 0:
+        return np.zeros(len(levels))
+    index = np.minimum(np.asarray(levels), cum_amount.size) - 1
+    return cum_amount[index]
+
+
+def vwap(side, sizes=VWAP_SIZES):
+    """Average price paid to fill each size walking the book, NaN when the book is too shallow"""
+    sizes = np.asarray(sizes, dtype=np.float64)
+    prices, amounts = side[:, 0], side[:, 1]
+    cum_amount = np.cumsum(amounts)
+    cum_notional = np.cumsum(prices * amounts)
+    if cum_amount.size == 0:
+        return np.full(sizes.size, np.nan)
+
+    # Level where each size is completed, and what the levels before it fill
+    index = np.searchsorted(cum_amount, sizes, side='left')
+    filled = index < cum_amount.size
+    index = np.minimum(index, cum_amount.size - 1)
+    prev_amount = np.where(index > 0, cum_amount[index - 1], 0.0)
+    prev_notional = np.where(index > 0, cum_notional[index - 1], 0.0)
+
+    notional = prev_notional + (sizes - prev_amount) * prices[index]
+    return np.where(filled, notional / sizes, np.nan)
+
+
+def depth_metrics(bids, asks, book, timestamp):
+    '''
+    Compute the depth metrics of one order book snapshot
+
+    Args:
+    bids (np.ndarray): (price, amount) array of the bids, best first
+    asks (np.ndarray): (price, amount) array of the asks, best first
+    book (str): Book name
+    timestamp (str): Timestamp of the matching top-of-book tuple
+
+    Returns:
+    tuple: Row matching DEPTH_COLUMNS
+    '''
+    bid_depth = cumulative_depth(bids)
+    ask_depth = cumulative_depth(asks)
+    total_depth = bid_depth + ask_depth
+    imbalance = np.divide(bid_depth - ask_depth, total_depth, out=np.zeros_like(total_depth), where=total_depth > 0)
+
+    microprice = np.nan
+    if len(bids) and len(asks):
+        (bid, bid_size), (ask, ask_size) = bids[0], asks[0]
+        microprice = (bid * ask_size + ask * bid_size) / (bid_size + ask_size)
+
+    metrics = np.concatenate([[microprice], bid_depth, ask_depth, imbalance, vwap(bids), vwap(asks)])
+    return (timestamp, book, *np.round(metrics, 8).tolist())
+
+
+def process_depth(payload, book, timestamp):
+    """Depth metrics row of an order_book payload"""
+    return depth_metrics(levels_to_array(payload['bids']), levels_to_array(payload['asks']), book, timestamp)
+
+
+def depth_filename(filename):
+    """Name of the depth file stored next to an interval file"""
+    return f"{os.path.splitext(filename)[0]}.depth.csv"
@@ -0,0 +1,93 @@
+import json
+
+try:
+    # Optional fast JSON backend
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+_SUCCESS = b'"success":true'
+_BIDS = b'"bids":[{'
+_ASKS = b'"asks":[{'
+_PRICE = b'"price":"'
+
+
+def _first_price(raw, key):
+    """Price of the first level after `key`, None if it isn't where it's expected"""
+    start = raw.find(key)
+    if start < 0:
+        return None
+    start += len(key)
+
+    # The price must belong to the first level, i.e. come before its closing brace
+    level_end = raw.find(b'}', start)
+    price_start = raw.find(_PRICE, start, level_end)
+    if level_end < 0 or price_start < 0:
+        return None
+    price_start += len(_PRICE)
+
+    price_end = raw.find(b'"', price_start, level_end)
+    if price_end < 0:
+        return None
+
+    try:
+        return float(raw[price_start:price_end])
+    except ValueError:
+        return None
+
+
+def parse_top_of_book(raw):
+    '''
+    Extract the best bid and ask from a raw order_book response without decoding it
+
+    Only the bytes up to the first level of each side are scanned. Anything
+    that doesn't look like the compact payload Bitso sends (failed request,
+    empty side, different spacing) returns None so the caller can fall back
+    to a full JSON decode.
+
+    Args:
+    raw (bytes): Body of the order_book response
+
+    Returns:
+    tuple: (best_bid, best_ask), or None if the payload looks unusual
+    '''
+    if _SUCCESS not in raw[:64]:
+        return None
+
+    best_bid = _first_price(raw, _BIDS)
+    best_ask = _first_price(raw, _ASKS)
+    if best_bid is None or best_ask is None:
+        return None
+    return best_bid, best_ask
+
+
+def parse_payload(raw):
+    """Fully decode the payload of a response"""
+    return loads(raw).get('payload')
+
+
+def parse_tickers(raw, books=None):
+    '''
+    Read the best bid and ask of every book in a ticker response
+
+    Args:
+    raw (bytes): Body of a /ticker response without book filter
+    books (set): Books to keep, all of them if None
+
+    Returns:
+    dict: (best_bid, best_ask) keyed by book, tickers without a bid or ask are left out
+    '''
+    payload = parse_payload(raw)
+    if not isinstance(payload, list):
+        return {}
+    quotes = {}
+    for ticker in payload:
+        book = ticker.get('book')
+        if books is not None and book not in books:
+            continue
+        try:
+            quotes[book] = (float(ticker['bid']), float(ticker['ask']))
+        except (KeyError, TypeError, ValueError):
+            continue
+    return quotes
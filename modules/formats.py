@@ -0,0 +1,217 @@
+import io
+import os
+import logging
+from datetime import datetime, timezone
+
+# Columns of the rows produced by process_response
+COLUMNS = ["timestamp", "book", "bid", "ask", "spread"]
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S%z"
+
+# Columns of the extra streams stored next to the interval files, keyed by the
+# stream suffix of the filename, e.g. btc_mxn_2023-06-30-10-00-00.depth.csv
+STREAM_COLUMNS = {
+    # Run-length encoded top of book, one row per run of unchanged samples
+    "rle": COLUMNS + ["last_timestamp", "count"],
+}
+
+
+def stream_of(filename):
+    """Stream of an interval file, e.g. "bars" for {book}_{interval}.bars.csv, "" for the top-of-book rows"""
+    return os.path.splitext(os.path.splitext(os.path.basename(filename))[0])[1].lstrip(".")
+
+
+def columns_for(filename):
+    """Column names of an interval or stream file, None if the stream is unknown"""
+    stream = stream_of(filename)
+    if not stream:
+        return COLUMNS
+    return STREAM_COLUMNS.get(stream)
+
+
+def make_data_tuple(book, best_bid, best_ask):
+    '''
+    Build the row stored for one top-of-book sample
+
+    Args:
+    book (str): Book name
+    best_bid (float): Best bid price
+    best_ask (float): Best ask price
+
+    Returns:
+    tuple: Row matching COLUMNS
+    '''
+    spread = float(format((best_bid/best_ask) * 100 / best_ask, '.4f'))
+    orderbook_timestamp = datetime.now(timezone.utc).strftime(TIMESTAMP_FORMAT)
+    return (orderbook_timestamp, book, best_bid, best_ask, spread)
+
+
+def read_csv_table(source, columns):
+    '''
+    Read a headerless interval CSV into a pyarrow Table with typed columns
+
+    Args:
+    source: Path or file-like object of the CSV
+    columns (list): Column names of the CSV, see columns_for
+
+    Returns:
+    pyarrow.Table: The rows, timestamp as timestamp[s, UTC] and book as string
+    '''
+    # pyarrow is only needed when typed tables are used
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+
+    timestamp = pa.timestamp("s", tz="UTC")
+    column_types = {"timestamp": timestamp, "last_timestamp": timestamp, "book": pa.string()}
+    return pa_csv.read_csv(
+        source,
+        read_options=pa_csv.ReadOptions(column_names=columns, autogenerate_column_names=columns is None),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={name: type_ for name, type_ in column_types.items() if name in (columns or [])},
+            timestamp_parsers=[TIMESTAMP_FORMAT]
+        )
+    )
+
+
+def read_parquet_table(source, columns=None):
+    '''
+    Read a Parquet interval or compacted file with the types of read_csv_table
+
+    Args:
+    source: Path, file-like object or pyarrow NativeFile of the Parquet file
+    columns (list): Columns to read, all by default
+
+    Returns:
+    pyarrow.Table: The rows, timestamp as timestamp[s, UTC]
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(source, columns=columns)
+    index = table.schema.get_field_index("timestamp")
+    if index == -1:
+        return table
+    # Parquet has no second resolution, timestamps come back in milliseconds
+    timestamp = pa.timestamp("s", tz="UTC")
+    return table.set_column(index, pa.field("timestamp", timestamp), table["timestamp"].cast(timestamp))
+
+
+class CsvFormat:
+    """Ship the interval file as the plain CSV written by the collectors"""
+
+    extension = "csv"
+    content_type = "text/csv"
+
+    def convert(self, filename, columns=None):
+        return filename
+
+    def encode(self, filename, data, columns=None):
+        """In-memory counterpart of convert, return the name and content to ship"""
+        return filename, data
+
+
+class ParquetFormat:
+    """
+    Ship the interval file as a compressed Parquet file with typed columns.
+
+    The collectors keep appending rows to a CSV staging file during the
+    interval, and the closed file is converted right before it is uploaded or
+    moved. The converted file replaces the CSV and keeps the same name with a
+    `.parquet` extension, so the Year/Month/Day/Hour partition is unchanged.
+    """
+
+    extension = "parquet"
+    content_type = "application/vnd.apache.parquet"
+
+    def __init__(self, compression="zstd"):
+        self.compression = compression
+
+    def convert(self, filename, columns=None):
+        '''
+        Convert a CSV interval file to Parquet and remove the CSV
+
+        Args:
+        filename (str): Name of the CSV file
+        columns (list): Column names of the CSV file, looked up from the filename by default
+
+        Returns:
+        str: Name of the Parquet file
+        '''
+        parquet_filename = f"{os.path.splitext(filename)[0]}.{self.extension}"
+        if filename == parquet_filename or (not os.path.exists(filename) and os.path.exists(parquet_filename)):
+            # Already converted by a previous attempt
+            return parquet_filename
+
+        # pyarrow is only needed when this format is used
+        import pyarrow.parquet as pq
+
+        table = read_csv_table(filename, columns or columns_for(filename))
+        pq.write_table(table, parquet_filename, compression=self.compression)
+        os.remove(filename)
+
+        logging.info(f"File {filename} converted to {parquet_filename} ({table.num_rows} rows, {self.compression})")
+        return parquet_filename
+
+    def encode(self, filename, data, columns=None):
+        '''
+        Convert an in-memory CSV interval to Parquet
+
+        Args:
+        filename (str): Name of the CSV interval
+        data (bytes): Content of the CSV interval
+        columns (list): Column names of the CSV, looked up from the filename by default
+
+        Returns:
+        tuple: Name and content of the Parquet file
+        '''
+        import pyarrow.parquet as pq
+
+        table = read_csv_table(io.BytesIO(data), columns or columns_for(filename))
+        buffer = io.BytesIO()
+        pq.write_table(table, buffer, compression=self.compression)
+        return f"{os.path.splitext(filename)[0]}.{self.extension}", buffer.getvalue()
+
+
+OUTPUT_FORMATS = {
+    "csv": CsvFormat(),
+    "parquet": ParquetFormat("zstd"),
+    "parquet-snappy": ParquetFormat("snappy"),
+}
+
+
+def get_output_format(name):
+    '''
+    Look up a registered output format
+
+    Args:
+    name (str): Name of the output format, see OUTPUT_FORMATS
+
+    Returns:
+    Output format with a `convert(filename)` method
+    '''
+    try:
+        return OUTPUT_FORMATS[name]
+    except KeyError:
+        raise ValueError(f"Unknown output format: {name}") from None
+
+
+def gcs_key(basename):
+    """Object name of an interval file, partitioned by Year/Month/Day/Hour without zero padding"""
+    year, month, day, hour = map(int, basename.split("_")[2].split("-")[0:4])
+    return f"{year}/{month}/{day}/{hour}/{basename}"
+
+
+def encode_buffer(interval, output_format="csv"):
+    '''
+    Name, content and headers of an in-memory interval in the output format
+
+    A gzip buffer shipped as CSV keeps its compression and is stored with
+    Content-Encoding gzip, so GCS still serves it as plain CSV.
+
+    Returns:
+    tuple: basename, data, content type and content encoding (None or "gzip")
+    '''
+    output = get_output_format(output_format)
+    if interval.compressed and output_format == "csv":
+        return os.path.basename(interval.filename), interval.data, output.content_type, "gzip"
+    filename, data = output.encode(interval.filename, interval.csv_bytes())
+    return os.path.basename(filename), data, output.content_type, None
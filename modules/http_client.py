@@ -0,0 +1,120 @@
+import logging
+import threading
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    # HTTP/2 is only available through httpx with the h2 extra installed
+    import httpx
+    import h2  # noqa: F401
+except ImportError:
+    httpx = None
+
+# Connection pool settings
+POOL_CONNECTIONS = 10  # Number of hosts with a pool
+POOL_MAXSIZE = 32  # Keep-alive connections per host
+DNS_CACHE_TTL = 300  # Seconds a resolved address is reused
+KEEPALIVE_TIMEOUT = 30  # Seconds an idle connection is kept open
+
+# Network errors worth retrying
+TRANSIENT_ERRORS = (requests.ConnectionError, requests.Timeout)
+if httpx is not None:
+    TRANSIENT_ERRORS += (httpx.TransportError,)
+ASYNC_TRANSIENT_ERRORS = (aiohttp.ClientError,)
+
+
+class HttpClient:
+    """
+    Long-lived HTTP client shared by every thread of the sync collectors.
+
+    Connections are pooled and kept alive between ticks so only the first
+    request to a host pays for the TCP connection and the TLS handshake. When
+    httpx and h2 are installed requests are sent over HTTP/2, otherwise a
+    requests.Session with a sized connection pool is used. Both return
+    responses with `status_code`, `headers`, `content` and `json()`.
+    """
+
+    def __init__(self, pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, http2=True):
+        if http2 and httpx is not None:
+            limits = httpx.Limits(
+                max_connections=pool_connections * pool_maxsize,
+                max_keepalive_connections=pool_maxsize,
+                keepalive_expiry=KEEPALIVE_TIMEOUT
+            )
+            self._client = httpx.Client(http2=True, limits=limits)
+            self.http2 = True
+        else:
+            adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+            self._client = requests.Session()
+            self._client.mount("https://", adapter)
+            self._client.mount("http://", adapter)
+            self.http2 = False
+
+    def get(self, url, **kwargs):
+        return self._client.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self._client.post(url, **kwargs)
+
+    def close(self):
+        self._client.close()
+
+
+class AsyncHttpClient:
+    """
+    Long-lived aiohttp session shared by every task of the async collectors.
+
+    The session is created lazily inside the running event loop and reuses
+    keep-alive connections with a per-host limit and a DNS cache. aiohttp only
+    speaks HTTP/1.1, so this path relies on keep-alive alone. Use it as an
+    async context manager to close the session on exit.
+    """
+
+    def __init__(self, pool_maxsize=POOL_MAXSIZE, dns_cache_ttl=DNS_CACHE_TTL):
+        self.pool_maxsize = pool_maxsize
+        self.dns_cache_ttl = dns_cache_ttl
+        self._session = None
+
+    async def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=0,
+                limit_per_host=self.pool_maxsize,
+                ttl_dns_cache=self.dns_cache_ttl,
+                keepalive_timeout=KEEPALIVE_TIMEOUT
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def __aenter__(self):
+        return await self.session()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+
+_http_client = None
+_http_client_lock = threading.Lock()
+async_http_client = AsyncHttpClient()
+
+
+def get_http_client():
+    '''
+    Return the HTTP client shared by the whole process, creating it on first use
+
+    Returns:
+    HttpClient: Shared HTTP client
+    '''
+    global _http_client
+    if _http_client is None:
+        with _http_client_lock:
+            if _http_client is None:
+                _http_client = HttpClient()
+                logging.info(f"HTTP client ready (HTTP/2: {_http_client.http2})")
+    return _http_client
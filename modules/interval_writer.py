@@ -0,0 +1,296 @@
+import io
+import csv
+import gzip
+import time
+import asyncio
+import os
+import logging
+import threading
+from modules.metrics import stage, ROWS_WRITTEN, BYTES_WRITTEN, ROWS_DEDUPLICATED
+from modules.formats import columns_for, stream_of
+from modules.sinks import row_sinks, publish
+
+# Flush policy, whichever comes first
+FLUSH_ROWS = 60
+FLUSH_INTERVAL = 10  # seconds
+
+# Dedup of unchanged top-of-book samples: "changes" records a row only when bid, ask or
+# spread change, "rle" collapses runs of unchanged samples into one row of the rle stream
+DEDUP_MODES = ("changes", "rle")
+HEARTBEAT = 60  # seconds, an unchanged book still gets a row this often to prove liveness
+
+
+# Diskless intervals: "memory" keeps the CSV in memory, "gzip" keeps it gzip compressed
+BUFFER_MODES = ("memory", "gzip")
+MAX_BUFFER_BYTES = 4 * 1024 * 1024  # Per writer, a larger interval spills to its file
+
+
+def rle_filename(filename):
+    """Name of the run-length encoded file replacing an interval file"""
+    return f"{os.path.splitext(filename)[0]}.rle.csv"
+
+
+class IntervalWriter:
+    """
+    Owns the open CSV file of the current interval and buffers rows in memory.
+
+    Rows are appended to an in-memory buffer and written to the file once
+    `flush_rows` rows are pending or `flush_interval` seconds have passed since
+    the last flush. The file handle stays open for the whole interval and is
+    closed by `close()`, which returns the filename ready to be handed to
+    `store_data`. The file is only created when the first rows are flushed.
+
+    With `dedup` set, unchanged top-of-book samples are dropped ("changes") or
+    collapsed into runs written to the `.rle.csv` file of the interval
+    ("rle"), and a row is still recorded every `heartbeat` seconds.
+
+    With `buffer` set the interval never touches the disk: rows are flushed
+    to an in-memory buffer, gzip compressed with "gzip", and `close()` returns
+    an IntervalBuffer for the upload pipeline instead of a filename. An
+    interval growing past `max_buffer` bytes spills to its file.
+    """
+
+    def __init__(self, filename=None, flush_rows=FLUSH_ROWS, flush_interval=FLUSH_INTERVAL, dedup=None,
+                 heartbeat=HEARTBEAT, buffer=None, max_buffer=MAX_BUFFER_BYTES):
+        if dedup is not None and dedup not in DEDUP_MODES:
+            raise ValueError(f"Unknown dedup mode: {dedup}")
+        if buffer is not None and buffer not in BUFFER_MODES:
+            raise ValueError(f"Unknown buffer mode: {buffer}")
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.dedup = dedup
+        self.heartbeat = heartbeat
+        self.buffer = buffer
+        self.max_buffer = max_buffer
+        self.filename = None
+        self.book = None
+        self.stream = None
+        self.columns = None
+        self._file = None
+        self._csv_writer = None
+        self._memory = None  # In-memory interval, the raw bytes under the gzip stream if any
+        self._stream = None
+        self._rows = []
+        self._run = None  # Last recorded sample, or the open run in rle mode
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+        if filename:
+            self.open(filename)
+
+    def open(self, filename):
+        '''
+        Start a new interval file, closing the current one first
+
+        Args:
+        filename (str): Name of the file of the new interval
+        '''
+        self._close()
+        self.filename = rle_filename(filename) if self.dedup == "rle" else filename
+        # Interval files are named {book}_{interval start}.csv
+        self.book = os.path.basename(filename).rsplit("_", 1)[0]
+        self.stream = stream_of(self.filename)
+        self.columns = columns_for(self.filename)
+        self._last_flush = time.monotonic()
+
+    def write(self, data_tuple):
+        '''
+        Buffer one row and flush it if the policy says so
+
+        Args:
+        data_tuple (tuple): Tuple with the data to be saved
+        '''
+        rows = self._dedup(data_tuple) if self.dedup else (data_tuple,)
+        with self._lock:
+            self._rows.extend(rows)
+        if row_sinks and rows:
+            publish(self.stream, self.columns, rows)
+        if self.should_flush():
+            self.flush()
+
+    def _dedup(self, data_tuple):
+        '''
+        Rows to record for one top-of-book sample in the dedup mode
+
+        Args:
+        data_tuple (tuple): Row matching formats.COLUMNS
+
+        Returns:
+        tuple: The rows to buffer, empty when the sample only extends what is already recorded
+        '''
+        prices = data_tuple[2:]
+        now = time.monotonic()
+        run = self._run
+        if self.dedup == "changes":
+            if run and run[0][2:] == prices and now - run[1] < self.heartbeat:
+                ROWS_DEDUPLICATED.labels(self.book).inc()
+                return ()
+            self._run = (data_tuple, now)
+            return (data_tuple,)
+
+        # Runs are [first sample, last timestamp, count, started at]
+        if run and run[0][2:] == prices and now - run[3] < self.heartbeat:
+            run[1] = data_tuple[0]
+            run[2] += 1
+            ROWS_DEDUPLICATED.labels(self.book).inc()
+            return ()
+        self._run = [data_tuple, data_tuple[0], 1, now]
+        return (rle_row(run),) if run else ()
+
+    def should_flush(self):
+        return len(self._rows) >= self.flush_rows or time.monotonic() - self._last_flush >= self.flush_interval
+
+    def flush(self):
+        with self._lock:
+            rows, self._rows = self._rows, []
+            self._last_flush = time.monotonic()
+            if not rows:
+                return
+
+            with stage("write"):
+                if self.buffer and self._file is None:
+                    written = self._write_memory(rows)
+                else:
+                    if self._file is None:
+                        self._file = open(self.filename, "a", newline='')
+                        self._csv_writer = csv.writer(self._file)
+
+                    start = self._file.tell()
+                    self._csv_writer.writerows(rows)
+                    self._file.flush()
+                    written = self._file.tell() - start
+        ROWS_WRITTEN.labels(self.book).inc(len(rows))
+        BYTES_WRITTEN.labels(self.book).inc(written)
+        logging.debug(f"{len(rows)} rows flushed to {self.filename}")
+
+    def _write_memory(self, rows):
+        """Append rows to the in-memory interval, spill it to its file past max_buffer, return the bytes written"""
+        text = io.StringIO()
+        csv.writer(text).writerows(rows)
+        data = text.getvalue().encode()
+        if self._memory is None:
+            self._memory = io.BytesIO()
+            self._stream = gzip.GzipFile(fileobj=self._memory, mode="wb", mtime=0) if self.buffer == "gzip" else self._memory
+        self._stream.write(data)
+
+        if self._memory.tell() > self.max_buffer:
+            logging.warning(f"{self.filename} outgrew its {self.max_buffer} bytes buffer, spilling it to disk")
+            self._file = open(self.filename, "a", newline='')
+            self._csv_writer = csv.writer(self._file)
+            self._file.write(self._take_memory().csv_bytes().decode())
+            self._file.flush()
+        return len(data)
+
+    def _take_memory(self):
+        """Finish the in-memory interval and hand it over as an IntervalBuffer"""
+        if self._stream is not self._memory:
+            self._stream.close()
+        interval = IntervalBuffer(self.filename, self._memory.getvalue(), self.buffer == "gzip")
+        self._memory = self._stream = None
+        return interval
+
+    def close(self):
+        '''
+        Flush pending rows and close the file of the current interval
+
+        Returns:
+        str: Name of the closed file, an IntervalBuffer in buffer mode, None if no rows were written
+        '''
+        return self._close()
+
+    def _close(self):
+        run, self._run = self._run, None
+        if self.dedup == "rle" and run:
+            with self._lock:
+                self._rows.append(rle_row(run))
+        self.flush()
+        with self._lock:
+            if self._memory is not None:
+                interval = self._take_memory()
+                logging.info(f"Data of {self.filename} kept in memory ({len(interval.data)} bytes)")
+                return interval
+            if self._file is None:
+                return None
+            self._file.close()
+            self._file = None
+            self._csv_writer = None
+        logging.info(f"Data saved to {self.filename}")
+        return self.filename
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._close()
+
+
+class IntervalBuffer:
+    """
+    Closed interval built in memory by a diskless IntervalWriter.
+
+    Stands in for the interval file in the upload pipeline and the store
+    functions, and is only written to disk by `spill` when it can't be
+    uploaded.
+
+    Args:
+    filename (str): Name the interval file would have had
+    data (bytes): The CSV rows, gzip compressed when `compressed`
+    compressed (bool): Whether `data` is gzip compressed
+    """
+
+    def __init__(self, filename, data, compressed=False):
+        self.filename = filename
+        self.data = data
+        self.compressed = compressed
+
+    def __repr__(self):
+        return f"IntervalBuffer({self.filename!r}, {len(self.data)} bytes)"
+
+    def csv_bytes(self):
+        """The uncompressed CSV rows"""
+        return gzip.decompress(self.data) if self.compressed else self.data
+
+    def spill(self, directory):
+        '''
+        Write the interval as a plain CSV file, e.g. to the pending directory after a failed upload
+
+        Args:
+        directory (str): Directory of the file
+
+        Returns:
+        str: Path of the file
+        '''
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, os.path.basename(self.filename))
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(self.csv_bytes())
+        os.replace(f"{path}.tmp", path)
+        logging.info(f"Interval {self.filename} spilled to {path}")
+        return path
+
+
+def rle_row(run):
+    """Row of the rle stream for a run, matching formats.STREAM_COLUMNS["rle"]"""
+    first, last_timestamp, count = run[:3]
+    return (*first, last_timestamp, count)
+
+
+class AsyncIntervalWriter(IntervalWriter):
+    """
+    IntervalWriter for asyncio collectors.
+
+    Buffering a row never leaves the event loop, only flushes and closes are
+    sent to a worker thread.
+    """
+
+    async def write(self, data_tuple):
+        rows = self._dedup(data_tuple) if self.dedup else (data_tuple,)
+        with self._lock:
+            self._rows.extend(rows)
+        if row_sinks and rows:
+            publish(self.stream, self.columns, rows)
+        if self.should_flush():
+            await asyncio.to_thread(self.flush)
+
+    async def close(self):
+        return await asyncio.to_thread(self._close)
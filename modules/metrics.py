@@ -0,0 +1,263 @@
+import os
+import time
+import bisect
+import logging
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Constants
+METRICS_PORT = 9108  # Port of the Prometheus endpoint
+DUMP_INTERVAL = 60  # seconds between metric dumps to a file
+# Seconds, from signing a request (tens of microseconds) to an upload (seconds)
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Per-tick INFO lines cost time on the hot path, they are only logged with LOG_TICKS=1
+LOG_TICKS = os.getenv("LOG_TICKS") == "1"
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at)
+
+
+class Metric(ABC):
+    """
+    A named metric with one child per combination of label values.
+
+    `labels(*values)` returns the child to update, children are created on
+    first use and cached, so the hot path only pays a dict lookup and a lock.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def _new_child(self):
+        """New child holding the value of one combination of label values"""
+
+    @abstractmethod
+    def _render_child(self, values, child):
+        """Exposition lines of one child"""
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _render_child(self, values, child):
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {child.value}"]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def _render_child(self, values, child):
+        with child._lock:
+            counts, total = list(child.counts), child.sum
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(float(bound))
+            labels = _format_labels(self.labelnames, values, f'le="{le}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Metrics of the process, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# Hot-path stages: sign, http, decode, process, write, upload
+STAGE_SECONDS = registry.register(Histogram(
+    "bitso_stage_seconds", "Time spent in each stage of the collection hot path", ["stage"]))
+TICKS = registry.register(Counter("bitso_ticks_total", "Ticks fired per clock", ["clock"]))
+LATE_TICKS = registry.register(Counter("bitso_late_ticks_total", "Ticks fired past the late threshold", ["clock"]))
+MISSED_TICKS = registry.register(Counter("bitso_missed_ticks_total", "Tick deadlines skipped", ["clock"]))
+REQUEST_EVENTS = registry.register(Counter(
+    "bitso_request_events_total", "Requests, retries, hedges, timeouts and failures per book", ["book", "event"]))
+SKIPPED_TICKS = registry.register(Counter(
+    "bitso_skipped_ticks_total", "Ticks that produced no row per book", ["book", "reason"]))
+ROWS_WRITTEN = registry.register(Counter("bitso_rows_written_total", "Rows written per book", ["book"]))
+BYTES_WRITTEN = registry.register(Counter("bitso_bytes_written_total", "Bytes written per book", ["book"]))
+ROWS_DEDUPLICATED = registry.register(Counter(
+    "bitso_rows_deduplicated_total", "Unchanged samples not written as rows, per book", ["book"]))
+CREDENTIAL_EVENTS = registry.register(Counter(
+    "bitso_credential_events_total", "Requests, rejections and rate limits per API key", ["key", "event"]))
+UPLOADS = registry.register(Counter("bitso_uploads_total", "Upload attempts by result", ["result"]))
+SINK_ROWS = registry.register(Counter("bitso_sink_rows_total", "Rows handed to the row sinks by result", ["sink", "result"]))
+
+
+def stage(name):
+    '''
+    Time a stage of the hot path into bitso_stage_seconds
+
+    Args:
+    name (str): Stage name, e.g. "sign" or "http"
+
+    Returns:
+    Context manager measuring the time spent inside it
+    '''
+    return STAGE_SECONDS.labels(name).time()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port=METRICS_PORT, host="localhost"):
+    '''
+    Serve the metrics on http://host:port/metrics from a daemon thread
+
+    Args:
+    port (int): Port to listen on
+    host (str): Interface to listen on, "" for all of them
+
+    Returns:
+    ThreadingHTTPServer: The running server, None if the port is taken
+    '''
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        logging.error(f"Metrics endpoint not started on port {port}: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"Metrics available on http://{host or '0.0.0.0'}:{server.server_port}/metrics")
+    return server
+
+
+def dump_metrics(path):
+    """Write the current metrics to `path`, replacing it atomically"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(registry.render())
+    os.replace(tmp_path, path)
+
+
+def start_metrics_dump(path, interval=DUMP_INTERVAL):
+    '''
+    Dump the metrics to a file every `interval` seconds from a daemon thread
+
+    Args:
+    path (str): File rewritten with the Prometheus text format
+    interval (float): Seconds between dumps
+    '''
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                dump_metrics(path)
+            except OSError as e:
+                logging.error(f"Could not dump metrics to {path}: {e}")
+
+    threading.Thread(target=loop, name="metrics-dump", daemon=True).start()
+
+
+def start_metrics(port=METRICS_PORT, dump_file=None):
+    '''
+    Start the metrics endpoint, and the periodic dumps when `dump_file` is set
+
+    Args:
+    port (int): Port of the endpoint, None disables it
+    dump_file (str): File the metrics are dumped to every DUMP_INTERVAL seconds
+    '''
+    if port is not None:
+        start_metrics_server(port)
+    if dump_file:
+        start_metrics_dump(dump_file)
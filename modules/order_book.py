@@ -0,0 +1,91 @@
+import bisect
+
+# Side of an order in Bitso's diff-orders messages
+BUY = 0
+SELL = 1
+
+
+class LocalOrderBook:
+    """
+    In-memory order book of one book, maintained from Bitso's diff-orders channel.
+
+    Orders are tracked by id so updates and cancellations can be applied, and
+    every price level keeps its total amount and order count. Level prices are
+    kept sorted, so the best bid and ask are read in O(1) and a level is
+    inserted or removed with a binary search.
+    """
+
+    def __init__(self, book):
+        self.book = book
+        self.sequence = None
+        self._orders = {}  # oid -> (side, price, amount)
+        self._levels = ({}, {})  # per side: price -> [amount, order count]
+        self._prices = ([], [])  # per side: sorted level prices
+
+    def load_snapshot(self, payload):
+        '''
+        Reset the book from an unaggregated REST order_book payload
+
+        Args:
+        payload (dict): Payload of /order_book?aggregate=false
+        '''
+        self.__init__(self.book)
+        for side, key in ((BUY, 'bids'), (SELL, 'asks')):
+            for order in payload[key]:
+                self._add(order['oid'], side, float(order['price']), float(order['amount']))
+        self.sequence = int(payload['sequence'])
+
+    def apply(self, sequence, orders):
+        '''
+        Apply the orders of one diff-orders message
+
+        Args:
+        sequence (int): Sequence number of the message
+        orders (list): Payload of the message
+        '''
+        for order in orders:
+            oid = order['o']
+            self._remove(oid)
+            amount = float(order.get('a') or 0)
+            if order.get('s', 'open') == 'open' and amount > 0:
+                self._add(oid, int(order['t']), float(order['r']), amount)
+        self.sequence = sequence
+
+    def _add(self, oid, side, price, amount):
+        self._orders[oid] = (side, price, amount)
+        level = self._levels[side].get(price)
+        if level is None:
+            self._levels[side][price] = [amount, 1]
+            bisect.insort(self._prices[side], price)
+        else:
+            level[0] += amount
+            level[1] += 1
+
+    def _remove(self, oid):
+        order = self._orders.pop(oid, None)
+        if order is None:
+            return
+        side, price, amount = order
+        level = self._levels[side][price]
+        level[0] -= amount
+        level[1] -= 1
+        if level[1] == 0:
+            del self._levels[side][price]
+            prices = self._prices[side]
+            del prices[bisect.bisect_left(prices, price)]
+
+    @property
+    def best_bid(self):
+        prices = self._prices[BUY]
+        return prices[-1] if prices else None
+
+    @property
+    def best_ask(self):
+        prices = self._prices[SELL]
+        return prices[0] if prices else None
+
+    def levels(self, side, n=None):
+        """(price, amount) of the first n levels of a side, best price first"""
+        prices = self._prices[side]
+        prices = prices[::-1] if side == BUY else prices
+        return [(price, self._levels[side][price][0]) for price in prices[:n]]
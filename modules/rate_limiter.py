@@ -0,0 +1,230 @@
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+import threading
+import multiprocessing
+
+# Bitso allows 60 requests per minute per API key
+REQUESTS_PER_MINUTE = 60
+BURST = 5
+DEFAULT_PRIORITY = 1
+DEFAULT_RETRY_AFTER = 60
+
+# Slots of the bucket state
+TOKENS, UPDATED_AT, PAUSED_UNTIL = range(3)
+
+
+class RateLimiter:
+    """
+    Token bucket that hands out one shared request budget to every collector.
+
+    Tokens refill continuously at requests_per_minute / 60 per second up to
+    `burst`. When several books are waiting for a token the one with the
+    highest priority is served first (FIFO among equal priorities). The bucket
+    follows the server as well: rate-limit headers clamp the local token count
+    and a 429 pauses every caller until the server's window resets.
+
+    The same instance can be used from threads (`acquire`) and from asyncio
+    tasks (`acquire_async`). Processes share one budget by calling `share`
+    with the same `shared_budget()`; priorities then only order the waiters
+    of each process.
+    """
+
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, burst=BURST, priorities=None):
+        self.rate = requests_per_minute / 60
+        self.burst = burst
+        self.priorities = dict(priorities or {})
+        # Bucket state: tokens, last refill and end of the server pause (monotonic seconds)
+        self._bucket = [float(burst), time.monotonic(), 0.0]
+        self._waiters = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def share(self, budget):
+        '''
+        Draw tokens from a budget shared with other processes
+
+        Call it before the limiter is used, e.g. at the start of a worker process.
+
+        Args:
+        budget (multiprocessing.Array): Bucket state created by `shared_budget`
+        '''
+        self._bucket = budget
+        self._lock = budget.get_lock()
+
+    def set_priority(self, book, priority):
+        '''
+        Set the priority of a book, higher values are served first
+
+        Args:
+        book (str): Book name
+        priority (int): Priority of the book
+        '''
+        with self._lock:
+            self.priorities[book] = priority
+
+    def headroom(self):
+        """Tokens available now, or minus the seconds left while the server pause lasts"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self._bucket[PAUSED_UNTIL]:
+                return now - self._bucket[PAUSED_UNTIL]
+            return self._bucket[TOKENS]
+
+    def _refill(self, now):
+        elapsed = now - self._bucket[UPDATED_AT]
+        self._bucket[TOKENS] = min(self.burst, self._bucket[TOKENS] + elapsed * self.rate)
+        self._bucket[UPDATED_AT] = now
+
+    def _enqueue(self, book):
+        with self._lock:
+            ticket = (-self.priorities.get(book, DEFAULT_PRIORITY), next(self._counter))
+            heapq.heappush(self._waiters, ticket)
+        return ticket
+
+    def _dequeue(self, ticket):
+        with self._lock:
+            if ticket in self._waiters:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+
+    def _try_take(self, ticket):
+        """Take a token for `ticket`, return 0 on success or the seconds to wait before retrying"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+
+            if now < self._bucket[PAUSED_UNTIL]:
+                return self._bucket[PAUSED_UNTIL] - now
+
+            if self._waiters[0] == ticket and self._bucket[TOKENS] >= 1:
+                heapq.heappop(self._waiters)
+                self._bucket[TOKENS] -= 1
+                return 0
+
+            return max((1 - self._bucket[TOKENS]) / self.rate, 0.001)
+
+    def acquire(self, book, timeout=None):
+        '''
+        Block until a request token is available for the book
+
+        Args:
+        book (str): Book the request is made for
+        timeout (float): Maximum seconds to wait, None waits forever
+
+        Returns:
+        bool: True if a token was taken, False if the timeout expired
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        ticket = self._enqueue(book)
+        try:
+            while True:
+                wait = self._try_take(ticket)
+                if wait == 0:
+                    return True
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    wait = min(wait, remaining)
+                time.sleep(wait)
+        finally:
+            self._dequeue(ticket)
+
+    async def acquire_async(self, book, timeout=None):
+        '''
+        Wait without blocking the event loop until a request token is available
+
+        Args:
+        book (str): Book the request is made for
+        timeout (float): Maximum seconds to wait, None waits forever
+
+        Returns:
+        bool: True if a token was taken, False if the timeout expired
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        ticket = self._enqueue(book)
+        try:
+            while True:
+                wait = self._try_take(ticket)
+                if wait == 0:
+                    return True
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    wait = min(wait, remaining)
+                await asyncio.sleep(wait)
+        finally:
+            self._dequeue(ticket)
+
+    def update_from_response(self, status_code, headers):
+        '''
+        Adjust the bucket to the rate-limit information returned by the server
+
+        Args:
+        status_code (int): HTTP status code of the response
+        headers (Mapping): Case-insensitive response headers
+        '''
+        remaining = _header_number(headers, "X-RateLimit-Remaining")
+        reset = _header_number(headers, "X-RateLimit-Reset")
+        retry_after = _header_number(headers, "Retry-After")
+
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+
+            if remaining is not None:
+                self._bucket[TOKENS] = min(self._bucket[TOKENS], remaining)
+
+            pause = None
+            if status_code == 429:
+                pause = retry_after or _seconds_until(reset) or DEFAULT_RETRY_AFTER
+            elif remaining is not None and remaining < 1 and reset is not None:
+                pause = _seconds_until(reset)
+
+            if pause:
+                self._bucket[TOKENS] = 0
+                self._bucket[PAUSED_UNTIL] = max(self._bucket[PAUSED_UNTIL], now + pause)
+
+        if status_code == 429:
+            logging.warning(f"Rate limited by the server, pausing requests for {pause:.1f}s")
+
+
+def _header_number(headers, name):
+    value = headers.get(name) if headers else None
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _seconds_until(reset):
+    """Rate-limit reset headers are either an epoch timestamp or a number of seconds"""
+    if reset is None:
+        return None
+    if reset > 1e9:
+        return max(reset - time.time(), 0)
+    return reset
+
+
+def shared_budget(burst=BURST):
+    '''
+    Create bucket state that worker processes can share through `RateLimiter.share`
+
+    The monotonic clock is system-wide, so the refill and pause times stored
+    here mean the same in every process.
+
+    Returns:
+    multiprocessing.Array: Shared bucket state, guarded by its own lock
+    '''
+    return multiprocessing.Array("d", [float(burst), time.monotonic(), 0.0])
+
+
+# Shared by every collector in the process
+rate_limiter = RateLimiter()
@@ -0,0 +1,306 @@
+"""
+Read stored samples back by book and time range.
+
+Only the hour partitions overlapping the range are listed, only the files of
+the requested books are read, and the manifests written by the compaction
+prune compacted files by their time bounds. Local files are memory mapped,
+GCS objects are fetched in parallel, large ones with parallel ranged reads.
+
+    from datetime import datetime, timedelta, timezone
+    from modules.reader import read_arrays
+
+    end = datetime.now(timezone.utc)
+    spread = read_arrays(["btc_mxn"], end - timedelta(hours=3), end, columns=["timestamp", "spread"])
+"""
+import io
+import json
+import logging
+from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from modules.formats import columns_for, read_csv_table, read_parquet_table
+from modules.storage import LocalStorage, get_storage, MANIFEST_NAME
+from modules.compaction import parse_name, ALL_BOOKS
+from modules.interval_writer import HEARTBEAT
+
+# Constants
+READ_WORKERS = 8  # Files read in parallel
+RANGE_SIZE = 8 * 1024 * 1024  # Objects larger than this are fetched in parallel ranges
+RANGE_WORKERS = 4
+
+
+def utc(moment):
+    """Naive datetimes are taken as UTC"""
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+def hours_between(start, end):
+    '''
+    Start of every hour overlapping [start, end)
+
+    Args:
+    start (datetime): Start of the range, inclusive
+    end (datetime): End of the range, exclusive
+
+    Returns:
+    list: Hour starts, oldest first
+    '''
+    hour = start.replace(minute=0, second=0, microsecond=0)
+    hours = []
+    while hour < end:
+        hours.append(hour)
+        hour += timedelta(hours=1)
+    return hours
+
+
+def select_files(storage, books, start, end, stream=""):
+    '''
+    Keys of the files that may hold rows of `books` in [start, end)
+
+    Interval files are pruned by book and by the start in their name, files
+    compacted across books are always kept. In the first and last hour of the
+    range the manifest, when there is one, prunes compacted files by their
+    time bounds.
+
+    Args:
+    storage: LocalStorage or GcsStorage holding the partitions
+    books (list): Books to read, None for all of them
+    start (datetime): Start of the range, inclusive
+    end (datetime): End of the range, exclusive
+    stream (str): "" for top of book, or the name of an extra stream such as "depth"
+
+    Returns:
+    list: (hour, key, size) tuples, oldest hour first
+    '''
+    selected = []
+    for hour in hours_between(start, end):
+        sizes = storage.sizes(storage.partition(hour))
+        partial = hour < start or hour + timedelta(hours=1) > end
+        bounds = read_bounds(storage, hour) if partial and any(key.endswith(MANIFEST_NAME) for key in sizes) else {}
+
+        for key, size in sizes.items():
+            info = parse_name(key)
+            if not info or info["stream"] != stream:
+                continue
+            if books is not None and info["book"] not in books and info["book"] != ALL_BOOKS:
+                continue
+            name = key.rsplit("/", 1)[-1]
+            if not info["compacted"] and key_start(name) >= end:
+                continue
+            if name in bounds:
+                first, last = bounds[name]
+                if last < start or first >= end:
+                    continue
+            selected.append((hour, key, size))
+    return selected
+
+
+def key_start(name):
+    """Start of the interval in an interval file name"""
+    stamp = name[len(parse_name(name)["book"]) + 1:][:19]
+    return datetime.strptime(stamp, "%Y-%m-%d-%H-%M-%S").replace(tzinfo=timezone.utc)
+
+
+def read_bounds(storage, hour):
+    """First and last timestamp of each compacted file of a partition, from its manifest"""
+    try:
+        manifest = json.loads(storage.read(f"{storage.partition(hour)}/{MANIFEST_NAME}"))
+    except Exception as e:
+        logging.warning(f"Ignoring the manifest of {storage.partition(hour)}: {e}")
+        return {}
+    bounds = {}
+    for entry in manifest.get("files", []):
+        if entry["books"]:
+            first = min(datetime.fromisoformat(stats["start"]) for stats in entry["books"].values())
+            last = max(datetime.fromisoformat(stats["end"]) for stats in entry["books"].values())
+            bounds[entry["name"]] = (first, last)
+    return bounds
+
+
+def fetch(storage, key, size):
+    '''
+    Source of a file for the table readers
+
+    Local files are memory mapped. Remote objects are downloaded, in parallel
+    ranges of RANGE_SIZE bytes when they are larger than that.
+
+    Returns:
+    A pyarrow NativeFile or a BytesIO
+    '''
+    if isinstance(storage, LocalStorage):
+        import pyarrow as pa
+        return pa.memory_map(storage.path(key))
+    if size <= RANGE_SIZE:
+        return io.BytesIO(storage.read(key))
+    ranges = [(offset, min(offset + RANGE_SIZE, size)) for offset in range(0, size, RANGE_SIZE)]
+    with ThreadPoolExecutor(max_workers=RANGE_WORKERS) as executor:
+        parts = executor.map(lambda bounds: storage.read_range(key, *bounds), ranges)
+        return io.BytesIO(b"".join(parts))
+
+
+def load(storage, key, size, books, start, end, columns=None):
+    '''
+    Read one file and keep the rows of `books` in [start, end)
+
+    Returns:
+    pyarrow.Table: The matching rows, with `columns` only when given
+    '''
+    import pyarrow.compute as pc
+
+    source = fetch(storage, key, size)
+    if key.endswith(".parquet"):
+        needed = None if columns is None else sorted(set(columns) | {"timestamp", "book"})
+        table = read_parquet_table(source, needed)
+    else:
+        table = read_csv_table(source, columns_for(key))
+
+    mask = pc.and_(pc.greater_equal(table["timestamp"], start), pc.less(table["timestamp"], end))
+    if books is not None:
+        mask = pc.and_(mask, pc.is_in(table["book"], value_set=pc.cast(books, table["book"].type)))
+    table = table.filter(mask)
+    return table.select(columns) if columns is not None else table
+
+
+def iter_tables(books, start, end, storage=None, columns=None, stream="", workers=READ_WORKERS):
+    '''
+    Tables of the matching rows, one per hour, oldest first
+
+    The files of an hour are read in parallel, only one hour is held in
+    memory at a time.
+
+    Args:
+    books (list): Books to read, None for all of them
+    start (datetime): Start of the range, inclusive, naive means UTC
+    end (datetime): End of the range, exclusive, naive means UTC
+    storage: A backend of modules.storage, the local data/ directory by default
+    columns (list): Columns to return, all by default
+    stream (str): "" for top of book, or the name of an extra stream such as "depth"
+    workers (int): Files read in parallel
+
+    Yields:
+    pyarrow.Table: Rows of one hour sorted by timestamp and book
+    '''
+    import pyarrow as pa
+
+    storage = storage or get_storage("local")
+    start, end = utc(start), utc(end)
+    books = None if books is None else list(books)
+    files = select_files(storage, books, start, end, stream)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for hour in sorted({hour for hour, _, _ in files}):
+            tables = list(executor.map(
+                lambda file: load(storage, file[1], file[2], books, start, end, columns),
+                [file for file in files if file[0] == hour]
+            ))
+            table = pa.concat_tables(tables, promote_options="permissive")
+            keys = [(name, "ascending") for name in ("timestamp", "book") if name in table.column_names]
+            yield table.sort_by(keys) if keys else table
+
+
+def read_table(books, start, end, storage=None, columns=None, stream="", workers=READ_WORKERS):
+    '''
+    All the matching rows as a single Arrow table, see iter_tables for the arguments
+
+    Returns:
+    pyarrow.Table: Rows sorted by timestamp and book, None if nothing matched
+    '''
+    import pyarrow as pa
+
+    tables = list(iter_tables(books, start, end, storage, columns, stream, workers))
+    return pa.concat_tables(tables, promote_options="permissive") if tables else None
+
+
+def read_arrays(books, start, end, storage=None, columns=None, stream="", workers=READ_WORKERS):
+    '''
+    The matching rows as NumPy arrays, see iter_tables for the arguments
+
+    Returns:
+    dict: One array per column, timestamps as datetime64[s], empty if nothing matched
+    '''
+    table = read_table(books, start, end, storage, columns, stream, workers)
+    if table is None:
+        return {}
+    return {name: table[name].to_numpy() for name in table.column_names}
+
+
+def iter_rows(books, start, end, storage=None, columns=None, stream="", workers=READ_WORKERS):
+    '''
+    Stream the matching rows one at a time, see iter_tables for the arguments
+
+    Yields:
+    tuple: One row, in timestamp and book order
+    '''
+    for table in iter_tables(books, start, end, storage, columns, stream, workers):
+        names = table.column_names
+        for batch in table.to_batches():
+            yield from zip(*(batch.column(name).to_pylist() for name in names))
+
+
+def to_grid(table, start, end, step=1, max_gap=HEARTBEAT):
+    '''
+    Re-expand top-of-book rows onto a regular time grid
+
+    Each grid point takes the last row of its book at or before it. Rows of
+    the rle stream hold until their `last_timestamp`, other rows, deduplicated
+    or not, for up to `max_gap` seconds, so a book that stopped reporting for
+    longer than the heartbeat shows up as missing points instead of a stale
+    price. Shorter gaps are filled with the last price.
+
+    Args:
+    table (pyarrow.Table): Top-of-book rows, with or without the rle columns
+    start (datetime): First grid point, rounded up to `step`
+    end (datetime): End of the grid, exclusive
+    step (int): Seconds between grid points
+    max_gap (int): Seconds a row without `last_timestamp` stays valid, the heartbeat of the writers
+
+    Returns:
+    pyarrow.Table: timestamp, book, bid, ask and spread on the grid, sorted by timestamp and book
+    '''
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    first = -(-int(utc(start).timestamp()) // step) * step
+    grid = np.arange(first, int(utc(end).timestamp()), step, dtype=np.int64)
+    tables = []
+    for book in sorted(pc.unique(table["book"]).to_pylist()):
+        rows = table.filter(pc.equal(table["book"], book)).sort_by("timestamp")
+        seconds = rows["timestamp"].cast(pa.int64()).to_numpy()
+        valid_until = seconds + max_gap - 1
+        if "last_timestamp" in rows.column_names:
+            last = rows["last_timestamp"].cast(pa.int64()).to_numpy(zero_copy_only=False)
+            runs = ~pc.is_null(rows["last_timestamp"]).to_numpy(zero_copy_only=False)
+            valid_until = np.where(runs, last, valid_until)
+
+        index = np.searchsorted(seconds, grid, side="right") - 1
+        found = index >= 0
+        found[found] = grid[found] <= valid_until[index[found]]
+        index = index[found]
+        tables.append(pa.table({
+            "timestamp": pa.array(grid[found], pa.int64()).cast(pa.timestamp("s", tz="UTC")),
+            "book": pa.array([book] * len(index), pa.string()),
+            **{name: rows[name].take(pa.array(index)) for name in ("bid", "ask", "spread")},
+        }))
+    if not tables:
+        return None
+    return pa.concat_tables(tables).sort_by([("timestamp", "ascending"), ("book", "ascending")])
+
+
+def read_grid(books, start, end, storage=None, step=1, max_gap=HEARTBEAT, workers=READ_WORKERS):
+    '''
+    Top of book of `books` on a regular grid, from raw, change-only or rle files
+
+    Reads `max_gap` seconds before `start` so the first grid points see the
+    row or run that was current then. See to_grid for the arguments.
+
+    Returns:
+    pyarrow.Table: timestamp, book, bid, ask and spread on the grid, None if nothing matched
+    '''
+    import pyarrow as pa
+
+    lookback = utc(start) - timedelta(seconds=max_gap)
+    tables = [read_table(books, lookback, end, storage, None, stream, workers) for stream in ("", "rle")]
+    tables = [table for table in tables if table is not None]
+    if not tables:
+        return None
+    return to_grid(pa.concat_tables(tables, promote_options="permissive"), start, end, step, max_gap)
@@ -0,0 +1,275 @@
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from modules.scheduler import TICK_PERIOD
+from modules.rate_limiter import rate_limiter
+from modules.http_client import TRANSIENT_ERRORS, ASYNC_TRANSIENT_ERRORS
+from modules.metrics import REQUEST_EVENTS
+
+# Constants
+DEADLINE = 0.8 * TICK_PERIOD  # Budget of one request, retries and hedges included
+MAX_RETRIES = 2
+BACKOFF_BASE = 0.05  # seconds
+BACKOFF_CAP = 0.25  # seconds
+HEDGE_QUANTILE = 0.95
+HEDGE_MIN_SAMPLES = 20  # Latencies needed before hedging starts
+LATENCY_WINDOW = 200
+HEDGE_WORKERS = 16  # Threads sending the requests of the sync path, at least one per concurrent caller
+TRANSIENT_STATUS = {500, 502, 503, 504}
+
+
+class TransientStatusError(Exception):
+    """Server error worth retrying"""
+
+    def __init__(self, status):
+        super().__init__(f"Transient HTTP status {status}")
+        self.status = status
+
+
+class LatencyTracker:
+    """Recent request latencies, used to pick the hedging threshold"""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, q):
+        with self._lock:
+            if len(self._samples) < HEDGE_MIN_SAMPLES:
+                return None
+            samples = sorted(self._samples)
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+class RequestPolicy:
+    """
+    Deadline, retry and hedging policy shared by the request paths.
+
+    Every request gets `deadline` seconds, retries included, so a stalled
+    connection can never hold a collector past its tick. Transient errors are
+    retried up to `retries` times with full-jitter exponential backoff, each
+    retry taking a token from the rate limiter like the first request. When
+    hedging is on, a request still pending after the recent p95 latency gets a
+    second identical request, if the rate limiter has a token to spare, and
+    whichever answers first wins. `stats` counts how often each of these
+    triggers, per book.
+    """
+
+    def __init__(self, deadline=DEADLINE, retries=MAX_RETRIES, hedge=True, limiter=rate_limiter,
+                 hedge_workers=HEDGE_WORKERS):
+        self.deadline = deadline
+        self.retries = retries
+        self.hedge = hedge
+        self.hedge_workers = hedge_workers
+        self.limiter = limiter
+        self.latency = LatencyTracker()
+        self.stats = {}
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _count(self, book, key):
+        with self._lock:
+            book_stats = self.stats.setdefault(book, {"requests": 0, "timeouts": 0, "retries": 0,
+                                                      "hedges": 0, "hedge_wins": 0, "failures": 0})
+            book_stats[key] += 1
+        REQUEST_EVENTS.labels(book, key).inc()
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+    def _hedge_after(self, remaining):
+        if not self.hedge:
+            return None
+        hedge_after = self.latency.quantile(HEDGE_QUANTILE)
+        if hedge_after is None or hedge_after >= remaining:
+            return None
+        return hedge_after
+
+    def _timed(self, send, timeout):
+        started_at = time.monotonic()
+        response = send(timeout)
+        self.latency.record(time.monotonic() - started_at)
+        return response
+
+    async def _timed_async(self, send, timeout):
+        started_at = time.monotonic()
+        response = await asyncio.wait_for(send(timeout), timeout)
+        self.latency.record(time.monotonic() - started_at)
+        return response
+
+    def call(self, send, book, limiter=None):
+        '''
+        Run a request under the policy
+
+        Args:
+        send (callable): Sends the request, takes the timeout in seconds
+        book (str): Book the request is made for
+        limiter (RateLimiter): Budget of the retries and hedges, e.g. the limiter of the API key signing `send`
+
+        Returns:
+        Response of `send`, None if the deadline or the retries ran out
+        '''
+        self._count(book, "requests")
+        limiter = limiter or self.limiter
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._count(book, "timeouts")
+                logging.error(f"Request for {book} ran out of its {self.deadline}s deadline")
+                return None
+
+            try:
+                return self._send(send, remaining, book, limiter)
+            except TimeoutError:
+                self._count(book, "timeouts")
+                logging.error(f"Request for {book} ran out of its {self.deadline}s deadline")
+                return None
+            except (*TRANSIENT_ERRORS, TransientStatusError) as e:
+                if attempt >= self.retries:
+                    self._count(book, "failures")
+                    logging.error(f"Request for {book} failed after {attempt + 1} attempts: {e}")
+                    return None
+                attempt += 1
+                time.sleep(min(self._backoff(attempt), max(deadline - time.monotonic(), 0)))
+                if not limiter.acquire(book, timeout=max(deadline - time.monotonic(), 0)):
+                    self._count(book, "timeouts")
+                    logging.error(f"Request for {book} got no token to retry within its {self.deadline}s deadline")
+                    return None
+                self._count(book, "retries")
+
+    def _send(self, send, timeout, book, limiter):
+        hedge_after = self._hedge_after(timeout)
+        if hedge_after is None:
+            return self._timed(send, timeout)
+
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.hedge_workers, thread_name_prefix="hedge")
+
+        started_at = time.monotonic()
+        first = self._executor.submit(self._timed, send, timeout)
+        done, _ = wait([first], timeout=hedge_after)
+        if done or not limiter.acquire(book, timeout=0):
+            return first.result()
+
+        self._count(book, "hedges")
+        remaining = timeout - (time.monotonic() - started_at)
+        second = self._executor.submit(self._timed, send, remaining)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(timeout - (time.monotonic() - started_at), 0),
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        self._count(book, "hedge_wins")
+                    return future.result()
+                error = future.exception()
+        raise error or TimeoutError(f"Hedged request for {book} timed out")
+
+    async def call_async(self, send, book, limiter=None):
+        '''
+        Run a request under the policy without blocking the event loop
+
+        Args:
+        send (callable): Coroutine function sending the request, takes the timeout in seconds
+        book (str): Book the request is made for
+        limiter (RateLimiter): Budget of the retries and hedges, e.g. the limiter of the API key signing `send`
+
+        Returns:
+        Response of `send`, None if the deadline or the retries ran out
+        '''
+        self._count(book, "requests")
+        limiter = limiter or self.limiter
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._count(book, "timeouts")
+                logging.error(f"Request for {book} ran out of its {self.deadline}s deadline")
+                return None
+
+            try:
+                return await self._send_async(send, remaining, book, limiter)
+            except asyncio.TimeoutError:
+                self._count(book, "timeouts")
+                logging.error(f"Request for {book} ran out of its {self.deadline}s deadline")
+                return None
+            except (*ASYNC_TRANSIENT_ERRORS, TransientStatusError) as e:
+                if attempt >= self.retries:
+                    self._count(book, "failures")
+                    logging.error(f"Request for {book} failed after {attempt + 1} attempts: {e}")
+                    return None
+                attempt += 1
+                await asyncio.sleep(min(self._backoff(attempt), max(deadline - time.monotonic(), 0)))
+                if not await limiter.acquire_async(book, timeout=max(deadline - time.monotonic(), 0)):
+                    self._count(book, "timeouts")
+                    logging.error(f"Request for {book} got no token to retry within its {self.deadline}s deadline")
+                    return None
+                self._count(book, "retries")
+
+    async def _send_async(self, send, timeout, book, limiter):
+        hedge_after = self._hedge_after(timeout)
+        if hedge_after is None:
+            return await self._timed_async(send, timeout)
+
+        started_at = time.monotonic()
+        first = asyncio.create_task(self._timed_async(send, timeout))
+        done, _ = await asyncio.wait({first}, timeout=hedge_after)
+        if done or not await limiter.acquire_async(book, timeout=0):
+            return await first
+
+        self._count(book, "hedges")
+        remaining = timeout - (time.monotonic() - started_at)
+        second = asyncio.create_task(self._timed_async(send, remaining))
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=max(timeout - (time.monotonic() - started_at), 0),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self._count(book, "hedge_wins")
+                        return task.result()
+                    error = task.exception()
+        finally:
+            for task in pending:
+                task.cancel()
+        raise error or asyncio.TimeoutError()
+
+    def report(self, book):
+        """Log and reset the request stats of a book"""
+        with self._lock:
+            stats = self.stats.pop(book, None)
+        if stats:
+            logging.info(
+                f"Requests for {book}: {stats['requests']} sent, {stats['retries']} retries, "
+                f"{stats['timeouts']} timeouts, {stats['hedges']} hedges ({stats['hedge_wins']} won), "
+                f"{stats['failures']} failures"
+            )
+        return stats
+
+
+# Shared by every collector in the process
+request_policy = RequestPolicy()
@@ -0,0 +1,111 @@
+import time
+import asyncio
+import logging
+import threading
+from modules.metrics import TICKS, LATE_TICKS, MISSED_TICKS
+
+# Constants
+TICK_PERIOD = 1  # seconds
+LATE_THRESHOLD = 0.1  # seconds after its deadline a tick counts as late
+
+
+class TickClock:
+    """
+    Fires ticks on an absolute deadline grid measured with the monotonic clock.
+
+    Deadlines are aligned to the wall clock's period boundaries, e.g. the start
+    of every second, and don't move when a tick's work is slow: the next tick
+    still fires on the grid. When the work overruns by whole periods, the
+    skipped deadlines are counted as missed. Ticks that fire more than
+    `late_threshold` after their deadline are counted as late. Each book uses
+    its own clock, so a slow book never delays the others. The period and
+    deadline are guarded by a lock, so another thread, e.g. the adaptive
+    sampler, can change the period while the clock is waited on.
+    """
+
+    def __init__(self, name, period=TICK_PERIOD, late_threshold=LATE_THRESHOLD):
+        self.name = name
+        self.period = period
+        self.late_threshold = late_threshold
+        self.stats = {"ticks": 0, "late": 0, "missed": 0, "max_lateness": 0.0}
+        self._lock = threading.Lock()
+
+        # First deadline is the next wall-clock period boundary
+        self._deadline = time.monotonic() + (period - time.time() % period)
+
+    def _next(self):
+        """Seconds to sleep until the next tick, skipping the deadlines already missed"""
+        with self._lock:
+            now = time.monotonic()
+            lateness = now - self._deadline
+            missed = int(lateness // self.period) if lateness >= self.period else 0
+            self._deadline += missed * self.period
+            delay = self._deadline - now
+        if missed:
+            self.stats["missed"] += missed
+            MISSED_TICKS.labels(self.name).inc(missed)
+            logging.warning(f"{self.name} missed {missed} ticks")
+        return delay
+
+    def _fire(self, delay=0.0):
+        with self._lock:
+            lateness = time.monotonic() - self._deadline - delay
+            self._deadline += self.period
+        self.stats["ticks"] += 1
+        self.stats["max_lateness"] = max(self.stats["max_lateness"], lateness)
+        TICKS.labels(self.name).inc()
+        if lateness > self.late_threshold:
+            self.stats["late"] += 1
+            LATE_TICKS.labels(self.name).inc()
+
+    def set_period(self, period):
+        '''
+        Change the tick period, the next deadline moves to one new period after the last tick
+
+        Args:
+        period (float): New period in seconds
+        '''
+        with self._lock:
+            self._deadline += period - self.period
+            self.period = period
+
+    def next_deadline(self):
+        """Monotonic time of the next deadline, for schedulers that wait on behalf of the clock"""
+        return time.monotonic() + self._next()
+
+    def fire(self, delay=0.0):
+        '''
+        Count the tick of the deadline returned by next_deadline
+
+        Args:
+        delay (float): Seconds after the deadline the tick was meant to run at, not counted as lateness
+        '''
+        self._fire(delay)
+
+    def wait(self):
+        '''
+        Sleep until the next deadline of the grid
+        '''
+        delay = self._next()
+        if delay > 0:
+            time.sleep(delay)
+        self._fire()
+
+    async def wait_async(self):
+        '''
+        Sleep until the next deadline of the grid without blocking the event loop
+        '''
+        delay = self._next()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self._fire()
+
+    def report(self):
+        """Log and reset the tick stats"""
+        stats = self.stats
+        logging.info(
+            f"Ticks for {self.name}: {stats['ticks']} fired, {stats['late']} late, "
+            f"{stats['missed']} missed, max lateness {stats['max_lateness'] * 1000:.0f}ms"
+        )
+        self.stats = {"ticks": 0, "late": 0, "missed": 0, "max_lateness": 0.0}
+        return stats
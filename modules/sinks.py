@@ -0,0 +1,223 @@
+"""
+Row sinks: consumers that get every row the collectors record, as it is recorded.
+
+The interval writers hand each parsed tick once to every started sink, next
+to the interval file they build for the file sinks ("local" and "gcs", see
+upload_pipeline.FanOutPipeline). Each sink has its own bounded queue and
+thread, batches rows by count and age, and retries failed batches on its own,
+so a slow or broken sink drops its own rows and never stalls sampling or the
+other sinks.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import random
+import logging
+import threading
+from abc import ABC, abstractmethod
+from modules.metrics import SINK_ROWS
+
+try:
+    # Optional fast JSON backend
+    import orjson
+
+    def dumps(record):
+        return orjson.dumps(record)
+except ImportError:
+    def dumps(record):
+        return json.dumps(record, separators=(",", ":")).encode()
+
+# Constants
+SINK_QUEUE_SIZE = 10000  # Writes waiting per sink, rows offered to a full sink are dropped
+SINK_BATCH_SIZE = 500  # Rows per batch
+SINK_FLUSH_INTERVAL = 1.0  # seconds a row waits for its batch to fill
+SINK_MAX_ATTEMPTS = 3
+SINK_RETRY_BASE = 0.5  # seconds
+FILE_SINKS = ("local", "gcs")  # Sinks of the closed interval files
+QUEUE_URL = os.getenv("SINK_QUEUE_URL", "http://localhost:8766")
+QUEUE_TOPIC = os.getenv("SINK_QUEUE_TOPIC", "bitso")
+
+
+def record(stream, columns, row):
+    """Row as a dict of its columns, tagged with its stream, "top" for the top-of-book rows"""
+    return {"stream": stream or "top", **dict(zip(columns or (), row))}
+
+
+class RowSink(ABC):
+    """
+    Base of the row sinks, subclasses implement `send`.
+
+    `offer` never blocks: the rows of a write go into a bounded queue,
+    drained by the sink's own thread in batches of up to `batch_size` rows or
+    every `flush_interval` seconds. When the queue is full the rows are
+    dropped and counted. A batch whose `send` raises is retried with jittered
+    backoff up to `max_attempts` times, then dropped and counted.
+    """
+
+    name = "sink"
+
+    def __init__(self, max_queue=SINK_QUEUE_SIZE, batch_size=SINK_BATCH_SIZE, flush_interval=SINK_FLUSH_INTERVAL,
+                 max_attempts=SINK_MAX_ATTEMPTS):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.stats = {"sent": 0, "dropped": 0, "failed": 0}
+        self._queue = queue.Queue(max_queue)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def offer(self, stream, columns, rows):
+        '''
+        Queue the rows of one write
+
+        Args:
+        stream (str): Stream of the rows, see formats.stream_of
+        columns (list): Column names of the rows
+        rows (tuple): The rows
+
+        Returns:
+        bool: False if the sink is full and the rows were dropped
+        '''
+        try:
+            self._queue.put_nowait((stream, columns, rows))
+            return True
+        except queue.Full:
+            self.stats["dropped"] += len(rows)
+            SINK_ROWS.labels(self.name, "dropped").inc(len(rows))
+            return False
+
+    @abstractmethod
+    def send(self, records):
+        '''
+        Deliver one batch, raise to have it retried
+
+        Args:
+        records (list): Rows as dicts, see `record`
+        '''
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"sink-{self.name}", daemon=True)
+        self._thread.start()
+        return self
+
+    def _batch(self):
+        """Wait for the next batch, shorter than batch_size once it is flush_interval old or the sink stops"""
+        batch = []
+        deadline = None
+        while len(batch) < self.batch_size:
+            timeout = self.flush_interval if deadline is None else deadline - time.monotonic()
+            try:
+                stream, columns, rows = self._queue.get(timeout=max(timeout, 0))
+            except queue.Empty:
+                if batch or self._stop.is_set():
+                    break
+                continue
+            deadline = deadline or time.monotonic() + self.flush_interval
+            batch.extend(record(stream, columns, row) for row in rows)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._batch()
+            if not batch:
+                return
+            for attempt in range(self.max_attempts):
+                try:
+                    self.send(batch)
+                    self.stats["sent"] += len(batch)
+                    SINK_ROWS.labels(self.name, "sent").inc(len(batch))
+                    break
+                except Exception as e:
+                    if attempt + 1 == self.max_attempts or self._stop.is_set():
+                        self.stats["failed"] += len(batch)
+                        SINK_ROWS.labels(self.name, "failed").inc(len(batch))
+                        logging.error(f"Sink {self.name} dropped {len(batch)} rows: {e}")
+                        break
+                    time.sleep(random.uniform(0, SINK_RETRY_BASE * 2 ** attempt))
+
+    def close(self, timeout=None):
+        '''
+        Send the queued rows and stop the sink
+
+        Args:
+        timeout (float): Seconds to wait for the queue to drain
+        '''
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+
+class NdjsonSink(RowSink):
+    """Writes every row as one JSON line, to stdout by default, e.g. to pipe the collector into another program"""
+
+    name = "ndjson"
+
+    def __init__(self, stream=None, **options):
+        super().__init__(**options)
+        self.stream = stream or sys.stdout.buffer
+
+    def send(self, records):
+        self.stream.write(b"".join(dumps(item) + b"\n" for item in records))
+        self.stream.flush()
+
+
+class QueueSink(RowSink):
+    """Publishes the rows as NDJSON batches to a topic of a message queue, see mocks/message_queue.py"""
+
+    name = "queue"
+
+    def __init__(self, url=QUEUE_URL, topic=QUEUE_TOPIC, timeout=5, **options):
+        super().__init__(**options)
+        self.url = f"{url.rstrip('/')}/topics/{topic}"
+        self.timeout = timeout
+
+    def send(self, records):
+        # Imported here so collectors without this sink never load the HTTP client
+        from modules.http_client import get_http_client
+        client = get_http_client()
+        body = b"".join(dumps(item) + b"\n" for item in records)
+        # httpx takes raw bodies as content, requests as data
+        response = client.post(self.url, timeout=self.timeout, **{"content" if client.http2 else "data": body})
+        if response.status_code >= 400:
+            raise RuntimeError(f"HTTP status {response.status_code}")
+
+
+ROW_SINKS = {"ndjson": NdjsonSink, "queue": QueueSink}
+
+# Started row sinks, fed by every IntervalWriter
+row_sinks = []
+
+
+def publish(stream, columns, rows):
+    """Hand the rows of one write to every started row sink"""
+    for sink in row_sinks:
+        sink.offer(stream, columns, rows)
+
+
+def start_row_sinks(names):
+    '''
+    Start the row sinks among `names`, file sink names are skipped
+
+    Args:
+    names (list): Sink names, e.g. ["local", "gcs", "ndjson", "queue"]
+
+    Returns:
+    list: The started sinks
+    '''
+    for name in names or ():
+        if name in FILE_SINKS:
+            continue
+        if name not in ROW_SINKS:
+            raise ValueError(f"Unknown sink {name!r}, expected one of {[*FILE_SINKS, *ROW_SINKS]}")
+        row_sinks.append(ROW_SINKS[name]().start())
+    return row_sinks
+
+
+def close_row_sinks(timeout=None):
+    """Send what the row sinks still hold and stop them"""
+    for sink in row_sinks:
+        sink.close(timeout)
+        logging.info(f"Sink {sink.name}: {sink.stats}")
+    row_sinks.clear()
@@ -0,0 +1,276 @@
+"""
+Storage backends of the collectors, the compaction and the reader.
+
+Backends are registered by name in BACKENDS and created on first use by
+`get_storage`, which shares one instance per backend and arguments across the
+process. Nothing from google-cloud is imported, and no credentials are looked
+up, until a GCS backend makes its first request, so local runs work without
+cloud credentials.
+
+    from modules.storage import get_storage
+
+    bucket = get_storage("gcs", "bitsode")
+    bucket.write("2023/6/30/10/btc_mxn_2023-06-30-10-00-00.csv", data, "text/csv")
+"""
+import io
+import os
+import gzip
+import logging
+import threading
+
+# Constants
+LOCAL_ROOT = "data"
+MANIFEST_NAME = "_manifest.json"  # Names starting with "_" are metadata, not data files
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # Larger uploads go in chunks of a resumable upload, a multiple of 256 KiB
+# Backend of the store_data_to_gcs helpers: "gcs", or "fake" to keep the objects in memory
+REMOTE_BACKEND = os.getenv("STORAGE_BACKEND", "gcs")
+
+_gcs_client = None
+_instances = {}
+_lock = threading.Lock()
+
+
+def gcs_client():
+    """The GCS client of the process, created on first use"""
+    global _gcs_client
+    if _gcs_client is None:
+        with _lock:
+            if _gcs_client is None:
+                from google.cloud import storage
+                _gcs_client = storage.Client()
+                logging.info("GCS client created")
+    return _gcs_client
+
+
+def _forget_clients():
+    """A forked worker creates its own client, sockets can't be shared with the parent"""
+    global _gcs_client
+    _gcs_client = None
+    _instances.clear()
+
+
+os.register_at_fork(after_in_child=_forget_clients)
+
+
+class LocalStorage:
+    """
+    Partitions under a local directory, in the layout of store_data_locally.
+
+    Keys are paths relative to `root` with "/" separators, e.g.
+    2023/06/30/10/btc_mxn_2023-06-30-10-00-00.csv.
+    """
+
+    def __init__(self, root=LOCAL_ROOT):
+        self.root = root
+
+    def partition(self, hour):
+        """Key prefix of the partition of a datetime's hour"""
+        return hour.strftime("%Y/%m/%d/%H")
+
+    def path(self, key):
+        """Local path of a key"""
+        return os.path.join(self.root, *key.split("/"))
+
+    def list(self, prefix):
+        '''
+        Keys of the files in a partition
+
+        Args:
+        prefix (str): Partition prefix, see `partition`
+
+        Returns:
+        list: Sorted keys
+        '''
+        directory = self.path(prefix)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(f"{prefix}/{name}" for name in os.listdir(directory)
+                      if os.path.isfile(os.path.join(directory, name)))
+
+    def sizes(self, prefix):
+        """Size in bytes of each file of a partition, keyed by key"""
+        return {key: os.path.getsize(self.path(key)) for key in self.list(prefix)}
+
+    def read(self, key):
+        with open(self.path(key), "rb") as f:
+            return f.read()
+
+    def read_range(self, key, start, end):
+        """Bytes [start, end) of a file"""
+        with open(self.path(key), "rb") as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def write(self, key, data, content_type=None, content_encoding=None):
+        '''
+        Write a file atomically, readers never see it half written
+
+        Args:
+        key (str): Key of the file
+        data (bytes): Content of the file, not encoded, `content_type` and `content_encoding` are ignored
+        '''
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def delete(self, key):
+        os.remove(self.path(key))
+
+
+class GcsStorage:
+    """
+    Partitions of a GCS bucket, in the layout of store_data_to_gcs.
+
+    Keys are object names, e.g. 2023/6/30/10/btc_mxn_2023-06-30-10-00-00.csv.
+    The shared client of `gcs_client` is used unless one is given, set
+    STORAGE_EMULATOR_HOST to point it at mocks/fake_gcs_server.py.
+    """
+
+    def __init__(self, bucket_name, client=None):
+        self.bucket_name = bucket_name
+        self._client = client
+        self._bucket = None
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            self._bucket = (self._client or gcs_client()).bucket(self.bucket_name)
+        return self._bucket
+
+    def partition(self, hour):
+        """Key prefix of the partition of a datetime's hour, the GCS keys are not zero padded"""
+        return f"{hour.year}/{hour.month}/{hour.day}/{hour.hour}"
+
+    def list(self, prefix):
+        '''
+        Keys of the objects in a partition
+
+        Args:
+        prefix (str): Partition prefix, see `partition`
+
+        Returns:
+        list: Sorted keys
+        '''
+        return sorted(blob.name for blob in self.bucket.client.list_blobs(self.bucket, prefix=f"{prefix}/"))
+
+    def sizes(self, prefix):
+        """Size in bytes of each object of a partition, keyed by key, from a single listing"""
+        return {blob.name: blob.size for blob in self.bucket.client.list_blobs(self.bucket, prefix=f"{prefix}/")}
+
+    def read(self, key):
+        return self.bucket.blob(key).download_as_bytes()
+
+    def read_range(self, key, start, end):
+        """Bytes [start, end) of an object, with a ranged GET"""
+        return self.bucket.blob(key).download_as_bytes(start=start, end=end - 1)
+
+    def write(self, key, data, content_type=None, content_encoding=None):
+        '''
+        Upload an object from memory, in chunks of a resumable upload when it is large
+
+        Args:
+        key (str): Key of the object
+        data (bytes): Content of the object
+        content_type (str): MIME type of the content
+        content_encoding (str): "gzip" when `data` is gzip compressed, GCS decompresses it for readers
+        '''
+        chunk_size = UPLOAD_CHUNK_SIZE if len(data) > UPLOAD_CHUNK_SIZE else None
+        blob = self.bucket.blob(key, chunk_size=chunk_size)
+        blob.content_encoding = content_encoding
+        blob.upload_from_file(io.BytesIO(data), size=len(data), content_type=content_type)
+        logging.debug(f"Wrote gs://{self.bucket_name}/{key}")
+
+    def upload_file(self, key, filename):
+        """Upload a local file to an object"""
+        self.bucket.blob(key).upload_from_filename(filename)
+
+    def delete(self, key):
+        self.bucket.blob(key).delete()
+
+
+class MemoryStorage:
+    """
+    In-process object store with the keys of GcsStorage.
+
+    A stand-in for a bucket in tests and dry runs: nothing leaves the
+    process, and the objects are gone when it exits. Gzip encoded objects
+    are read back decompressed, like GCS does. For a fake bucket shared
+    between processes, use GcsStorage with mocks/fake_gcs_server.py.
+    """
+
+    def __init__(self, bucket_name="fake"):
+        self.bucket_name = bucket_name
+        self.objects = {}  # key -> (data, content_type, content_encoding)
+        self._lock = threading.Lock()
+
+    def partition(self, hour):
+        return GcsStorage.partition(self, hour)
+
+    def list(self, prefix):
+        return sorted(self.sizes(prefix))
+
+    def sizes(self, prefix):
+        with self._lock:
+            return {key: len(data) for key, (data, _, _) in self.objects.items() if key.startswith(f"{prefix}/")}
+
+    def read(self, key):
+        data, _, content_encoding = self.objects[key]
+        return gzip.decompress(data) if content_encoding == "gzip" else data
+
+    def read_range(self, key, start, end):
+        return self.read(key)[start:end]
+
+    def write(self, key, data, content_type=None, content_encoding=None):
+        with self._lock:
+            self.objects[key] = (bytes(data), content_type, content_encoding)
+        logging.debug(f"Wrote {key} to the {self.bucket_name} memory store")
+
+    def upload_file(self, key, filename):
+        with open(filename, "rb") as f:
+            self.write(key, f.read())
+
+    def delete(self, key):
+        with self._lock:
+            del self.objects[key]
+
+
+# Backend classes by name, their constructor arguments are the ones of get_storage
+BACKENDS = {
+    "local": LocalStorage,
+    "gcs": GcsStorage,
+    "fake": MemoryStorage,
+}
+
+
+def register_backend(name, factory):
+    '''
+    Make a backend available to get_storage
+
+    Args:
+    name (str): Name of the backend
+    factory (callable): Creates the backend from the arguments of get_storage
+    '''
+    BACKENDS[name] = factory
+
+
+def get_storage(name, *args):
+    '''
+    The shared instance of a storage backend, created on first use
+
+    Args:
+    name (str): "local", "gcs", "fake" or a registered backend
+    *args: Arguments of the backend, e.g. the root directory or the bucket name
+
+    Returns:
+    The backend, the same object for the same name and arguments
+    '''
+    key = (name, *args)
+    with _lock:
+        if key not in _instances:
+            if name not in BACKENDS:
+                raise ValueError(f"Unknown storage backend: {name}")
+            _instances[key] = BACKENDS[name](*args)
+        return _instances[key]
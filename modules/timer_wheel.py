@@ -0,0 +1,157 @@
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Constants
+WHEEL_RESOLUTION = 0.01  # seconds per slot of the innermost wheel
+WHEEL_SLOTS = 256  # Slots per wheel, the innermost one spans 2.56s, the next one 655s
+WHEEL_LEVELS = 3
+POOL_WORKERS = 16  # Threads running the jobs, however many jobs are scheduled
+
+
+class TimerWheel:
+    """
+    Hierarchical timing wheel.
+
+    Timers go into the slot of their expiry tick on the innermost wheel that
+    spans it. Every tick `advance` empties one slot of the innermost wheel,
+    and each time a wheel wraps around, the next slot of the wheel above is
+    cascaded down. Scheduling and expiring a timer costs O(1) however many
+    timers are pending. Expiry ticks round up, so a timer never fires before
+    its deadline and at most one resolution after it.
+    """
+
+    def __init__(self, resolution=WHEEL_RESOLUTION, slots=WHEEL_SLOTS, levels=WHEEL_LEVELS, start=None):
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+        self.pending = 0
+        self._origin = time.monotonic() if start is None else start
+        self._tick = 0  # Ticks advanced since the origin
+        self._wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self._lock = threading.Lock()
+
+    def _place(self, expiry, item):
+        delta = expiry - self._tick
+        for level in range(self.levels):
+            span = self.slots ** (level + 1)
+            if delta < span or level == self.levels - 1:
+                # Timers beyond the outermost wheel wait in its last slot and get placed again when it cascades
+                slot = min(expiry, self._tick + span - 1) // self.slots ** level % self.slots
+                self._wheels[level][slot].append((expiry, item))
+                return
+
+    def schedule(self, deadline, item):
+        '''
+        Add a timer
+
+        Args:
+        deadline (float): Monotonic time the timer expires at, a deadline in the past expires on the next tick
+        item: Returned by `advance` once the timer expired
+        '''
+        expiry = int(-(-(deadline - self._origin) // self.resolution))
+        with self._lock:
+            self._place(max(expiry, self._tick + 1), item)
+            self.pending += 1
+
+    def advance(self, now=None):
+        '''
+        Move the wheel up to `now` and collect the expired timers
+
+        Args:
+        now (float): Monotonic time, now by default
+
+        Returns:
+        list: Items of the expired timers, in expiry order
+        '''
+        now = time.monotonic() if now is None else now
+        target = int((now - self._origin) // self.resolution)
+        expired = []
+        with self._lock:
+            while self._tick < target:
+                self._tick += 1
+                # Outer wheels first, what they cascade may land in the slot of a wheel below that cascades too
+                for level in range(self.levels - 1, 0, -1):
+                    if self._tick % self.slots ** level == 0:
+                        slot = self._wheels[level][self._tick // self.slots ** level % self.slots]
+                        timers, slot[:] = slot[:], []
+                        for expiry, item in timers:
+                            self._place(expiry, item)
+                slot = self._wheels[0][self._tick % self.slots]
+                expired.extend(item for _, item in slot)
+                slot.clear()
+            self.pending -= len(expired)
+        return expired
+
+    def next_tick(self):
+        """Monotonic time of the next tick"""
+        return self._origin + (self._tick + 1) * self.resolution
+
+
+class WheelExecutor:
+    """
+    Runs periodic jobs on a fixed pool of threads.
+
+    A job has a `name`, a TickClock `clock` and a `step` method doing the
+    work of one tick. The deadlines of all the jobs wait in one TimerWheel,
+    whose driver thread hands the due jobs to the pool, so the executor runs
+    `workers` threads plus the driver however many jobs there are. Threads
+    the jobs start themselves, e.g. the send threads of the request policy,
+    come on top. A job is only scheduled again once its step returned, so it
+    never runs concurrently with itself, and a step that raises is logged
+    without ending the job.
+    """
+
+    def __init__(self, workers=POOL_WORKERS, resolution=WHEEL_RESOLUTION):
+        self.workers = workers
+        self.wheel = TimerWheel(resolution)
+        self.stats = {"steps": 0, "errors": 0}
+        self._lock = threading.Lock()  # Guards stats, updated from the pool threads
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="collector")
+        self._stop = threading.Event()
+
+    @property
+    def stopping(self):
+        return self._stop.is_set()
+
+    def add(self, job, delay=0.0):
+        '''
+        Schedule a job on its clock's next deadline
+
+        Args:
+        job: Object with `name`, `clock` and `step()`
+        delay (float): Seconds after each deadline the job runs at
+        '''
+        self.wheel.schedule(job.clock.next_deadline() + delay, (job, delay))
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _run(self, job, delay):
+        try:
+            # The delay is part of the schedule, the tick is only late past it
+            job.clock.fire(delay)
+            job.step()
+            self._count("steps")
+        except Exception as e:
+            self._count("errors")
+            logging.error(f"Error in {job.name}, retrying on its next tick: {e}")
+        finally:
+            if not self._stop.is_set():
+                self.add(job, delay)
+
+    def run(self):
+        '''
+        Hand the due jobs to the pool until `stop` is called, then wait for the running steps
+        '''
+        while not self._stop.is_set():
+            for job, delay in self.wheel.advance():
+                self._pool.submit(self._run, job, delay)
+            self._stop.wait(max(self.wheel.next_tick() - time.monotonic(), 0))
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+    def stop(self):
+        """Stop scheduling jobs, `run` returns once the running steps finished"""
+        self._stop.set()
@@ -0,0 +1,599 @@
+import os
+import time
+import queue
+import shutil
+import random
+import asyncio
+import logging
+import threading
+from modules.metrics import stage, UPLOADS
+from modules.interval_writer import IntervalBuffer
+
+# Constants
+PENDING_DIR = "pending"  # Closed intervals waiting to be stored
+UPLOAD_WORKERS = 4
+QUEUE_SIZE = 64
+BACKPRESSURE_LEVEL = 0.8  # Queue fill ratio that signals backpressure
+MAX_ATTEMPTS = 5
+RETRY_BASE = 1  # seconds
+RETRY_CAP = 30  # seconds
+RESCAN_INTERVAL = 60  # seconds between scans of the pending directory
+
+# The collectors, the fan-out rescan and the feed can hand over the same file at once
+_fan_out_lock = threading.Lock()
+
+
+def stage_file(filename, pending_dir=PENDING_DIR):
+    '''
+    Move a closed interval file into the pending directory
+
+    The move is a rename on the same filesystem, so a file is either still in
+    the working directory or fully in the pending directory, never half copied.
+
+    Returns:
+    str: Path of the staged file
+    '''
+    os.makedirs(pending_dir, exist_ok=True)
+    staged = os.path.join(pending_dir, os.path.basename(filename))
+    if os.path.abspath(filename) != os.path.abspath(staged):
+        os.replace(filename, staged)
+    return staged
+
+
+def stage_item(item, pending_dir=PENDING_DIR):
+    """Stage a closed interval file, in-memory intervals stay in memory"""
+    return item if isinstance(item, IntervalBuffer) else stage_file(item, pending_dir)
+
+
+def spill(item, pending_dir=PENDING_DIR):
+    """Write an in-memory interval that could not be uploaded to the pending directory"""
+    if isinstance(item, IntervalBuffer):
+        return item.spill(pending_dir)
+    return item
+
+
+def fan_out_item(item, pending_dirs):
+    '''
+    Give every sink its own copy of a closed interval
+
+    Files are hard linked into every pending directory, or copied across
+    filesystems, and the original is removed. In-memory intervals are never
+    changed once closed, so every sink gets the same IntervalBuffer.
+
+    Returns:
+    list: The copy of each pending directory, in order, empty if the file was already fanned out
+    '''
+    if isinstance(item, IntervalBuffer):
+        return [item] * len(pending_dirs)
+    with _fan_out_lock:
+        if not os.path.exists(item):
+            return []
+        copies = []
+        for pending_dir in pending_dirs:
+            os.makedirs(pending_dir, exist_ok=True)
+            copy = os.path.join(pending_dir, os.path.basename(item))
+            if os.path.abspath(copy) != os.path.abspath(item):
+                try:
+                    os.link(item, copy)
+                except FileExistsError:
+                    pass
+                except OSError:
+                    shutil.copy2(item, copy)
+            copies.append(copy)
+        if os.path.abspath(item) not in {os.path.abspath(copy) for copy in copies}:
+            os.remove(item)
+        return copies
+
+
+def pending_files(pending_dir=PENDING_DIR):
+    """Files left in the pending directory, oldest first"""
+    if not os.path.isdir(pending_dir):
+        return []
+    paths = [os.path.join(pending_dir, name) for name in os.listdir(pending_dir)]
+    return sorted((path for path in paths if os.path.isfile(path)), key=os.path.getmtime)
+
+
+def retry_delay(attempt):
+    """Full-jitter exponential backoff"""
+    return random.uniform(0, min(RETRY_CAP, RETRY_BASE * 2 ** attempt))
+
+
+class UploadPipeline:
+    """
+    Background upload stage for the threaded collectors.
+
+    Closed interval files are moved to a pending directory and queued. A pool
+    of worker threads drains the queue through `store`, the function that
+    ships a file and removes it from disk, e.g. `store_data`. Failed uploads
+    are retried with jittered backoff. A file that still fails stays in the
+    pending directory, which is rescanned periodically and on start, so a crash
+    or a long outage never loses a closed interval.
+
+    The queue is bounded. `submit` never blocks sampling: when the queue is
+    full the file just waits on disk for the next rescan and `submit` returns
+    False. `backpressure` tells the collectors that uploads are falling behind.
+
+    IntervalBuffers of diskless writers are queued and uploaded from memory,
+    they are only written to the pending directory when the queue is full,
+    when their upload gives up, or when the pipeline closes with them queued
+    or still uploading.
+    """
+
+    def __init__(self, store, workers=UPLOAD_WORKERS, max_queue=QUEUE_SIZE, pending_dir=PENDING_DIR,
+                 max_attempts=MAX_ATTEMPTS):
+        self.store = store
+        self.workers = workers
+        self.pending_dir = pending_dir
+        self.max_attempts = max_attempts
+        self.stats = {"uploaded": 0, "retries": 0, "failures": 0, "deferred": 0}
+        self._queue = queue.Queue(max_queue)
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._workers = []
+        self._threads = []
+
+    @property
+    def backpressure(self):
+        return self._queue.qsize() >= BACKPRESSURE_LEVEL * self._queue.maxsize
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"upload-{i}", daemon=True)
+            thread.start()
+            self._workers.append(thread)
+        rescan = threading.Thread(target=self._rescan_loop, name="upload-rescan", daemon=True)
+        rescan.start()
+        self._threads.append(rescan)
+        return self
+
+    def submit(self, filename):
+        '''
+        Hand a closed interval file to the pipeline
+
+        Args:
+        filename (str): Name of the closed file, or an IntervalBuffer
+
+        Returns:
+        bool: False if the queue is full and the file waits for the next rescan
+        '''
+        return self._enqueue(stage_item(filename, self.pending_dir))
+
+    def _enqueue(self, path):
+        with self._lock:
+            if path in self._queued:
+                return True
+            try:
+                self._queue.put_nowait(path)
+            except queue.Full:
+                self.stats["deferred"] += 1
+                logging.warning(f"Upload queue full, {path} deferred to the next rescan")
+                spill(path, self.pending_dir)
+                return False
+            self._queued.add(path)
+        return True
+
+    def feed(self, source):
+        '''
+        Submit the files other processes put on `source` until it yields None
+
+        Runs in a background thread, see RemoteUploader for the sending side.
+
+        Args:
+        source (multiprocessing.Queue): Queue of closed interval files
+        '''
+        def forward():
+            for path in iter(source.get, None):
+                self.submit(path)
+
+        thread = threading.Thread(target=forward, name="upload-feed", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+        return thread
+
+    def _rescan_loop(self):
+        while True:
+            for path in pending_files(self.pending_dir):
+                if not self._enqueue(path):
+                    break
+            if self._stop.wait(RESCAN_INTERVAL):
+                return
+
+    def _work(self):
+        while True:
+            path = self._queue.get()
+            if path is None:
+                return
+            try:
+                self._upload(path)
+            finally:
+                with self._lock:
+                    self._queued.discard(path)
+                self._queue.task_done()
+
+    def _upload(self, path):
+        if isinstance(path, str) and not os.path.exists(path):
+            # Already uploaded through another submission of the same file
+            return
+        for attempt in range(self.max_attempts):
+            try:
+                with stage("upload"):
+                    self.store(path)
+                self.stats["uploaded"] += 1
+                UPLOADS.labels("ok").inc()
+                return
+            except Exception as e:
+                UPLOADS.labels("error").inc()
+                if attempt + 1 == self.max_attempts:
+                    self.stats["failures"] += 1
+                    logging.error(f"Giving up on {path} for now, kept in {self.pending_dir}: {e}")
+                    spill(path, self.pending_dir)
+                    return
+                self.stats["retries"] += 1
+                delay = retry_delay(attempt)
+                logging.warning(f"Upload of {path} failed ({e}), retrying in {delay:.1f}s")
+                if self._stop.wait(delay):
+                    spill(path, self.pending_dir)
+                    return
+
+    def close(self, timeout=None):
+        '''
+        Wait for the queued uploads and stop the workers
+
+        Args:
+        timeout (float): Seconds to wait for the queue to drain
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks and (deadline is None or time.monotonic() < deadline):
+            time.sleep(0.1)
+        self._stop.set()
+        # In-memory intervals still queued would be lost with the process
+        while True:
+            try:
+                path = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._queued.discard(path)
+            spill(path, self.pending_dir)
+            self._queue.task_done()
+        for _ in range(self.workers):
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                break
+        # Workers retrying stop at once, one stuck in an upload past the deadline dies with the
+        # process, so the in-memory interval it holds is written out first
+        for thread in self._workers:
+            thread.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+        with self._lock:
+            in_hand = list(self._queued)
+        for path in in_hand:
+            spill(path, self.pending_dir)
+
+
+class AsyncUploadPipeline:
+    """
+    Background upload stage for the asyncio collectors.
+
+    Same contract as UploadPipeline, with `store` a coroutine function drained
+    by `workers` tasks, which also bounds the number of concurrent uploads.
+    """
+
+    def __init__(self, store, workers=UPLOAD_WORKERS, max_queue=QUEUE_SIZE, pending_dir=PENDING_DIR,
+                 max_attempts=MAX_ATTEMPTS):
+        self.store = store
+        self.workers = workers
+        self.max_queue = max_queue
+        self.pending_dir = pending_dir
+        self.max_attempts = max_attempts
+        self.stats = {"uploaded": 0, "retries": 0, "failures": 0, "deferred": 0}
+        self._queue = None
+        self._queued = set()
+        self._tasks = []
+
+    @property
+    def backpressure(self):
+        return self._queue.qsize() >= BACKPRESSURE_LEVEL * self._queue.maxsize
+
+    async def start(self):
+        self._queue = asyncio.Queue(self.max_queue)
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._rescan_loop()))
+        return self
+
+    async def submit(self, filename):
+        '''
+        Hand a closed interval file to the pipeline
+
+        Args:
+        filename (str): Name of the closed file, or an IntervalBuffer
+
+        Returns:
+        bool: False if the queue is full and the file waits for the next rescan
+        '''
+        path = await asyncio.to_thread(stage_item, filename, self.pending_dir)
+        if not self._enqueue(path):
+            await asyncio.to_thread(spill, path, self.pending_dir)
+            return False
+        return True
+
+    def _enqueue(self, path):
+        if path in self._queued:
+            return True
+        try:
+            self._queue.put_nowait(path)
+        except asyncio.QueueFull:
+            self.stats["deferred"] += 1
+            logging.warning(f"Upload queue full, {path} deferred to the next rescan")
+            return False
+        self._queued.add(path)
+        return True
+
+    async def _rescan_loop(self):
+        while True:
+            for path in await asyncio.to_thread(pending_files, self.pending_dir):
+                if not self._enqueue(path):
+                    break
+            await asyncio.sleep(RESCAN_INTERVAL)
+
+    async def _work(self):
+        while True:
+            path = await self._queue.get()
+            try:
+                await self._upload(path)
+            finally:
+                self._queued.discard(path)
+                self._queue.task_done()
+
+    async def _upload(self, path):
+        if isinstance(path, str) and not os.path.exists(path):
+            # Already uploaded through another submission of the same file
+            return
+        try:
+            for attempt in range(self.max_attempts):
+                try:
+                    with stage("upload"):
+                        await self.store(path)
+                    self.stats["uploaded"] += 1
+                    UPLOADS.labels("ok").inc()
+                    return
+                except Exception as e:
+                    UPLOADS.labels("error").inc()
+                    if attempt + 1 == self.max_attempts:
+                        self.stats["failures"] += 1
+                        logging.error(f"Giving up on {path} for now, kept in {self.pending_dir}: {e}")
+                        await asyncio.to_thread(spill, path, self.pending_dir)
+                        return
+                    self.stats["retries"] += 1
+                    delay = retry_delay(attempt)
+                    logging.warning(f"Upload of {path} failed ({e}), retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            # Cancelled by close while uploading or waiting to retry, an in-memory interval would be lost
+            spill(path, self.pending_dir)
+            raise
+
+    async def close(self, timeout=None):
+        '''
+        Wait for the queued uploads and cancel the workers
+
+        Args:
+        timeout (float): Seconds to wait for the queue to drain
+        '''
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"{self._queue.qsize()} uploads left in {self.pending_dir}")
+        for task in self._tasks:
+            task.cancel()
+        # The workers spill the in-memory intervals they hold as they are cancelled
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        # In-memory intervals still queued would be lost with the process
+        while not self._queue.empty():
+            spill(self._queue.get_nowait(), self.pending_dir)
+
+
+class FanOutPipeline:
+    """
+    Upload stage of several file sinks for the threaded collectors.
+
+    Has the interface of UploadPipeline, but hands every closed interval to
+    one UploadPipeline per sink, built from `stores`, a store function per
+    sink name. Each sink has its own queue, workers, retries and pending
+    directory, pending/<sink>, so a slow or failing sink only delays its own
+    uploads. Intervals left in the shared pending directory, e.g. by a run
+    with a single sink or by RemoteUploader, are fanned out on every rescan.
+    """
+
+    def __init__(self, stores, pending_dir=PENDING_DIR, **options):
+        self.pending_dir = pending_dir
+        self.pipelines = {
+            name: UploadPipeline(store, pending_dir=os.path.join(pending_dir, name), **options)
+            for name, store in stores.items()
+        }
+        self._stop = threading.Event()
+        self._threads = []
+        if not self.pipelines:
+            logging.warning("No file sinks, closed intervals are discarded")
+
+    @property
+    def backpressure(self):
+        return any(pipeline.backpressure for pipeline in self.pipelines.values())
+
+    @property
+    def stats(self):
+        return {name: pipeline.stats for name, pipeline in self.pipelines.items()}
+
+    def _fan_out(self, item):
+        return fan_out_item(item, [pipeline.pending_dir for pipeline in self.pipelines.values()])
+
+    def start(self):
+        for pipeline in self.pipelines.values():
+            pipeline.start()
+        if self.pipelines:
+            rescan = threading.Thread(target=self._rescan_loop, name="upload-fan-out", daemon=True)
+            rescan.start()
+            self._threads.append(rescan)
+        return self
+
+    def _rescan_loop(self):
+        while True:
+            for path in pending_files(self.pending_dir):
+                try:
+                    self.submit(path)
+                except Exception as e:
+                    logging.error(f"Error fanning out {path}, retrying on the next rescan: {e}")
+            if self._stop.wait(RESCAN_INTERVAL):
+                return
+
+    def submit(self, filename):
+        '''
+        Hand a closed interval file to the pipeline of every sink
+
+        Args:
+        filename (str): Name of the closed file, or an IntervalBuffer
+
+        Returns:
+        bool: False if the queue of a sink is full and its copy waits for the next rescan
+        '''
+        copies = self._fan_out(filename)
+        return all([pipeline.submit(copy) for pipeline, copy in zip(self.pipelines.values(), copies)])
+
+    def feed(self, source):
+        '''
+        Submit the files other processes put on `source` until it yields None
+
+        Args:
+        source (multiprocessing.Queue): Queue of closed interval files
+        '''
+        def forward():
+            for path in iter(source.get, None):
+                try:
+                    self.submit(path)
+                except Exception as e:
+                    logging.error(f"Error fanning out {path}, left for the next rescan: {e}")
+
+        thread = threading.Thread(target=forward, name="upload-feed", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+        return thread
+
+    def close(self, timeout=None):
+        '''
+        Wait for the queued uploads of every sink and stop their workers
+
+        Args:
+        timeout (float): Seconds to wait for the queues to drain, shared by the sinks
+        '''
+        self._stop.set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for pipeline in self.pipelines.values():
+            pipeline.close(None if deadline is None else max(deadline - time.monotonic(), 0))
+
+
+class AsyncFanOutPipeline:
+    """
+    Upload stage of several file sinks for the asyncio collectors.
+
+    Same contract as FanOutPipeline, with one AsyncUploadPipeline per sink.
+    """
+
+    def __init__(self, stores, pending_dir=PENDING_DIR, **options):
+        self.pending_dir = pending_dir
+        self.pipelines = {
+            name: AsyncUploadPipeline(store, pending_dir=os.path.join(pending_dir, name), **options)
+            for name, store in stores.items()
+        }
+        self._rescan = None
+        if not self.pipelines:
+            logging.warning("No file sinks, closed intervals are discarded")
+
+    @property
+    def backpressure(self):
+        return any(pipeline.backpressure for pipeline in self.pipelines.values())
+
+    @property
+    def stats(self):
+        return {name: pipeline.stats for name, pipeline in self.pipelines.items()}
+
+    def _fan_out(self, item):
+        return fan_out_item(item, [pipeline.pending_dir for pipeline in self.pipelines.values()])
+
+    async def start(self):
+        for pipeline in self.pipelines.values():
+            await pipeline.start()
+        if self.pipelines:
+            self._rescan = asyncio.create_task(self._rescan_loop())
+        return self
+
+    async def _rescan_loop(self):
+        while True:
+            for path in await asyncio.to_thread(pending_files, self.pending_dir):
+                try:
+                    await self.submit(path)
+                except Exception as e:
+                    logging.error(f"Error fanning out {path}, retrying on the next rescan: {e}")
+            await asyncio.sleep(RESCAN_INTERVAL)
+
+    async def submit(self, filename):
+        '''
+        Hand a closed interval file to the pipeline of every sink
+
+        Args:
+        filename (str): Name of the closed file, or an IntervalBuffer
+
+        Returns:
+        bool: False if the queue of a sink is full and its copy waits for the next rescan
+        '''
+        copies = await asyncio.to_thread(self._fan_out, filename)
+        return all([await pipeline.submit(copy) for pipeline, copy in zip(self.pipelines.values(), copies)])
+
+    async def close(self, timeout=None):
+        '''
+        Wait for the queued uploads of every sink and cancel their workers
+
+        Args:
+        timeout (float): Seconds to wait for the queues to drain, the sinks drain concurrently
+        '''
+        if self._rescan:
+            self._rescan.cancel()
+        await asyncio.gather(*(pipeline.close(timeout) for pipeline in self.pipelines.values()))
+
+
+class RemoteUploader:
+    """
+    Upload front end for worker processes.
+
+    Has the `submit` and `backpressure` of AsyncUploadPipeline, but only stages
+    the files and passes their paths over a multiprocessing queue to the one
+    UploadPipeline of the parent process, which reads it with `feed`. A full
+    queue leaves the file in the pending directory for the parent's rescan.
+    """
+
+    def __init__(self, queue, max_queue=QUEUE_SIZE, pending_dir=PENDING_DIR):
+        self.queue = queue
+        self.max_queue = max_queue
+        self.pending_dir = pending_dir
+        self.stats = {"submitted": 0, "deferred": 0}
+
+    @property
+    def backpressure(self):
+        try:
+            return self.queue.qsize() >= BACKPRESSURE_LEVEL * self.max_queue
+        except NotImplementedError:
+            # qsize is not available on macOS
+            return False
+
+    async def submit(self, filename):
+        # In-memory intervals are pickled over the queue, they still never touch the disk
+        path = await asyncio.to_thread(stage_item, filename, self.pending_dir)
+        try:
+            self.queue.put_nowait(path)
+        except queue.Full:
+            self.stats["deferred"] += 1
+            logging.warning(f"Upload queue full, {path} deferred to the next rescan")
+            await asyncio.to_thread(spill, path, self.pending_dir)
+            return False
+        self.stats["submitted"] += 1
+        return True
@@ -2,9 +2,10 @@ import logging
 import csv
 import os
 import shutil
-from google.cloud import storage
-
-gcs_client = storage.Client()
+from modules.formats import get_output_format, encode_buffer, gcs_key
+from modules.interval_writer import IntervalBuffer
+from modules.storage import get_storage, REMOTE_BACKEND
+from modules.metrics import LOG_TICKS
 
 logging.basicConfig(
     level=logging.INFO,
@@ -38,32 +39,55 @@ def save_to_csv_stream(data_tuple, filename):
     with open(filename, "a", newline='') as csvfile:
         csv_writer = csv.writer(csvfile)
         csv_writer.writerow(data_tuple)
-    logging.info(f"Data saved to {filename}")
+    if LOG_TICKS:
+        logging.info(f"Data saved to {filename}")
 
 
-def store_data_to_gcs(gcs_bucket_name, filename):
+def store_data_to_gcs(gcs_bucket_name, filename, output_format="csv"):
     '''
     Store a file in Google Cloud Storage
 
     Args:
     gcs_bucket_name (str): Name of the GCS bucket
-    filename (str): Name of the file to be stored in GCS
+    filename (str): Name of the file to be stored in GCS, or an IntervalBuffer of a diskless writer
+    output_format (str): Format the file is shipped in, see modules.formats
     '''
-    year, month, day, hour = map(int, filename.split("_")[2].split("-")[0:4])
-    gcs_key = f"{year}/{month}/{day}/{hour}/{filename}"
+    if isinstance(filename, IntervalBuffer):
+        return store_buffer_to_gcs(gcs_bucket_name, filename, output_format)
 
-    bucket = gcs_client.bucket(gcs_bucket_name)
-    blob = bucket.blob(gcs_key)
-    blob.upload_from_filename(filename)
-    logging.info(f"File {filename} uploaded successfully to {gcs_key}")
+    filename = get_output_format(output_format).convert(filename)
+    key = gcs_key(os.path.basename(filename))
+
+    get_storage(REMOTE_BACKEND, gcs_bucket_name).upload_file(key, filename)
+    logging.info(f"File {filename} uploaded successfully to {key}")
 
     # Remove the file after uploading
     os.remove(filename)
 
 
-def store_data_locally(filename):
+def store_buffer_to_gcs(gcs_bucket_name, interval, output_format="csv"):
+    '''
+    Stream an in-memory interval to Google Cloud Storage, nothing touches the disk
+
+    Args:
+    gcs_bucket_name (str): Name of the GCS bucket
+    interval (IntervalBuffer): Closed in-memory interval
+    output_format (str): Format the interval is shipped in, see modules.formats
+    '''
+    basename, data, content_type, content_encoding = encode_buffer(interval, output_format)
+    key = gcs_key(basename)
+    get_storage(REMOTE_BACKEND, gcs_bucket_name).write(key, data, content_type, content_encoding)
+    logging.info(f"Interval {interval.filename} uploaded successfully to {key} from memory")
+
+
+def store_data_locally(filename, output_format="csv"):
+    if isinstance(filename, IntervalBuffer):
+        return store_buffer_locally(filename, output_format)
+
+    filename = get_output_format(output_format).convert(filename)
+
     # Extract year, month, day, and hour from the filename
-    year, month, day, hour = filename.split("_")[2].split("-")[0:4]
+    year, month, day, hour = os.path.basename(filename).split("_")[2].split("-")[0:4]
 
     # Create local directory structure
     local_dir = os.path.join("data", year, month, day, hour)
@@ -76,6 +100,16 @@ def store_data_locally(filename):
     logging.info(f"File {local_filepath} stored locally")
 
 
+def store_buffer_locally(interval, output_format="csv"):
+    """Write an in-memory interval straight to its local partition"""
+    filename, data = get_output_format(output_format).encode(interval.filename, interval.csv_bytes())
+    basename = os.path.basename(filename)
+    year, month, day, hour = basename.split("_")[2].split("-")[0:4]
+    key = f"{year}/{month}/{day}/{hour}/{basename}"
+    get_storage("local").write(key, data)
+    logging.info(f"Interval {interval.filename} stored locally in {get_storage('local').path(key)}")
+
+
 if __name__ == "__main__":
     # Sample data
     data_list = [
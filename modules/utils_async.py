@@ -2,14 +2,15 @@ import logging
 import csv
 import os
 import shutil
-from google.cloud import storage
 import asyncio
 import aiofiles
-from google.api_core import retry
+from modules.formats import get_output_format, encode_buffer, gcs_key
+from modules.interval_writer import IntervalBuffer
+from modules.storage import get_storage, REMOTE_BACKEND
+from modules.metrics import LOG_TICKS
+from modules.utils import store_buffer_locally
 
 
-gcs_client = storage.Client()
-
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s'
@@ -31,21 +32,26 @@ async def save_to_csv_stream_async(data_tuple, filename):
     """
     async with aiofiles.open(filename, mode='a', newline='') as csvfile:
         await csvfile.write(','.join(map(str, data_tuple)) + '\n')
-    logging.info(f"Data appended to {filename}")
+    if LOG_TICKS:
+        logging.info(f"Data appended to {filename}")
+
 
-@retry.Retry(predicate=retry.if_exception_type(Exception))
-async def store_data_to_gcs_async(gcs_bucket_name, filename):
+async def store_data_to_gcs_async(gcs_bucket_name, filename, output_format="csv"):
     """
     Store a file in Google Cloud Storage asynchronously
+
+    Errors are logged and raised, retries are left to the upload pipeline.
+    `filename` can also be an IntervalBuffer of a diskless writer.
     """
+    if isinstance(filename, IntervalBuffer):
+        return await store_buffer_to_gcs_async(gcs_bucket_name, filename, output_format)
     try:
-        year, month, day, hour = map(int, filename.split("_")[2].split("-")[0:4])
-        gcs_key = f"{year}/{month}/{day}/{hour}/{filename}"
-        bucket = gcs_client.bucket(gcs_bucket_name)
-        blob = bucket.blob(gcs_key)
+        filename = await asyncio.to_thread(get_output_format(output_format).convert, filename)
+        key = gcs_key(os.path.basename(filename))
+        backend = get_storage(REMOTE_BACKEND, gcs_bucket_name)
 
-        await asyncio.to_thread(blob.upload_from_filename, filename)
-        logging.info(f"File {filename} uploaded successfully to {gcs_key}")
+        await asyncio.to_thread(backend.upload_file, key, filename)
+        logging.info(f"File {filename} uploaded successfully to {key}")
 
         # Remove the file after uploading
         await asyncio.to_thread(os.remove, filename)
@@ -55,11 +61,32 @@ async def store_data_to_gcs_async(gcs_bucket_name, filename):
         raise
 
 
-async def store_data_locally_async(filename):
+async def store_buffer_to_gcs_async(gcs_bucket_name, interval, output_format="csv"):
+    """
+    Stream an in-memory interval to Google Cloud Storage asynchronously, nothing touches the disk
+    """
+    try:
+        basename, data, content_type, content_encoding = await asyncio.to_thread(
+            encode_buffer, interval, output_format)
+        key = gcs_key(basename)
+        backend = get_storage(REMOTE_BACKEND, gcs_bucket_name)
+
+        await asyncio.to_thread(backend.write, key, data, content_type, content_encoding)
+        logging.info(f"Interval {interval.filename} uploaded successfully to {key} from memory")
+
+    except Exception as e:
+        logging.error(f"Error uploading {interval.filename} to GCS: {e}")
+        raise
+
+
+async def store_data_locally_async(filename, output_format="csv"):
     """
     Store data locally asynchronously
     """
-    year, month, day, hour = filename.split("_")[2].split("-")[0:4]
+    if isinstance(filename, IntervalBuffer):
+        return await asyncio.to_thread(store_buffer_locally, filename, output_format)
+    filename = await asyncio.to_thread(get_output_format(output_format).convert, filename)
+    year, month, day, hour = os.path.basename(filename).split("_")[2].split("-")[0:4]
     local_dir = os.path.join("data", year, month, day, hour)
     await asyncio.to_thread(os.makedirs, local_dir, exist_ok=True)
 
@@ -67,6 +94,7 @@ async def store_data_locally_async(filename):
     await asyncio.to_thread(shutil.move, filename, local_filepath)
     logging.info(f"File {local_filepath} stored locally")
 
+
 if __name__ == "__main__":
     # Sample data
     data_list = [
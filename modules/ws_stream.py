@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import aiohttp
+from modules import api_request_async
+from modules.order_book import LocalOrderBook
+from modules.fast_parse import loads, parse_payload
+from modules.formats import make_data_tuple
+from modules.rate_limiter import rate_limiter
+
+# Constants
+WS_URL = "wss://ws.bitso.com"
+HEARTBEAT = 30
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 30
+SNAPSHOT_TIMEOUT = 10  # seconds, unaggregated snapshots are much larger than the top of book
+
+
+class OrderBookStream:
+    """
+    Keeps a local order book per book up to date from Bitso's websocket.
+
+    Each book is subscribed to the diff-orders channel and seeded from an
+    unaggregated REST snapshot. Diffs are applied in sequence order; a gap in
+    the sequence numbers, or a reconnect, triggers a resync: diffs are buffered
+    while a new snapshot is fetched, then the ones newer than the snapshot are
+    replayed on top of it. Snapshots go through the shared rate limiter, so a
+    resync costs one REST request instead of one per second. A diff that can't
+    be applied also resyncs its book, and while disconnected every book waits
+    for a resync, so a stale book is never sampled.
+    """
+
+    def __init__(self, books, api_key, api_secret, ws_url=WS_URL, snapshot_url=None, limiter=rate_limiter):
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.ws_url = ws_url
+        self.snapshot_url = snapshot_url or api_request_async.BASE_URL
+        self.limiter = limiter
+        self.books = {book: LocalOrderBook(book) for book in books}
+        self.stats = {book: {"messages": 0, "gaps": 0, "resyncs": 0, "errors": 0} for book in books}
+        self._pending = {book: [] for book in books}  # Diffs buffered while a snapshot loads
+        self._resync_tasks = {}
+
+    def top_of_book_tuple(self, book):
+        '''
+        Current top-of-book row of a book
+
+        Returns:
+        tuple: Row matching the interval files, None while the book is resyncing
+        '''
+        order_book = self.books[book]
+        if book in self._pending or order_book.best_bid is None or order_book.best_ask is None:
+            return None
+        return make_data_tuple(book, order_book.best_bid, order_book.best_ask)
+
+    async def run(self, session):
+        """Stream until cancelled, reconnecting with exponential backoff"""
+        delay = RECONNECT_DELAY
+        while True:
+            try:
+                async with session.ws_connect(self.ws_url, heartbeat=HEARTBEAT) as ws:
+                    for book in self.books:
+                        await ws.send_json({"action": "subscribe", "book": book, "type": "diff-orders"})
+                        self._resync(book, session)
+                    logging.info(f"Streaming {len(self.books)} books from {self.ws_url}")
+                    delay = RECONNECT_DELAY
+
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            self._on_message(msg.data, session)
+                        elif msg.type == aiohttp.WSMsgType.ERROR:
+                            break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.error(f"Websocket error: {e}")
+            finally:
+                for task in self._resync_tasks.values():
+                    task.cancel()
+                self._resync_tasks.clear()
+                # Diffs are missed until the next connection resyncs the books
+                self._pending = {book: [] for book in self.books}
+
+            logging.warning(f"Websocket disconnected, reconnecting in {delay}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def _on_message(self, data, session):
+        try:
+            message = loads(data)
+            book = message.get('book')
+        except Exception as e:
+            logging.error(f"Malformed websocket message: {e}")
+            return
+        if message.get('type') != 'diff-orders' or book not in self.books or 'sequence' not in message:
+            return
+
+        try:
+            self._on_diff(book, message, session)
+        except Exception as e:
+            self._on_bad_diff(book, e, session)
+
+    def _on_bad_diff(self, book, error, session):
+        """Resync a book whose diff could not be applied, it may be half applied"""
+        logging.error(f"Bad diff for {book}, resyncing from a snapshot: {error}")
+        self.stats[book]["errors"] += 1
+        self._resync(book, session)
+
+    def _on_diff(self, book, message, session):
+        sequence = int(message['sequence'])
+        orders = message.get('payload') or []
+        self.stats[book]["messages"] += 1
+
+        if book in self._pending:
+            self._pending[book].append((sequence, orders))
+            return
+
+        order_book = self.books[book]
+        if sequence <= order_book.sequence:
+            return
+        if sequence != order_book.sequence + 1:
+            logging.warning(f"Sequence gap on {book}: expected {order_book.sequence + 1}, got {sequence}")
+            self.stats[book]["gaps"] += 1
+            self._resync(book, session)
+            self._pending[book].append((sequence, orders))
+            return
+
+        order_book.apply(sequence, orders)
+
+    def _resync(self, book, session):
+        self._pending.setdefault(book, [])
+        if book not in self._resync_tasks:
+            self._resync_tasks[book] = asyncio.create_task(self._load_snapshot(book, session))
+
+    async def _load_snapshot(self, book, session):
+        self.stats[book]["resyncs"] += 1
+        order_book = self.books[book]
+        params = {"book": book, "aggregate": "false"}
+
+        while True:
+            try:
+                await self.limiter.acquire_async(book)
+                response = await asyncio.wait_for(api_request_async.make_request(
+                    self.api_key, self.api_secret, "GET", self.snapshot_url, params, session, self.limiter
+                ), SNAPSHOT_TIMEOUT)
+                order_book.load_snapshot(parse_payload(response))
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Error loading {book} snapshot: {e}")
+                await asyncio.sleep(RECONNECT_DELAY)
+
+        del self._resync_tasks[book]
+        pending = self._pending.pop(book)
+        for i, (sequence, orders) in enumerate(pending):
+            if sequence <= order_book.sequence:
+                continue
+            if sequence != order_book.sequence + 1:
+                # The snapshot is older than the buffered diffs, fetch a newer one
+                logging.warning(f"Snapshot of {book} at {order_book.sequence} doesn't reach diff {sequence}")
+                self.stats[book]["gaps"] += 1
+                self._resync(book, session)
+                self._pending[book].extend(pending[i:])
+                return
+            try:
+                order_book.apply(sequence, orders)
+            except Exception as e:
+                self._on_bad_diff(book, e, session)
+                self._pending[book].extend(pending[i + 1:])
+                return
+
+        logging.info(f"Order book {book} synced at sequence {order_book.sequence}")